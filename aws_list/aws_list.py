@@ -3,39 +3,75 @@
 """
 Script to list Amazon Web Services (AWS) information
 """
+import io
 import os
 import sys
 import argparse
 import logging
+import traceback
+import importlib
+import contextlib
 
 # Get script path
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 # Add path where modules reside
 sys.path.append(DIR_PATH + "/resources")
 
-from s3 import cmd_list_s3
-from regions import cmd_list_regions
-from securitygroup import cmd_list_securitygroup
-from subnet import cmd_list_subnets
-from vpcs import cmd_list_vpcs
-from volumes import cmd_list_volumes
-from instances import cmd_num_inst
-from instances import cmd_list_instances
-from ami import cmd_show_ami_detail
 from pcof import msg
 from pcof import setup_logging
+from cache import configure_api_cache
+from ratelimit import configure_rate_limit
+from ratelimit import RETRY_MODE
+from ratelimit import RETRY_MAX_ATTEMPTS
+from pool import configure_pool
+from pool import pool_stats
+from stats import configure_stats
+from stats import write_stats
+from profiling import profile_run
 
 
 # If --debug, write log to filename
 LOG_FILENAME = 'aws.log'
 
+# Default number of threads used to query regions in parallel
+MAX_WORKERS = 10
+
 # Global log
 log = ''
 
+
+###########################################################################
+# Return a function that imports the subcommand module only when called
+#
+# Subcommand modules load boto3, botocore and prettytable, which are slow
+# to import, so they are not loaded for --help or other subcommands
+###########################################################################
+def lazy_cmd(module_name, func_name):
+    def cmd(args):
+        module = importlib.import_module(module_name)
+        return getattr(module, func_name)(args)
+    return cmd
+
+
+###########################################################################
+# argparse type of options that must be an integer greater than zero
+###########################################################################
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "invalid positive int value: '%s'" % value)
+    return number
+
+
 ###########################################################################
 # Parses the command line arguments
+# Params: argv (list): Optional. Arguments, default is sys.argv[1:]
 ###########################################################################
-def parse_parameters():
+def parse_parameters(argv=None):
     # epilog message: Custom text after the help
     epilog = '''
     Example of use:
@@ -43,7 +79,10 @@ def parse_parameters():
         %s instances -filter instance-id i-0b849030d3949ac16
         %s instances -filter tag:Name DNS
         %s instances -detail
-    ''' % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+        %s --regions all instances
+        %s --regions all numinstances InstanceType,Tag:Team
+    ''' % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0],
+           sys.argv[0])
     # Create the argparse object and define global options
     parser = argparse.ArgumentParser(
         description='Script to list Amazon Web Services (AWS) information',
@@ -56,6 +95,101 @@ def parse_parameters():
     parser.add_argument('--profile', '-p',
                         help='Profile Name',
                         dest='profile')
+    parser.add_argument('--regions', '-r',
+                        metavar='all|region1,region2',
+                        help='Query these regions in parallel. '
+                             'Default is the configured region',
+                        dest='regions')
+    parser.add_argument('--workers',
+                        type=positive_int,
+                        default=MAX_WORKERS,
+                        help='Max number of parallel queries (default: %s)'
+                             % MAX_WORKERS,
+                        dest='workers')
+    parser.add_argument('--engine',
+                        choices=['threads', 'asyncio'],
+                        default='threads',
+                        help='Query engine (default: threads). asyncio '
+                             'queries all regions and id chunks in one '
+                             'event loop, with at most --workers requests '
+                             'per region. It needs aiobotocore',
+                        dest='engine')
+    parser.add_argument('--format', '-f',
+                        choices=['table', 'csv', 'tsv', 'jsonl'],
+                        default='table',
+                        help='Output format (default: table). csv, tsv '
+                             'and jsonl of instances, volumes, subnets, '
+                             'vpcs and secgroups lists are streamed, '
+                             'unless -sortby is used',
+                        dest='format')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='Print table rows as soon as they are '
+                             'received, with fixed column widths and '
+                             'no sorting',
+                        dest='stream')
+    parser.add_argument('--cache',
+                        action='store_true',
+                        help='Cache API responses on disk '
+                             '(~/.cache/aws_list)',
+                        dest='cache')
+    parser.add_argument('--cache-ttl',
+                        type=int,
+                        metavar='SECONDS',
+                        help='Time to live of all cached responses, '
+                             'instead of the per resource defaults. '
+                             'It implies --cache. 0 stores responses '
+                             'without reading them',
+                        dest='cache_ttl')
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        help='Ignore cached responses and fetch them again',
+                        dest='refresh')
+    parser.add_argument('--api-rate',
+                        type=float,
+                        metavar='REQ_PER_SEC',
+                        help='Max API requests per second per profile, '
+                             'region and API family, instead of the per '
+                             'service defaults. 0 disables the limit',
+                        dest='api_rate')
+    parser.add_argument('--retries',
+                        type=int,
+                        default=RETRY_MAX_ATTEMPTS,
+                        help='Max attempts of each API request '
+                             '(default: %d)' % RETRY_MAX_ATTEMPTS,
+                        dest='retries')
+    parser.add_argument('--retry-mode',
+                        choices=['legacy', 'standard', 'adaptive'],
+                        default=RETRY_MODE,
+                        help='botocore retry mode, botocore < 1.15 only has '
+                             'legacy (default: %s)' % RETRY_MODE,
+                        dest='retry_mode')
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help='Write API calls, retries, throttles, latency '
+                             'percentiles and phases time to stderr',
+                        dest='stats')
+    parser.add_argument('--stats-file',
+                        metavar='FILE',
+                        help='Write the --stats summary as json to FILE. '
+                             'It implies --stats',
+                        dest='stats_file')
+    parser.add_argument('--profile-run',
+                        choices=['cpu', 'mem'],
+                        help='Profile the command with cProfile (cpu, '
+                             'main thread) or tracemalloc (mem) and '
+                             'write a report to stderr',
+                        dest='profile_run')
+    parser.add_argument('--profile-output',
+                        metavar='FILE',
+                        help='With --profile-run, write the pstats file '
+                             '(cpu) or the report (mem) to FILE',
+                        dest='profile_output')
+    parser.add_argument('--no-daemon',
+                        action='store_true',
+                        help='Do not forward the command to a running '
+                             'daemon (see serve)',
+                        dest='no_daemon')
     # Add subcommands options
     subparsers = parser.add_subparsers(title='Commands', dest='command')
     #############
@@ -70,6 +204,18 @@ def parse_parameters():
     listinst_parser.add_argument('-sortby',
                                  dest='sortby',
                                  help='Sort table output by "column"')
+    listinst_parser.add_argument('-tag',
+                                 action='append',
+                                 metavar='key[=value]',
+                                 dest='tag',
+                                 help='Only instances with this tag. '
+                                      'It can be used many times')
+    listinst_parser.add_argument('-tag-missing',
+                                 action='append',
+                                 metavar='key',
+                                 dest='tag_missing',
+                                 help='Only instances without this tag key. '
+                                      'It can be used many times')
     listinst_group = listinst_parser.add_mutually_exclusive_group()
     listinst_group.set_defaults(output='table')
     listinst_group.add_argument('-detail',
@@ -102,7 +248,8 @@ def parse_parameters():
                                 const='names',
                                 dest='output',
                                 help='Show vpc and subnet names details')
-    listinst_parser.set_defaults(func=cmd_list_instances)
+    listinst_parser.set_defaults(
+        func=lazy_cmd('instances', 'cmd_list_instances'))
     ###############
     # numinstance #
     ###############
@@ -115,14 +262,19 @@ def parse_parameters():
     listnuminst_parser.add_argument('-sortby',
                                     dest='sortby',
                                     help='Sort table output by "column"')
-    listnuminst_parser.add_argument(choices=['InstanceType',
-                                             'ImageId',
-                                             'VpcId',
-                                             'AvailabilityZone',
-                                             'SubnetId'],
+    listnuminst_parser.add_argument('-profiles',
+                                    metavar='profile1,profile2',
+                                    help='Add up the instances of these '
+                                         'profiles. Default is --profile')
+    listnuminst_parser.add_argument(metavar='type1,type2',
                                     dest='pertype',
-                                    help='Show Number of Instances per Type')
-    listnuminst_parser.set_defaults(func=cmd_num_inst)
+                                    help='Show Number of Instances per Type. '
+                                         'Types: InstanceType, ImageId, '
+                                         'VpcId, AvailabilityZone, SubnetId, '
+                                         'InstanceState, KeyName, Region, '
+                                         'Profile or Tag:<key>')
+    listnuminst_parser.set_defaults(
+        func=lazy_cmd('instances', 'cmd_num_inst'))
     #######
     # ami #
     #######
@@ -130,13 +282,15 @@ def parse_parameters():
         'ami', help='List [EC2] AMI (Amazon Machine Images)')
     listami_parser.add_argument('ami_id',
                                 help='AMI ID')
-    listami_parser.set_defaults(func=cmd_show_ami_detail)
+    listami_parser.set_defaults(
+        func=lazy_cmd('ami', 'cmd_show_ami_detail'))
     ##################################
     # Regions and Availability Zones #
     ##################################
     listregion_parser = subparsers.add_parser(
         'regions', help='List [EC2] Regions and Availability Zones')
-    listregion_parser.set_defaults(func=cmd_list_regions)
+    listregion_parser.set_defaults(
+        func=lazy_cmd('regions', 'cmd_list_regions'))
     ##################
     # security group #
     ##################
@@ -151,11 +305,19 @@ def parse_parameters():
     listsecgroup_parser.add_argument('-rules',
                                      action='store_true',
                                      help='Show security group rules')
+    listsecgroup_parser.add_argument('-reach',
+                                     nargs=2,
+                                     metavar=('source', 'port[/protocol]'),
+                                     help='Show inbound rules that allow a '
+                                          'source (ip, cidr or group id) to '
+                                          'reach a port. Default protocol '
+                                          'is tcp')
     listsecgroup_parser.add_argument('-filter',
                                      nargs=2,
                                      metavar=('filter_name', 'value'),
                                      help='Filter VPCs')
-    listsecgroup_parser.set_defaults(func=cmd_list_securitygroup)
+    listsecgroup_parser.set_defaults(
+        func=lazy_cmd('securitygroup', 'cmd_list_securitygroup'))
     ###########
     # subnets #
     ###########
@@ -167,11 +329,21 @@ def parse_parameters():
     listsubnet_parser.add_argument('-detail',
                                    action='store_true',
                                    help='Show subnet metadata detail')
+    listsubnet_parser.add_argument('-overlaps',
+                                   action='store_true',
+                                   help='Show subnets of different VPCs '
+                                        'with overlapping cidrs')
+    listsubnet_parser.add_argument('-profiles',
+                                   metavar='profile1,profile2',
+                                   help='With -overlaps, compare the subnets '
+                                        'of these profiles. Default is '
+                                        '--profile')
     listsubnet_parser.add_argument('-filter',
                                    nargs=2,
                                    metavar=('filter_name', 'value'),
                                    help='Filter VPCs')
-    listsubnet_parser.set_defaults(func=cmd_list_subnets)
+    listsubnet_parser.set_defaults(
+        func=lazy_cmd('subnet', 'cmd_list_subnets'))
     ######
     # S3 #
     ######
@@ -183,7 +355,8 @@ def parse_parameters():
     lists3_parser.add_argument('-numobj',
                                action='store_true',
                                help='Show S3 Bucket Number of Objects')
-    lists3_parser.set_defaults(func=cmd_list_s3)
+    lists3_parser.set_defaults(
+        func=lazy_cmd('s3', 'cmd_list_s3'))
     ###########
     # volumes #
     ###########
@@ -199,7 +372,8 @@ def parse_parameters():
                                     nargs=2,
                                     metavar=('filter_name', 'value'),
                                     help='Filter volumes')
-    listvolumes_parser.set_defaults(func=cmd_list_volumes)
+    listvolumes_parser.set_defaults(
+        func=lazy_cmd('volumes', 'cmd_list_volumes'))
     #######
     # Vpc #
     #######
@@ -212,18 +386,97 @@ def parse_parameters():
     listvpc_group.add_argument('-detail',
                                action='store_true',
                                help='Show vpcs detail')
+    listvpc_group.add_argument('-overlaps',
+                               action='store_true',
+                               help='Show VPCs with overlapping cidrs')
+    listvpc_parser.add_argument('-profiles',
+                                metavar='profile1,profile2',
+                                help='With -overlaps, compare the VPCs of '
+                                     'these profiles. Default is --profile')
     listvpc_parser.add_argument('-filter',
                                 nargs=2,
                                 metavar=('filter_name', 'value'),
                                 help='Filter VPCs')
-    listvpc_parser.set_defaults(func=cmd_list_vpcs)
+    listvpc_parser.set_defaults(
+        func=lazy_cmd('vpcs', 'cmd_list_vpcs'))
+    #########
+    # serve #
+    #########
+    serve_parser = subparsers.add_parser(
+        'serve', help='Serve commands from a resident daemon')
+    serve_parser.add_argument('-socket',
+                              metavar='PATH',
+                              help='Unix socket path (default: '
+                                   '$AWS_LIST_SOCKET or '
+                                   '~/.cache/aws_list/aws_list.sock)')
+    serve_parser.add_argument('-refresh',
+                              type=int,
+                              default=60,
+                              metavar='SECONDS',
+                              dest='daemon_refresh',
+                              help='Refresh each command output every '
+                                   'SECONDS (default: 60)')
+    serve_parser.set_defaults(func=cmd_serve)
 
     # If there is no parameter, print help
-    if len(sys.argv) < 2:
+    if len(sys.argv if argv is None else [None] + argv) < 2:
         parser.print_help()
         sys.exit(0)
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+
+    # -profiles of subnets and vpcs is only used by -overlaps
+    for command, command_parser in (('subnets', listsubnet_parser),
+                                    ('vpcs', listvpc_parser)):
+        if args.command == command and args.profiles and not args.overlaps:
+            command_parser.error("argument -profiles: requires -overlaps")
+
+    return args
+
+
+###########################################################################
+# Run a command as the daemon does
+# Params: argv (list): command line arguments, without the script name
+#
+# Cache, rate limit and pool settings of each command are applied, pooled
+# clients are kept if they did not change
+# Return tuple: command output (stdout), errors (stderr), exit code
+###########################################################################
+def run_command(argv):
+    output = io.StringIO()
+    errors = io.StringIO()
+    exitcode = 0
+    with contextlib.redirect_stdout(output), \
+            contextlib.redirect_stderr(errors):
+        try:
+            args = parse_parameters(argv)
+            if not args.command or args.command == 'serve':
+                msg("red", "Erro: Use -h for help", 1)
+            configure_api_cache(args)
+            configure_rate_limit(args)
+            configure_pool(args)
+            args.func(args)
+        # msg() and argparse exit with SystemExit
+        except SystemExit as error:
+            if isinstance(error.code, int):
+                exitcode = error.code
+            elif error.code:
+                print(error.code, file=sys.stderr)
+                exitcode = 1
+        # the daemon keeps running, show the error as the script would do
+        except Exception:
+            traceback.print_exc()
+            exitcode = 1
+
+    return output.getvalue(), errors.getvalue(), exitcode
+
+
+###########################################################################
+# Serve commands from a resident daemon
+###########################################################################
+def cmd_serve(args):
+    daemon = importlib.import_module('aws_list_daemon')
+    daemon.serve(args, run_command)
 
 
 ##############################################################################
@@ -250,7 +503,30 @@ def main():
     if not args.command:
         msg("red", "Erro: Use -h for help", 1)
 
-    args.func(args)
+    # forward the command to a running daemon, if there is one. Stats
+    # and profiles are only collected by the process that runs it
+    if (args.command != 'serve' and not args.no_daemon and not args.debug
+            and not args.stats and not args.stats_file
+            and not args.profile_run):
+        daemon = importlib.import_module('aws_list_daemon')
+        answer = daemon.forward_command(daemon.socket_path(), sys.argv[1:])
+        if answer is not None:
+            sys.stdout.write(answer[0])
+            sys.stderr.write(answer[1])
+            sys.exit(answer[2])
+
+    configure_api_cache(args)
+    configure_rate_limit(args)
+    configure_pool(args)
+    configure_stats(args)
+
+    try:
+        with profile_run(args):
+            args.func(args)
+    finally:
+        # commands that fail (ex: no instance found) also have stats
+        write_stats(args)
+    log.debug("sessions and clients pool: %s", pool_stats())
 
 
 ##############################################################################
@@ -1,15 +1,43 @@
 """
 Module with AWS EC2 class and functions
 """
+import sys
+import copy
 import logging
 import pprint
-import boto3
-import botocore
+import queue
+import threading
+import ipaddress
+import collections
+import concurrent.futures
 from pcof import msg
+from pcof import LazyPformat
+from pcof import StreamTable
+from pool import get_resource
+from stats import phase
 
 
 log = logging.getLogger(__name__)
 
+# Query paths already warned that --engine asyncio does not apply to them
+_threads_only_warned = set()
+
+
+##############################################################################
+# Return value with all strings in it interned
+#
+# Values repeated by many resources (ex: availability zone, instance type)
+# are then stored only once in memory
+##############################################################################
+def intern_strings(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, dict):
+        return {sys.intern(k): intern_strings(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [intern_strings(i) for i in value]
+    return value
+
 
 ##############################################################################
 # Aws EC2 Class
@@ -21,11 +49,28 @@ class Aws_ec2():
         ec2            (obj): boto3 ec2 resource
         resource_type  (str): Aws resource type
         resource_id    (str): Aws resource id
+        metadata      (dict): Optional. Resource metadata already returned
+                              by a Describe* page. If not informed, the
+                              resource is loaded with its own API call
+        fields        (list): Optional. Metadata keys to keep, the others
+                              are dropped to save memory. Default keeps all
+
+    Objects are compact records: they only keep the metadata, not the
+    boto3 resource, and values in repeated_fields are interned.
+    Tags are kept in the tags dictionary (key -> value), the Tags list
+    is only kept in the metadata when fields is not informed.
     """
+    __slots__ = ('resource_type', 'resource_id', 'region_name', 'metadata',
+                 'tags')
+
     available_types = ['Volume', 'Image', 'Instance', 'Vpc', 'Subnet',
                        'SecurityGroup', 'RouteTable', 'VpcPeeringConnection']
 
-    def __init__(self, ec2, resource_type, resource_id):
+    # metadata keys whose values are usually repeated by many resources
+    repeated_fields = ('Tags',)
+
+    def __init__(self, ec2, resource_type, resource_id, metadata=None,
+                 fields=None):
         log.info("Creating Aws type: %s, id: %s", resource_type, resource_id)
 
         if resource_type not in self.available_types:
@@ -33,16 +78,42 @@ class Aws_ec2():
 
         self.resource_type = resource_type
         self.resource_id = resource_id
-        # fetch an attribute from an object
-        # ec2.resource_type(resource_id)
-        self.ec2 = getattr(ec2, self.resource_type)(self.resource_id)
-        self.ec2.load()
-        self.metadata = self.ec2.meta.__dict__['data']
-        if not self.metadata:
+        self.region_name = sys.intern(ec2.meta.client.meta.region_name)
+        if metadata is None:
+            # fetch an attribute from an object
+            # ec2.resource_type(resource_id)
+            resource = getattr(ec2, self.resource_type)(self.resource_id)
+            resource.load()
+            metadata = resource.meta.__dict__['data']
+        # else: metadata came from a list page, no need to describe it again
+        if not metadata:
             msg("red", "resource_type: " + resource_type)
             msg("red", "resource_id: " + resource_id)
             msg("red", "metadata not loaded", 1)
-        log.debug("metadata: %s", pprint.pformat(self.metadata))
+        self.tags = {sys.intern(tag['Key']): sys.intern(tag['Value'])
+                     for tag in metadata.get('Tags') or ()}
+        self.metadata = self.compact_metadata(metadata, fields)
+        # hot path: called for every resource, skip it unless debugging
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("metadata: %s", LazyPformat(self.metadata))
+
+    def compact_metadata(self, metadata, fields):
+        """
+        Return metadata with only the keys in fields and with the values
+        of repeated_fields interned
+
+        Params:
+            metadata  (dict): resource metadata
+            fields    (list): metadata keys to keep. None keeps all keys
+        """
+        if fields is not None:
+            # Tags are already in self.tags
+            metadata = {key: metadata[key] for key in fields
+                        if key in metadata and key != 'Tags'}
+        for key in self.repeated_fields:
+            if key in metadata:
+                metadata[key] = intern_strings(metadata[key])
+        return metadata
 
     def show_metadata(self):
         """
@@ -57,6 +128,12 @@ class Aws_ec2():
             pprint.pprint(value)
         print("")
 
+    def region(self):
+        """
+        Return region where the resource was found
+        """
+        return self.region_name
+
     def tag_value(self, key):
         """
         Return tag value for a specific tag key
@@ -64,29 +141,13 @@ class Aws_ec2():
         Params:
             key    (str): metadata Tag key
         """
-        log.info("key: %s", key)
-
-        try:
-            value = [tag['Value']
-                     for tag in self.metadata['Tags'] if tag['Key'] == key]
-        except KeyError:
-            return [""][0]
-
-        if value:
-            return value[0]
-        else:
-            return [""][0]
+        return self.tags.get(key, "")
 
     def all_tags_key(self):
         """
         Return a list with all tag keys
         """
-        log.info("Looking for tag keys: id: %s", self.resource_id)
-
-        all_keys = [tag['Key'] for tag in self.metadata['Tags']]
-
-        log.debug("all_keys: %s", pprint.pformat(all_keys))
-        return all_keys
+        return list(self.tags)
 
     def tag_name(self):
         """
@@ -94,6 +155,23 @@ class Aws_ec2():
         """
         return self.tag_value("Name")
 
+    def match_tags(self, tags=(), missing=()):
+        """
+        Return True if the resource has all tags and none of the missing
+        tag keys
+
+        Params:
+            tags      (list): (key, value) tuples. If value is None, any
+                              value matches
+            missing   (list): tag keys the resource must not have
+        """
+        for key, value in tags:
+            if key not in self.tags:
+                return False
+            if value is not None and self.tags[key] != value:
+                return False
+        return not any(key in self.tags for key in missing)
+
     def find_key(self, dict_obj, key):
         """
         Function to search in a dictionary for an specific key
@@ -133,6 +211,10 @@ class Aws_ec2_instance(Aws_ec2):
     """
     Aws ec2 class for Instance
     """
+    __slots__ = ()
+
+    repeated_fields = ('Tags', 'InstanceType', 'Placement', 'State', 'ImageId',
+                       'KeyName', 'VpcId', 'SubnetId', 'SecurityGroups')
 
     def availabilityzone(self):
         return self.metadata['Placement']['AvailabilityZone']
@@ -191,9 +273,15 @@ class Aws_ec2_ami(Aws_ec2):
     """
     Aws ec2 class for AMI
     """
+    __slots__ = ()
+
+    repeated_fields = ('Tags', 'OwnerId', 'ImageOwnerAlias', 'RootDeviceType')
 
     def description(self):
-        return self.metadata['Description']
+        try:
+            return self.metadata['Description']
+        except KeyError:
+            return ""
 
     def creationdate(self):
         return self.metadata['CreationDate']
@@ -221,6 +309,9 @@ class Aws_ec2_volume(Aws_ec2):
     """
     Aws ec2 class for volume
     """
+    __slots__ = ()
+
+    repeated_fields = ('Tags', 'AvailabilityZone', 'VolumeType', 'State')
 
     def volumeid(self):
         return self.resource_id
@@ -264,6 +355,9 @@ class Aws_ec2_vpc(Aws_ec2):
     """
     Aws ec2 class for vpc
     """
+    __slots__ = ()
+
+    repeated_fields = ('Tags', 'DhcpOptionsId', 'InstanceTenancy', 'State')
 
     def vpcid(self):
         return self.resource_id
@@ -271,6 +365,18 @@ class Aws_ec2_vpc(Aws_ec2):
     def cidrblock(self):
         return self.metadata['CidrBlock']
 
+    def cidrblocks(self):
+        """
+        Return list with primary and secondary, ipv4 and ipv6, cidrs
+        """
+        cidrs = [i['CidrBlock']
+                 for i in self.metadata.get('CidrBlockAssociationSet', [])
+                 if i['CidrBlockState']['State'] == 'associated']
+        cidrs += [i['Ipv6CidrBlock']
+                  for i in self.metadata.get('Ipv6CidrBlockAssociationSet', [])
+                  if i['Ipv6CidrBlockState']['State'] == 'associated']
+        return cidrs or [self.cidrblock()]
+
     def dhcpoptionsid(self):
         return self.metadata['DhcpOptionsId']
 
@@ -291,6 +397,9 @@ class Aws_ec2_subnet(Aws_ec2):
     """
     Aws ec2 class for subnet
     """
+    __slots__ = ()
+
+    repeated_fields = ('Tags', 'VpcId', 'AvailabilityZone', 'State')
 
     def subnetid(self):
         return self.resource_id
@@ -301,6 +410,16 @@ class Aws_ec2_subnet(Aws_ec2):
     def cidrblock(self):
         return self.metadata['CidrBlock']
 
+    def cidrblocks(self):
+        """
+        Return list with ipv4 and ipv6 cidrs
+        """
+        cidrs = [self.cidrblock()]
+        cidrs += [i['Ipv6CidrBlock']
+                  for i in self.metadata.get('Ipv6CidrBlockAssociationSet', [])
+                  if i['Ipv6CidrBlockState']['State'] == 'associated']
+        return cidrs
+
     def availableipaddresscount(self):
         return self.metadata['AvailableIpAddressCount']
 
@@ -321,6 +440,9 @@ class Aws_ec2_secgroup(Aws_ec2):
     """
     Aws ec2 class for Security Groups
     """
+    __slots__ = ()
+
+    repeated_fields = ('Tags', 'VpcId')
 
     def groupid(self):
         return self.resource_id
@@ -391,14 +513,198 @@ class Aws_ec2_secgroup(Aws_ec2):
         return all_rules
 
 
+##############################################################################
+# Tag Index Class
+##############################################################################
+class Aws_tag_index():
+    """
+    Inverted index of the tags of many resources, built once per run
+
+    Params:
+        resources (list): Optional. Aws_ec2 objects to index
+    """
+
+    def __init__(self, resources=()):
+        # ids of all indexed resources
+        self.ids = set()
+        # tag key -> resource ids with the key
+        self.key_ids = collections.defaultdict(set)
+        # tag key -> tag value -> resource ids
+        self.value_ids = collections.defaultdict(
+            lambda: collections.defaultdict(set))
+
+        for resource in resources:
+            self.add(resource)
+
+    def add(self, resource):
+        """
+        Add a resource tags to the index
+        """
+        self.ids.add(resource.resource_id)
+        for key, value in resource.tags.items():
+            self.key_ids[key].add(resource.resource_id)
+            self.value_ids[key][value].add(resource.resource_id)
+
+    def select(self, tags=(), missing=()):
+        """
+        Return set with the ids of resources that have all tags and none
+        of the missing tag keys
+
+        Params:
+            tags      (list): (key, value) tuples. If value is None, any
+                              value matches
+            missing   (list): tag keys the resource must not have
+        """
+        selected = None
+        # start from the most selective tag, so the sets stay small
+        for key, value in sorted(tags, key=lambda tag: len(
+                self.key_ids.get(tag[0], ()))):
+            if value is None:
+                ids = self.key_ids.get(key, set())
+            else:
+                ids = self.value_ids.get(key, {}).get(value, set())
+            selected = set(ids) if selected is None else selected & ids
+            if not selected:
+                return set()
+
+        if selected is None:
+            selected = set(self.ids)
+        for key in missing:
+            selected -= self.key_ids.get(key, set())
+
+        return selected
+
+
+# Max number of values sent in a single Describe* filter
+MAX_FILTER_VALUES = 200
+
+# Estimated column widths used by streamed tables
+STREAM_WIDTHS = {'InstanceId': 19, 'VolumeId': 21, 'VpcId': 21,
+                 'SubnetId': 24, 'GroupId': 20, 'Tag_Name': 30,
+                 'GroupName': 30, 'Description': 40, 'InBound': 45,
+                 'OutBound': 45, 'CidrBlock': 18, 'DhcpOptionsId': 22,
+                 'AvailabilityZone': 16, 'InstanceType': 12,
+                 'InstanceState': 13, 'KeyName': 20, 'PrivateIpAddress': 16,
+                 'LaunchTime': 25, 'CreateTime': 32, 'VolumeType': 10,
+                 'Device': 10, 'State': 10, 'Size': 6, 'Region': 14}
+
+# Map boto3 ec2 collection name to its resource type
+collection_types = {'instances': 'Instance',
+                    'images': 'Image',
+                    'volumes': 'Volume',
+                    'vpcs': 'Vpc',
+                    'subnets': 'Subnet',
+                    'security_groups': 'SecurityGroup'}
+
+
+###############################################################################
+# Query AWS EC2 resource pages
+#
+# Generator that yields one list of aws_class objects per page returned
+# by the Describe* call. Objects are built from the page metadata, so
+# there is no extra API call per resource. If fields is informed, objects
+# only keep these metadata keys
+###############################################################################
+def query_aws_pages(ec2, aws_class, *, resource_type,
+                    filter_name='', filter_value='', filters=None,
+                    fields=None):
+    log.info("Params: resource_type: %s, filter_name: %s, filter_value: %s",
+             resource_type, filter_name, filter_value)
+    # botocore is loaded by boto3 when the session is created
+    import botocore.exceptions
+
+    collection = getattr(ec2, resource_type)
+    if filter_name and not filters:
+        filters = [{'Name': filter_name,
+                    'Values': ['*' + filter_value + '*']}]
+    if filters:
+        log.debug("querying with filter")
+        log.debug("filters: %s", LazyPformat(filters))
+        collection = collection.filter(Filters=filters)
+    else:
+        log.debug("querying without filter")
+        collection = collection.all()
+
+    try:
+        for page in collection.pages():
+            yield [aws_class(ec2,
+                             collection_types[resource_type],
+                             resource.id,
+                             metadata=resource.meta.data,
+                             fields=fields)
+                   for resource in page]
+    except botocore.exceptions.ClientError as error:
+        msg("red", str(error), 1)
+
+
+###############################################################################
+# Query AWS EC2 resources by id
+#
+# Resolve a list of ids with chunked multi-value filter queries, so the
+# number of API calls grows with chunks/pages, not with the number of ids.
+# Ids not found (ex: deregistered ami) are just missing from the result.
+# If scan_threshold is informed and there are more ids than it, a single
+# paginated scan of all resources is done instead of the chunked queries.
+#
+# Return dictionary: resource id -> aws_class object
+###############################################################################
+def query_aws_by_ids(ec2, aws_class, *, resource_type, filter_name, ids,
+                     chunk_size=MAX_FILTER_VALUES, scan_threshold=None):
+    # remove duplicated and empty ids
+    ids = sorted(set(i for i in ids if i))
+    log.info("Params: resource_type: %s, filter_name: %s, num ids: %s",
+             resource_type, filter_name, len(ids))
+
+    resources = dict()
+    if scan_threshold and len(ids) > scan_threshold:
+        log.debug("scanning all %s", resource_type)
+        wanted = set(ids)
+        for page in query_aws_pages(ec2,
+                                    aws_class,
+                                    resource_type=resource_type):
+            for resource in page:
+                if resource.resource_id in wanted:
+                    resources[resource.resource_id] = resource
+        return resources
+
+    for pos in range(0, len(ids), chunk_size):
+        filters = [{'Name': filter_name,
+                    'Values': ids[pos:pos + chunk_size]}]
+        for page in query_aws_pages(ec2,
+                                    aws_class,
+                                    resource_type=resource_type,
+                                    filters=filters):
+            for resource in page:
+                resources[resource.resource_id] = resource
+
+    log.debug("Found %s of %s ids", len(resources), len(ids))
+    return resources
+
+
 ###############################################################################
 # Query AWS EC2 resource
 #
 # Return list with resources id
+# If aws_class is informed, return a list with aws_class objects
+# built straight from the Describe* pages instead
 ###############################################################################
-def query_aws(ec2, *, resource_type, filter_name='', filter_value=''):
+def query_aws(ec2, *, resource_type, filter_name='', filter_value='',
+              aws_class=None, fields=None):
     log.info("Params: filter_name: %s, filter_value: %s",
              filter_name, filter_value)
+    import botocore.exceptions
+
+    if aws_class:
+        resources = list()
+        for page in query_aws_pages(ec2,
+                                    aws_class,
+                                    resource_type=resource_type,
+                                    filter_name=filter_name,
+                                    filter_value=filter_value,
+                                    fields=fields):
+            resources.extend(page)
+        log.debug("Returning %s %s", len(resources), resource_type)
+        return resources
 
     filters = [{'Name': filter_name,
                 'Values': ['*' + filter_value + '*']}]
@@ -407,7 +713,7 @@ def query_aws(ec2, *, resource_type, filter_name='', filter_value=''):
 
     if filter_name:
         log.debug("querying with filter")
-        log.debug("filters: %s", pprint.pformat(filters))
+        log.debug("filters: %s", LazyPformat(filters))
         try:
             for resource in getattr(ec2, resource_type).filter(Filters=filters):
                 resources.append(resource.id)
@@ -418,25 +724,326 @@ def query_aws(ec2, *, resource_type, filter_name='', filter_value=''):
         for resource in getattr(ec2, resource_type).all():
             resources.append(resource.id)
 
-    log.debug("Returning vpcs ids: %s", pprint.pformat(resources))
+    log.debug("Returning vpcs ids: %s", LazyPformat(resources))
     return resources
 
 
+###############################################################################
+# Return list with regions name to be queried
+#
+# [None] means only the default region from boto3 configuration
+###############################################################################
+def query_regions_names(args):
+    if not args.regions:
+        return [None]
+
+    if args.regions == 'all':
+        ec2 = initialize_boto3_session(args, 'ec2')
+        regions = ec2.meta.client.describe_regions()
+        return sorted(i['RegionName'] for i in regions['Regions'])
+
+    return [i.strip() for i in args.regions.split(',') if i.strip()]
+
+
+###############################################################################
+# Call func(region) for each region using a bounded thread pool
+#
+# Return dictionary: region -> func return
+###############################################################################
+def run_regions(args, func, regions):
+    log.info("regions: %s", regions)
+
+    if not regions:
+        return dict()
+    if len(regions) == 1:
+        return {regions[0]: func(regions[0])}
+
+    workers = min(args.workers, len(regions))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {region: pool.submit(func, region) for region in regions}
+        return {region: future.result() for region, future in futures.items()}
+
+
+###############################################################################
+# Call func(profile_args) for each profile using a bounded thread pool
+#
+# Profiles are the comma separated args.profiles, or args.profile if it is
+# not informed. profile_args is a copy of args with profile set
+# Params:
+#   - args         (args): command line arguments
+#   - func         (func): func(profile_args)
+#   - asynchronous (bool): Optional. True if func queries with the asyncio
+#                          engine (query_aws_regions and
+#                          query_aws_by_ids_regions). With --engine asyncio,
+#                          the queries of all profiles then run in the
+#                          same event loop
+# Return dictionary: profile -> func return
+###############################################################################
+def run_profiles(args, func, asynchronous=False):
+    profiles = [args.profile]
+    if getattr(args, 'profiles', None):
+        profiles = [i.strip() for i in args.profiles.split(',') if i.strip()]
+
+    def run_profile(profile):
+        profile_args = copy.copy(args)
+        profile_args.profile = profile
+        return func(profile_args)
+
+    with phase('fetch'):
+        if asynchronous and len(profiles) > 1 and use_asyncio(args):
+            import aio
+            with aio.shared_loop(args):
+                return run_regions(args, run_profile, profiles)
+        return run_regions(args, run_profile, profiles)
+
+
+###############################################################################
+# Warn, once per path, that --engine asyncio is not used by a query path,
+# which always uses threads
+###############################################################################
+def warn_threads_only(args, path):
+    if args.engine != 'asyncio' or path in _threads_only_warned:
+        return
+    _threads_only_warned.add(path)
+    log.warning("--engine asyncio does not apply to %s, using threads", path)
+
+
+###############################################################################
+# Return True if --engine asyncio is used and it is available
+###############################################################################
+def use_asyncio(args):
+    if args.engine != 'asyncio':
+        return False
+    # imported only when needed, asyncio takes a while to be imported
+    import aio
+    return aio.available()
+
+
+###############################################################################
+# Query AWS EC2 resource on all regions selected by --regions
+#
+# Return a merged list with aws_class objects from all regions
+###############################################################################
+def query_aws_regions(args, aws_class, *, resource_type,
+                      filter_name='', filter_value='', fields=None):
+    if use_asyncio(args):
+        import aio
+        with phase('fetch'):
+            return aio.query_aws_regions(args,
+                                         aws_class,
+                                         resource_type=resource_type,
+                                         filter_name=filter_name,
+                                         filter_value=filter_value,
+                                         fields=fields)
+
+    def query_region(region):
+        ec2 = initialize_boto3_session(args, 'ec2', region)
+        return query_aws(ec2,
+                         resource_type=resource_type,
+                         filter_name=filter_name,
+                         filter_value=filter_value,
+                         aws_class=aws_class,
+                         fields=fields)
+
+    resources = list()
+    with phase('fetch'):
+        for region_resources in run_regions(
+                args, query_region, query_regions_names(args)).values():
+            resources.extend(region_resources)
+
+    return resources
+
+
+###############################################################################
+# Query AWS EC2 resource pages on all regions selected by --regions
+#
+# Generator that yields pages as soon as any region returns them. Regions
+# are queried in parallel by at most args.workers threads, and only a few
+# pages are buffered, so memory does not grow with the number of resources.
+# The asyncio engine is not used
+###############################################################################
+def query_aws_regions_pages(args, aws_class, *, resource_type,
+                            filter_name='', filter_value='', fields=None):
+    warn_threads_only(args, 'streamed queries (--stream, csv, tsv, jsonl '
+                            'and numinstances)')
+    regions = query_regions_names(args)
+    pages = queue.Queue(maxsize=args.workers * 2)
+    workers = threading.BoundedSemaphore(args.workers)
+    # mark that a region has no more pages
+    done = object()
+
+    def query_region(region):
+        with workers:
+            try:
+                ec2 = initialize_boto3_session(args, 'ec2', region)
+                for page in query_aws_pages(ec2,
+                                            aws_class,
+                                            resource_type=resource_type,
+                                            filter_name=filter_name,
+                                            filter_value=filter_value,
+                                            fields=fields):
+                    pages.put(page)
+            # msg() exits with SystemExit, send it to the main thread too
+            except BaseException as error:
+                pages.put(error)
+            finally:
+                pages.put(done)
+
+    for region in regions:
+        # daemon threads do not block exit if the consumer stops early
+        threading.Thread(target=query_region, args=(region,),
+                         daemon=True).start()
+
+    remaining = len(regions)
+    while remaining:
+        page = pages.get()
+        if page is done:
+            remaining -= 1
+        elif isinstance(page, BaseException):
+            raise page
+        else:
+            yield page
+
+
+###############################################################################
+# Return True if the output should be streamed, ie, printed as soon as
+# pages arrive instead of collected and sorted in a table
+#
+# csv, tsv and jsonl are streamed unless -sortby is used. --stream always
+# streams, so -sortby is ignored
+###############################################################################
+def stream_output(args):
+    sortby = getattr(args, 'sortby', None)
+    if args.stream:
+        if sortby:
+            log.warning("-sortby %s is ignored with --stream", sortby)
+        return True
+    return args.format != 'table' and not sortby
+
+
+###############################################################################
+# Stream AWS EC2 resource on all regions selected by --regions
+#
+# Each row is printed as soon as its page arrives. Each column is the
+# resource method with the header name in lower case. If select is
+# informed, only resources where select(resource) is True are printed
+# Return the number of printed rows
+###############################################################################
+def stream_aws_regions(args, aws_class, header, *, resource_type,
+                       filter_name='', filter_value='', fields=None,
+                       select=None, alignl='', alignr=''):
+    output = StreamTable(header,
+                         fmt=args.format,
+                         widths=STREAM_WIDTHS,
+                         alignl=alignl,
+                         alignr=alignr)
+
+    # pages are fetched while rows are printed, both are timed as stream
+    with phase('stream'):
+        for page in query_aws_regions_pages(args,
+                                            aws_class,
+                                            resource_type=resource_type,
+                                            filter_name=filter_name,
+                                            filter_value=filter_value,
+                                            fields=fields):
+            output.add_rows([getattr(resource, attr.lower())()
+                             for attr in header]
+                            for resource in page
+                            if select is None or select(resource))
+        output.close()
+
+    return output.num_rows
+
+
+###############################################################################
+# Query AWS EC2 resources by id on the regions where they are referenced
+#
+# Params: resources (list): aws objects that reference the ids
+#         get_ids   (func): return a list of ids referenced by a resource
+#
+# Return a merged dictionary: resource id -> aws_class object
+###############################################################################
+def query_aws_by_ids_regions(args, aws_class, *, resource_type, filter_name,
+                             resources, get_ids, **kwargs):
+    if use_asyncio(args):
+        import aio
+        with phase('join'):
+            return aio.query_aws_by_ids_regions(args,
+                                                aws_class,
+                                                resource_type=resource_type,
+                                                filter_name=filter_name,
+                                                resources=resources,
+                                                get_ids=get_ids,
+                                                **kwargs)
+
+    ids_per_region = collections.defaultdict(list)
+    for resource in resources:
+        ids_per_region[resource.region()].extend(get_ids(resource))
+
+    def query_region(region):
+        ec2 = initialize_boto3_session(args, 'ec2', region)
+        return query_aws_by_ids(ec2,
+                                aws_class,
+                                resource_type=resource_type,
+                                filter_name=filter_name,
+                                ids=ids_per_region[region],
+                                **kwargs)
+
+    found = dict()
+    with phase('join'):
+        for region_found in run_regions(args,
+                                        query_region,
+                                        list(ids_per_region)).values():
+            found.update(region_found)
+
+    return found
+
+
+###############################################################################
+# Find overlapping cidrs
+# Params: blocks (list): (cidr, item) tuples
+#
+# Cidrs are either disjoint or one contains the other, so after sorting
+# them by first address (and larger first), a stack of the cidrs that
+# contain the current one finds all overlaps in O(n log n + overlaps)
+# Return list with (item, cidr, other_item, other_cidr, relation) tuples,
+# relation is "equal" or "contains" (cidr contains other_cidr)
+###############################################################################
+def cidr_overlaps(blocks):
+    networks = sorted(((ipaddress.ip_network(cidr, strict=False), cidr, item)
+                       for cidr, item in blocks),
+                      key=lambda block: (block[0].version,
+                                         block[0].network_address,
+                                         block[0].prefixlen))
+
+    overlaps = list()
+    stack = list()
+    for network, cidr, item in networks:
+        # remove cidrs that end before this one
+        while stack and (stack[-1][0].version != network.version
+                         or stack[-1][0].broadcast_address
+                         < network.network_address):
+            stack.pop()
+        for other_network, other_cidr, other_item in stack:
+            relation = 'equal' if other_network == network else 'contains'
+            overlaps.append((other_item, other_cidr, item, cidr, relation))
+        stack.append((network, cidr, item))
+
+    log.debug("%s overlaps in %s cidrs", len(overlaps), len(networks))
+    return overlaps
+
+
 ###############################################################################
 # Initialize boto3 session
 # Params: args     (args)
 #         resource (str): boto3 resource. Ex: ec2, s3
+#         region_name (str): Optional. Default is the configured region
 ###############################################################################
-def initialize_boto3_session(args, resource):
-    log.info("args: %s, resource: %s", args, resource)
-
-    # Configure boto3 resource
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-        boto_resource = session.resource(resource)
-    else:
-        boto_resource = boto3.resource(resource)
+def initialize_boto3_session(args, resource, region_name=None):
+    log.info("args: %s, resource: %s, region_name: %s",
+             args, resource, region_name)
 
-    return boto_resource
+    # sessions and clients are reused by all calls, see pool module
+    return get_resource(resource, args.profile, region_name)
 
 # vim: ts=4
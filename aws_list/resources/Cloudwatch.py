@@ -3,11 +3,18 @@ Module to handle Cloud Watch
 """
 import logging
 from datetime import datetime, timedelta
-import boto3
+from pool import get_client
 
 
 log = logging.getLogger(__name__)
 
+# Max number of metrics in a single GetMetricData request
+MAX_METRIC_DATA_QUERIES = 500
+
+# S3 metrics: name -> (MetricName, Unit, StorageType)
+S3_METRICS = {'size': ('BucketSizeBytes', 'Bytes', 'StandardStorage'),
+              'numobj': ('NumberOfObjects', 'Count', 'AllStorageTypes')}
+
 
 ##############################################################################
 # Cloud Watch Class
@@ -17,12 +24,9 @@ class Cloudwatch:
     Class to handle pre-defined queries on Cloud Watch
     """
 
-    def __init__(self, profile=''):
-        if profile:
-            session = boto3.Session(profile_name=profile)
-            self.cw = session.client('cloudwatch')
-        else:
-            self.cw = boto3.client('cloudwatch')
+    def __init__(self, profile='', region_name=None):
+        # S3 metrics are only available in the bucket's region
+        self.cw = get_client('cloudwatch', profile or None, region_name)
 
     def get_s3_bucket_size(self, bucket_name, numdays='7'):
         """
@@ -74,4 +78,76 @@ class Cloudwatch:
         )
         return resp['Datapoints']
 
+    def get_s3_buckets_metrics(self, bucket_names, metrics=('size', 'numobj'),
+                               numdays='7'):
+        """
+        Return S3 Buckets metrics using batched GetMetricData requests
+
+        Each request asks up to MAX_METRIC_DATA_QUERIES metrics, so size
+        and number of objects of many buckets are fetched together
+
+        Params:
+            bucket_names  (list): Bucket Names
+            metrics       (list): S3_METRICS names, 'size' and/or 'numobj'
+            numdays        (int): Number of days to show (now - numdays)
+
+        Return a dictionary: bucket name -> metric name -> datapoints
+        where datapoints is a list in the same format returned by
+        get_s3_bucket_size, ie, [{'Timestamp': ts, 'Average': value}]
+        """
+        log.debug("num buckets: %s, metrics: %s, numdays: %s",
+                  len(bucket_names), metrics, numdays)
+
+        # query id -> (bucket name, metric name)
+        queries_id = dict()
+        queries = list()
+        for bucket_name in bucket_names:
+            for metric in metrics:
+                metric_name, unit, storage_type = S3_METRICS[metric]
+                # id must start with a lowercase letter
+                query_id = 'm' + str(len(queries))
+                queries_id[query_id] = (bucket_name, metric)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/S3',
+                            'MetricName': metric_name,
+                            'Dimensions': [
+                                {'Name': 'BucketName', 'Value': bucket_name},
+                                {'Name': 'StorageType', 'Value': storage_type}
+                            ]
+                        },
+                        'Period': 86400,
+                        'Stat': 'Average',
+                        'Unit': unit
+                    },
+                    'ReturnData': True
+                })
+
+        results = {bucket_name: {metric: list() for metric in metrics}
+                   for bucket_name in bucket_names}
+
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=int(numdays))
+        for pos in range(0, len(queries), MAX_METRIC_DATA_QUERIES):
+            batch = queries[pos:pos + MAX_METRIC_DATA_QUERIES]
+            kwargs = {'MetricDataQueries': batch,
+                      'StartTime': start_time,
+                      'EndTime': end_time}
+            while True:
+                resp = self.cw.get_metric_data(**kwargs)
+                for metric_data in resp['MetricDataResults']:
+                    bucket_name, metric = queries_id[metric_data['Id']]
+                    results[bucket_name][metric].extend(
+                        {'Timestamp': timestamp, 'Average': value}
+                        for timestamp, value in zip(metric_data['Timestamps'],
+                                                    metric_data['Values']))
+                # follow pagination
+                if not resp.get('NextToken'):
+                    break
+                kwargs['NextToken'] = resp['NextToken']
+
+        return results
+
 # vim: ts=4
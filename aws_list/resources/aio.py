@@ -0,0 +1,300 @@
+"""
+Module to query AWS EC2 resources with asyncio, for high fan-out queries
+
+All region and chunk queries of a command run concurrently in a single
+event loop, using aiobotocore clients. Requests in flight are bounded
+per endpoint (profile, region and service) and in the whole loop. The
+profiles of -profiles are queried by several threads, they share one
+loop and its clients, see shared_loop.
+Functions return the same objects as their Aws module counterparts, so
+the results feed the same table builders.
+"""
+import types
+import asyncio
+import logging
+import threading
+import contextlib
+import collections
+import importlib.util
+from pcof import msg
+from cache import cache_client
+from ratelimit import client_config
+from ratelimit import limit_async_client
+from stats import stats_client
+from Aws import collection_types
+from Aws import query_regions_names
+from Aws import MAX_FILTER_VALUES
+
+
+log = logging.getLogger(__name__)
+
+# Max requests in flight in the whole event loop
+MAX_REQUESTS = 1000
+
+# (event loop, AsyncClients) shared by all threads, see shared_loop
+_shared = None
+
+# boto3 ec2 collection name -> (paginated operation, response key, id key)
+OPERATIONS = {'instances': ('describe_instances', 'Reservations',
+                            'InstanceId'),
+              'images': ('describe_images', 'Images', 'ImageId'),
+              'volumes': ('describe_volumes', 'Volumes', 'VolumeId'),
+              'vpcs': ('describe_vpcs', 'Vpcs', 'VpcId'),
+              'subnets': ('describe_subnets', 'Subnets', 'SubnetId'),
+              'security_groups': ('describe_security_groups',
+                                  'SecurityGroups', 'GroupId')}
+
+
+##############################################################################
+# Return True if the asyncio engine can be used, ie, aiobotocore is
+# installed. Otherwise the threads engine is used
+##############################################################################
+def available():
+    if importlib.util.find_spec('aiobotocore') is None:
+        log.warning("aiobotocore is not installed, using threads engine")
+        return False
+    return True
+
+
+##############################################################################
+# Async Clients Class
+##############################################################################
+class AsyncClients:
+    """
+    aiobotocore clients of an event loop, created on first use and closed
+    when the loop ends. Use it as an async context manager.
+
+    API cache, stats and rate limit handlers are registered on each
+    client, as the pool module does for boto3 clients. Clients of
+    different endpoints are created concurrently.
+
+    Params:
+        max_per_endpoint  (int): max requests in flight per profile,
+                                 region and service
+        max_requests      (int): Optional. Max requests in flight
+    """
+
+    def __init__(self, max_per_endpoint, max_requests=MAX_REQUESTS):
+        self.max_per_endpoint = max_per_endpoint
+        self.requests = asyncio.Semaphore(max_requests)
+        self.stack = contextlib.AsyncExitStack()
+        # (profile, region, service) -> lock held while the client is created
+        self.locks = collections.defaultdict(asyncio.Lock)
+        # profile -> aiobotocore session
+        self.sessions = dict()
+        # (profile, region, service) -> (client, semaphore)
+        self.clients = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stack.aclose()
+
+    async def get(self, service, profile=None, region_name=None):
+        """
+        Return tuple: client, semaphore of its endpoint
+        """
+        key = (profile, region_name, service)
+        if key in self.clients:
+            return self.clients[key]
+
+        async with self.locks[key]:
+            if key in self.clients:
+                return self.clients[key]
+
+            # imported only when the asyncio engine is used
+            from aiobotocore.session import AioSession
+
+            if profile not in self.sessions:
+                self.sessions[profile] = AioSession(profile=profile)
+            log.debug("new client: %s", key)
+            client = await self.stack.enter_async_context(
+                self.sessions[profile].create_client(
+                    service,
+                    region_name=region_name,
+                    config=client_config(
+                        max_pool_connections=self.max_per_endpoint)))
+            stats_client(client, asynchronous=True)
+            cache_client(client, profile)
+            limit_async_client(client, profile)
+            self.clients[key] = (client,
+                                 asyncio.Semaphore(self.max_per_endpoint))
+            return self.clients[key]
+
+
+##############################################################################
+# Query AWS EC2 resources of a region, following all pages
+#
+# Return list with aws_class objects built from the pages
+##############################################################################
+async def describe(clients, aws_class, *, profile, region, resource_type,
+                   filters=None, fields=None):
+    client, endpoint = await clients.get('ec2', profile, region)
+    operation, response_key, id_key = OPERATIONS[resource_type]
+    # aws objects only use the ec2 resource to get the region name
+    ec2 = types.SimpleNamespace(meta=types.SimpleNamespace(client=client))
+
+    kwargs = {'Filters': filters} if filters else dict()
+    resources = list()
+    # pages are requested one after the other, so the query holds a
+    # single slot while it runs
+    async with endpoint, clients.requests:
+        async for page in client.get_paginator(operation).paginate(**kwargs):
+            items = page.get(response_key, [])
+            if resource_type == 'instances':
+                items = [instance
+                         for reservation in items
+                         for instance in reservation['Instances']]
+            resources.extend(aws_class(ec2,
+                                       collection_types[resource_type],
+                                       item[id_key],
+                                       metadata=item,
+                                       fields=fields)
+                             for item in items)
+
+    log.debug("region: %s, %s %s", region, len(resources), resource_type)
+    return resources
+
+
+##############################################################################
+# Run the queries of all threads in one event loop, while it is used
+# Params: args (args): command line arguments, --workers is used
+#
+# The loop runs in its own thread. run() sends the queries of the other
+# threads to it, so they share the loop and the clients. The clients are
+# closed at the end
+##############################################################################
+@contextlib.contextmanager
+def shared_loop(args):
+    global _shared
+
+    async def open_clients():
+        # asyncio objects are created inside the loop that uses them
+        return AsyncClients(args.workers)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    clients = asyncio.run_coroutine_threadsafe(open_clients(), loop).result()
+    _shared = (loop, clients)
+    try:
+        yield
+    finally:
+        _shared = None
+        asyncio.run_coroutine_threadsafe(clients.__aexit__(None, None, None),
+                                         loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+##############################################################################
+# Run query(clients), a coroutine function, in the shared event loop, or
+# in a new one with its own clients
+# Params:
+#   - args   (args): command line arguments, --workers is used
+#   - query  (func): async function, called with AsyncClients
+#
+# API errors stop the script, as query_aws_pages does
+##############################################################################
+def run(args, query):
+    import botocore.exceptions
+
+    async def run_query():
+        async with AsyncClients(args.workers) as clients:
+            return await query(clients)
+
+    try:
+        if _shared:
+            loop, clients = _shared
+            return asyncio.run_coroutine_threadsafe(query(clients),
+                                                    loop).result()
+        return asyncio.run(run_query())
+    except botocore.exceptions.ClientError as error:
+        msg("red", str(error), 1)
+
+
+##############################################################################
+# Query AWS EC2 resource on all regions selected by --regions
+#
+# Same as Aws.query_aws_regions
+# Return a merged list with aws_class objects from all regions
+##############################################################################
+def query_aws_regions(args, aws_class, *, resource_type,
+                      filter_name='', filter_value='', fields=None):
+    log.info("Params: resource_type: %s, filter_name: %s, filter_value: %s",
+             resource_type, filter_name, filter_value)
+
+    filters = None
+    if filter_name:
+        filters = [{'Name': filter_name,
+                    'Values': ['*' + filter_value + '*']}]
+    regions = query_regions_names(args)
+
+    async def query(clients):
+        return await asyncio.gather(*(
+            describe(clients,
+                     aws_class,
+                     profile=args.profile,
+                     region=region,
+                     resource_type=resource_type,
+                     filters=filters,
+                     fields=fields)
+            for region in regions))
+
+    return [resource
+            for region_resources in run(args, query)
+            for resource in region_resources]
+
+
+##############################################################################
+# Query AWS EC2 resources by id on the regions where they are referenced
+#
+# Same as Aws.query_aws_by_ids_regions, but all chunks of all regions are
+# queried concurrently
+# Return a merged dictionary: resource id -> aws_class object
+##############################################################################
+def query_aws_by_ids_regions(args, aws_class, *, resource_type, filter_name,
+                             resources, get_ids, chunk_size=MAX_FILTER_VALUES,
+                             scan_threshold=None):
+    ids_per_region = collections.defaultdict(set)
+    for resource in resources:
+        ids_per_region[resource.region()].update(
+            i for i in get_ids(resource) if i)
+
+    async def query_region(clients, region):
+        ids = sorted(ids_per_region[region])
+        if scan_threshold and len(ids) > scan_threshold:
+            log.debug("scanning all %s", resource_type)
+            return await describe(clients,
+                                  aws_class,
+                                  profile=args.profile,
+                                  region=region,
+                                  resource_type=resource_type)
+        chunks = await asyncio.gather(*(
+            describe(clients,
+                     aws_class,
+                     profile=args.profile,
+                     region=region,
+                     resource_type=resource_type,
+                     filters=[{'Name': filter_name,
+                               'Values': ids[pos:pos + chunk_size]}])
+            for pos in range(0, len(ids), chunk_size)))
+        return [found for chunk in chunks for found in chunk]
+
+    async def query(clients):
+        return await asyncio.gather(*(query_region(clients, region)
+                                      for region in ids_per_region))
+
+    found = dict()
+    for region, region_found in zip(ids_per_region, run(args, query)):
+        # a scan also returns resources that were not asked
+        for resource in region_found:
+            if resource.resource_id in ids_per_region[region]:
+                found[resource.resource_id] = resource
+
+    log.debug("Found %s ids", len(found))
+    return found
+
+# vim: ts=4
@@ -0,0 +1,264 @@
+"""
+Module to serve aws_list commands from a resident process
+
+It is not named daemon, so it is never shadowed by the python-daemon
+package, as the resources directory is the last one in sys.path
+
+The daemon keeps the boto3 clients and the output of each requested
+command in memory, and refreshes these outputs in background. Commands
+are sent over a Unix socket as one json line: {"argv": [...]} and the
+answer is one json line: {"output": "...", "errors": "...", "exitcode": 0},
+with the stdout and stderr of the command
+
+Requests may have an "env" digest of the AWS environment of the client.
+Commands of a client with another environment (ex: other AWS_PROFILE or
+credentials) are not served, the daemon answers {"error": "env"}.
+"""
+import os
+import json
+import hashlib
+import time
+import socket
+import logging
+import threading
+import socketserver
+from pcof import msg
+from cache import cache_dir
+
+
+log = logging.getLogger(__name__)
+
+# Default time, in seconds, between refreshes of each command output
+DAEMON_REFRESH = 60
+
+# Commands not requested for this number of refreshes are dropped
+DAEMON_EXPIRE_REFRESHES = 10
+
+# Max size in bytes of a request
+MAX_REQUEST_SIZE = 64 * 1024
+
+# Environment variable with the daemon socket path, used by serve and by
+# the clients
+SOCKET_ENV = 'AWS_LIST_SOCKET'
+
+# Max time, in seconds, to connect to the daemon
+CONNECT_TIMEOUT = 1
+
+# Environment variables used by boto3 to select the account and region
+AWS_ENVIRONMENT = ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE',
+                   'AWS_DEFAULT_REGION', 'AWS_REGION',
+                   'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+                   'AWS_SESSION_TOKEN', 'AWS_SECURITY_TOKEN',
+                   'AWS_CONFIG_FILE', 'AWS_SHARED_CREDENTIALS_FILE',
+                   'AWS_ROLE_ARN', 'AWS_WEB_IDENTITY_TOKEN_FILE')
+
+
+##############################################################################
+# Return the daemon socket path: $AWS_LIST_SOCKET or the default one
+##############################################################################
+def socket_path():
+    return (os.environ.get(SOCKET_ENV)
+            or os.path.join(cache_dir(), 'aws_list.sock'))
+
+
+##############################################################################
+# Return digest of the AWS environment of this process
+#
+# A digest is sent, so credentials are never written to the socket
+##############################################################################
+def aws_environment():
+    values = json.dumps([os.environ.get(name) for name in AWS_ENVIRONMENT])
+    return hashlib.sha256(values.encode()).hexdigest()
+
+
+##############################################################################
+# Inventory Class
+##############################################################################
+class Inventory:
+    """
+    Output of the commands served by the daemon
+
+    Commands write to sys.stdout, so they run one at a time, but served
+    outputs are only read from memory.
+
+    Params:
+        run_command   (func): run_command(argv), return (output, errors,
+                              exitcode)
+        refresh        (int): Optional. Seconds between refreshes of each
+                              command output
+    """
+
+    def __init__(self, run_command, refresh=DAEMON_REFRESH):
+        self.run_command = run_command
+        self.refresh = refresh
+        # argv -> (output, errors, exitcode, update time)
+        self.outputs = dict()
+        # argv -> last request time
+        self.requested = dict()
+        self.lock = threading.Lock()
+        self.run_lock = threading.Lock()
+
+    def get(self, argv):
+        """
+        Return (output, errors, exitcode) of a command, running it only
+        if it was never requested or if --refresh is used
+        """
+        key = tuple(argv)
+        with self.lock:
+            self.requested[key] = time.time()
+            entry = self.outputs.get(key)
+        if '--refresh' in argv:
+            entry = self.update(key)
+        elif entry is None:
+            entry = self.update(key, self.refresh)
+        return entry[:3]
+
+    def update(self, key, max_age=0):
+        """
+        Run a command and store its output. If another thread updated
+        it less than max_age seconds ago, that output is returned
+        """
+        with self.run_lock:
+            entry = self.outputs.get(key)
+            if entry and time.time() - entry[3] < max_age:
+                return entry
+            start = time.time()
+            output, errors, exitcode = self.run_command(list(key))
+            log.debug("ran %s in %.3fs", key, time.time() - start)
+            entry = (output, errors, exitcode, time.time())
+            with self.lock:
+                self.outputs[key] = entry
+        return entry
+
+    def refresh_loop(self):
+        """
+        Refresh outputs older than refresh seconds, forever
+        """
+        while True:
+            now = time.time()
+            with self.lock:
+                expired = [key for key, last in self.requested.items()
+                           if now - last > self.refresh
+                           * DAEMON_EXPIRE_REFRESHES]
+                for key in expired:
+                    log.debug("dropping %s", key)
+                    del self.requested[key]
+                    self.outputs.pop(key, None)
+                old = [key for key, entry in self.outputs.items()
+                       if now - entry[3] >= self.refresh]
+
+            for key in old:
+                self.update(key, self.refresh)
+
+            time.sleep(1)
+
+
+##############################################################################
+# Request Handler Class
+##############################################################################
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answer one command per connection
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST_SIZE))
+            argv = [str(i) for i in request['argv']]
+            env = request.get('env', self.server.env)
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            answer = {'output': '',
+                      'errors': "Invalid request: %s\n" % error,
+                      'exitcode': 1}
+        else:
+            if env != self.server.env:
+                log.debug("other AWS environment: %s", argv)
+                answer = {'error': 'env'}
+            else:
+                output, errors, exitcode = self.server.inventory.get(argv)
+                answer = {'output': output,
+                          'errors': errors,
+                          'exitcode': exitcode}
+        self.wfile.write(json.dumps(answer).encode() + b'\n')
+
+
+##############################################################################
+# Serve commands on a Unix socket until it is interrupted
+# Params:
+#   - args          (args): command line arguments
+#   - run_command   (func): run_command(argv), return (output, errors,
+#                             exitcode)
+##############################################################################
+def serve(args, run_command):
+    path = args.socket or socket_path()
+    if forward_command(path, None) is not None:
+        msg("red", "Error: a daemon is already running on " + path, 1)
+    try:
+        # remove the socket left by a daemon that did not stop cleanly
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    inventory = Inventory(run_command, args.daemon_refresh)
+    threading.Thread(target=inventory.refresh_loop, daemon=True).start()
+
+    # outputs have information about the accounts, only the owner reads
+    # it. The socket is created with these permissions, so no other user
+    # connects before they are set
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, RequestHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    server.inventory = inventory
+    server.env = aws_environment()
+
+    msg("green", "Serving on " + path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+##############################################################################
+# Send a command to the daemon
+# Params:
+#   - path  (str): daemon socket path
+#   - argv (list): command line arguments, without the script name. If
+#                  None, only check if the daemon is running
+#
+# Return (output, errors, exitcode), or None if the daemon is not running
+# or it has another AWS environment
+##############################################################################
+def forward_command(path, argv):
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(path)
+        if argv is None:
+            return '', '', 0
+        # the first run of a command may take a while
+        sock.settimeout(None)
+        sock.sendall(json.dumps({'argv': argv,
+                                 'env': aws_environment()}).encode() + b'\n')
+        with sock.makefile('rb') as answer_file:
+            answer = json.loads(answer_file.readline())
+        if answer.get('error') == 'env':
+            log.debug("daemon has another AWS environment")
+            return None
+        return answer['output'], answer['errors'], answer['exitcode']
+    except (OSError, ValueError, KeyError) as error:
+        log.debug("daemon not available: %s", error)
+        return None
+    finally:
+        sock.close()
+
+# vim: ts=4
@@ -0,0 +1,346 @@
+"""
+Module to cache AWS information on disk
+"""
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import logging
+import datetime
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Default time to live, in seconds, of cached API responses per operation
+CACHE_TTLS = {'DescribeInstances': 60,
+              'DescribeVolumes': 300,
+              'DescribeSecurityGroups': 300,
+              'DescribeSubnets': 600,
+              'DescribeVpcs': 3600,
+              'DescribeImages': 3600,
+              'DescribeRegions': 86400,
+              'DescribeAvailabilityZones': 86400,
+              'ListBuckets': 300,
+              'GetBucketLocation': 86400,
+              'GetMetricData': 3600,
+              'GetMetricStatistics': 3600}
+CACHE_DEFAULT_TTL = 300
+
+# Only responses of read only operations are cached
+CACHEABLE_OPERATIONS = ('Describe', 'List', 'Get')
+
+# Max size in bytes of the API cache file entries. When it is exceeded,
+# the least recently used entries are removed
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# API cache used by all boto3 clients, see configure_api_cache
+_api_cache = None
+
+
+##############################################################################
+# Return the directory where cache files are stored
+#
+# Uses $XDG_CACHE_HOME/aws_list, or ~/.cache/aws_list if it is not set
+##############################################################################
+def cache_dir():
+    base_dir = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base_dir, 'aws_list')
+
+
+##############################################################################
+# Return True if the caches are enabled, ie, --cache or --cache-ttl is used
+#
+# --cache-ttl 0 enables them too: every cached entry is expired, so new
+# responses are stored but never read, as with --refresh
+##############################################################################
+def cache_enabled(args):
+    return bool(args.cache) or args.cache_ttl is not None
+
+
+##############################################################################
+# Return the max age, in seconds, of the data read from a cache
+# Params:
+#   - args      (args): command line arguments: --cache, --cache-ttl and
+#                       --refresh are used
+#   - default    (int): max age of the cache, if --cache-ttl is not used
+#
+# Return None if the caches are disabled, 0 with --refresh
+##############################################################################
+def cache_ttl(args, default):
+    if not cache_enabled(args):
+        return None
+    if args.refresh:
+        return 0
+    return default if args.cache_ttl is None else args.cache_ttl
+
+
+##############################################################################
+# Load data from a json cache file
+# Params:
+#   - name   (str): cache name
+#   - ttl    (int): max age of the cache in seconds
+#
+# Return None if the cache does not exist, is invalid or expired
+##############################################################################
+def load_cache(name, ttl):
+    log.debug("name: %s, ttl: %s", name, ttl)
+
+    if not ttl:
+        return None
+
+    cache_file = os.path.join(cache_dir(), name + '.json')
+    try:
+        with open(cache_file) as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        log.debug("cache %s not found or invalid", cache_file)
+        return None
+
+    if time.time() - cache.get('timestamp', 0) > ttl:
+        log.debug("cache %s expired", cache_file)
+        return None
+
+    return cache.get('data')
+
+
+##############################################################################
+# Save data in a json cache file
+# Params:
+#   - name   (str): cache name
+#   - data   (obj): json serializable data
+##############################################################################
+def save_cache(name, data):
+    log.debug("name: %s", name)
+
+    cache_file = os.path.join(cache_dir(), name + '.json')
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        # write to a temporary file first, so a concurrent run never
+        # reads a partial cache file
+        tmp_file = cache_file + '.' + str(os.getpid())
+        with open(tmp_file, 'w') as fd:
+            json.dump({'timestamp': time.time(), 'data': data}, fd)
+        os.replace(tmp_file, cache_file)
+    except OSError as error:
+        # cache is only an optimization, never abort because of it
+        log.warning("Could not write cache %s: %s", cache_file, error)
+
+
+##############################################################################
+# API Cache Class
+##############################################################################
+class ApiCache:
+    """
+    Persistent cache of AWS API responses stored in a SQLite file
+
+    Responses are keyed by profile, region, operation and the normalized
+    request parameters. It is safe to be used by many threads.
+
+    Params:
+        path      (str): Optional. SQLite file, default is
+                         cache_dir()/api_cache.sqlite3
+        ttl       (int): Optional. Time to live in seconds for all
+                         operations, instead of the CACHE_TTLS defaults
+        refresh  (bool): Optional. Ignore cached responses, but still
+                         store the new ones
+        max_size  (int): Optional. Max size in bytes of all responses
+    """
+
+    def __init__(self, path=None, *, ttl=None, refresh=False,
+                 max_size=CACHE_MAX_SIZE):
+        self.path = path or os.path.join(cache_dir(), 'api_cache.sqlite3')
+        self.ttl = ttl
+        self.refresh = refresh
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        log.debug("path: %s, ttl: %s, refresh: %s", self.path, ttl, refresh)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'key TEXT PRIMARY KEY, operation TEXT, '
+                        'created REAL, accessed REAL, size INTEGER, '
+                        'value BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                        'ON responses (accessed)')
+
+    def operation_ttl(self, operation):
+        """
+        Return time to live in seconds of an operation responses
+        """
+        if self.ttl is not None:
+            return self.ttl
+        return CACHE_TTLS.get(operation, CACHE_DEFAULT_TTL)
+
+    @staticmethod
+    def make_key(profile, region, operation, params):
+        """
+        Return cache key of a request
+
+        Params:
+            profile     (str): profile name
+            region      (str): region name
+            operation   (str): service and operation name
+            params     (dict): request parameters
+        """
+        def normalize(value):
+            # datetimes (ex: cloud watch EndTime) are truncated to the
+            # hour, otherwise the same query would never hit the cache
+            if isinstance(value, datetime.datetime):
+                return value.strftime('%Y-%m-%dT%H')
+            return str(value)
+
+        key = json.dumps([profile, region, operation, params],
+                         sort_keys=True, default=normalize)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key, operation):
+        """
+        Return a cached response or None if not found or expired
+        """
+        if self.refresh:
+            return None
+
+        now = time.time()
+        try:
+            with self.lock:
+                entry = self.db.execute(
+                    'SELECT created, value FROM responses WHERE key = ?',
+                    (key,)).fetchone()
+                if not entry:
+                    return None
+                if now - entry[0] > self.operation_ttl(operation):
+                    return None
+                self.db.execute(
+                    'UPDATE responses SET accessed = ? WHERE key = ?',
+                    (now, key))
+            return pickle.loads(entry[1])
+        # besides sqlite errors, unpickling raises EOFError, TypeError,
+        # AttributeError, etc. Any of them is a cache miss
+        except Exception as error:
+            log.warning("Could not read api cache: %s", error)
+            return None
+
+    def set(self, key, operation, response):
+        """
+        Store a response, removing least recently used ones if the cache
+        is bigger than max_size
+        """
+        now = time.time()
+        try:
+            value = pickle.dumps(response)
+            with self.lock:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?)',
+                    (key, operation, now, now, len(value), value))
+                self._evict()
+        # responses that can not be pickled are not cached
+        except Exception as error:
+            log.warning("Could not write api cache: %s", error)
+
+    def _evict(self):
+        total_size = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        while total_size > self.max_size:
+            key, size = self.db.execute(
+                'SELECT key, size FROM responses '
+                'ORDER BY accessed LIMIT 1').fetchone()
+            log.debug("evicting key: %s", key)
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total_size -= size
+
+
+##############################################################################
+# Return the http response of a request answered without network
+#
+# It is a botocore AWSResponse without raw body, as the ones of botocore
+# Stubber, so handlers that parse the body themselves (ex: s3
+# GetBucketLocation) keep the parsed response returned with it
+##############################################################################
+def cached_http_response():
+    # botocore is imported by boto3, only when a client is created
+    from botocore.awsrequest import AWSResponse
+
+    response = AWSResponse(None, 200, {}, None)
+    # there is no body to read from raw
+    response._content = b''
+    return response
+
+
+##############################################################################
+# Configure the API cache from command line arguments
+#
+# The cache is enabled with --cache or --cache-ttl, see cache_enabled. The
+# current cache is kept if its settings did not change, as the daemon
+# configures it for each command
+##############################################################################
+def configure_api_cache(args):
+    global _api_cache
+
+    if cache_enabled(args):
+        if (_api_cache and _api_cache.ttl == args.cache_ttl
+                and _api_cache.refresh == args.refresh):
+            return _api_cache
+        try:
+            _api_cache = ApiCache(ttl=args.cache_ttl, refresh=args.refresh)
+        except (OSError, sqlite3.Error) as error:
+            log.warning("API cache disabled: %s", error)
+            _api_cache = None
+    else:
+        _api_cache = None
+
+    return _api_cache
+
+
+##############################################################################
+# Serve API calls of a boto3 client from the API cache
+# Params:
+#   - client    (obj): boto3 client
+#   - profile   (str): profile used to create the client
+#
+# It does nothing if the cache is not enabled
+##############################################################################
+def cache_client(client, profile=None):
+    api_cache = _api_cache
+    if not api_cache:
+        return client
+
+    region = client.meta.region_name
+
+    def build_key(params, model, context, **kwargs):
+        if model.name.startswith(CACHEABLE_OPERATIONS):
+            operation = model.service_model.service_name + '.' + model.name
+            context['api_cache_key'] = api_cache.make_key(
+                profile, region, operation, params)
+
+    def lookup(model, context, **kwargs):
+        key = context.get('api_cache_key')
+        if not key:
+            return None
+        response = api_cache.get(key, model.name)
+        if response is None:
+            log.debug("cache miss: %s", model.name)
+            return None
+        log.debug("cache hit: %s", model.name)
+        context['api_cache_hit'] = True
+        return cached_http_response(), response
+
+    def store(http_response, parsed, model, context, **kwargs):
+        key = context.get('api_cache_key')
+        if (key and not context.get('api_cache_hit')
+                and http_response.status_code < 300):
+            api_cache.set(key, model.name, parsed)
+
+    client.meta.events.register('before-parameter-build', build_key)
+    client.meta.events.register('before-call', lookup)
+    client.meta.events.register('after-call', store)
+
+    return client
+
+# vim: ts=4
@@ -2,30 +2,79 @@
 Module class to handle AWS EC2 instances
 """
 import logging
-import pprint
+import collections
 from pcof import msg
+from pcof import LazyPformat
 from pcof import print_table
-from Aws import Aws_ec2
 from Aws import Aws_ec2_instance
 from Aws import Aws_ec2_ami
 from Aws import Aws_ec2_volume
-from Aws import query_aws
-from Aws import initialize_boto3_session
+from Aws import Aws_ec2_vpc
+from Aws import Aws_ec2_subnet
+from Aws import Aws_tag_index
+from Aws import query_aws_regions
+from Aws import query_aws_regions_pages
+from Aws import query_aws_by_ids_regions
+from Aws import stream_aws_regions
+from Aws import stream_output
+from Aws import run_profiles
+from stats import phase
 
 
 log = logging.getLogger(__name__)
 
+# If instances have more volumes than it, scan all volumes
+# instead of querying them by id
+VOLUME_SCAN_THRESHOLD = 1000
+
+# Columns of the default instances table
+TABLE_HEADER = ['InstanceId', 'Tag_Name', 'VpcId', 'AvailabilityZone',
+                'InstanceType', 'InstanceState', 'KeyName', 'PrivateIpAddress',
+                'LaunchTime']
+TABLE_ALIGN_LEFT = ['PrivateIpAddress', 'Tag_Name']
+
+# Instance metadata keys used by each output, the others are not kept in
+# memory. None keeps all keys
+OUTPUT_FIELDS = {
+    "table": ['Tags', 'VpcId', 'Placement', 'InstanceType', 'State',
+              'KeyName', 'PrivateIpAddress', 'LaunchTime'],
+    "detail": None,
+    "tags": ['Tags'],
+    "ami": ['Tags', 'ImageId'],
+    "volume": ['Tags', 'BlockDeviceMappings'],
+    "secgroup": ['Tags', 'SecurityGroups'],
+    "names": ['Tags', 'VpcId', 'SubnetId', 'Placement']}
+
+# Types that numinstances can group by, besides Tag:<key>
+PERTYPES = ['InstanceType', 'ImageId', 'VpcId', 'AvailabilityZone',
+            'SubnetId', 'InstanceState', 'KeyName', 'Region', 'Profile']
+
+# Instance metadata keys used by each numinstances type, when they are not
+# the type itself
+PERTYPE_FIELDS = {'AvailabilityZone': ['Placement'],
+                  'InstanceState': ['State'],
+                  'Region': [],
+                  'Profile': []}
+
 
 ##########################################################################
 # Show instances' ami details
 ##########################################################################
 def show_instances_ami(*args, **kwargs):
-    log.info("args: %s", pprint.pformat(args))
-    log.info("args: %s", pprint.pformat(kwargs))
+    log.info("args: %s", LazyPformat(args))
+    log.info("args: %s", LazyPformat(kwargs))
 
     header = ['InstanceId', 'Tag_Name', 'ImageId', 'Description',
               'OwnerId', 'ImageOwnerAlias']
 
+    # resolve each distinct ami only once, using chunked queries
+    amis = query_aws_by_ids_regions(kwargs['args'],
+                                    Aws_ec2_ami,
+                                    resource_type='images',
+                                    filter_name='image-id',
+                                    resources=kwargs["instances"],
+                                    get_ids=lambda i: [i.imageid()])
+
     rows = list()
     for instance in kwargs["instances"]:
         row = list()
@@ -33,27 +82,43 @@ def show_instances_ami(*args, **kwargs):
         for metadata_key in header[:3]:
             row.append((getattr(instance, metadata_key.lower())()))
 
-        ami = Aws_ec2_ami(kwargs['ec2'], 'Image', instance.imageid())
+        # ami may not exist anymore (deregistered), show empty cells
+        ami = amis.get(instance.imageid())
         # handle the ami methods
         for ami_attr in header[3:]:
-            row.append((getattr(ami, ami_attr.lower())()))
+            row.append((getattr(ami, ami_attr.lower())() if ami else ""))
+        if kwargs['args'].regions:
+            row.append(instance.region())
         rows.append(row)
 
+    if kwargs['args'].regions:
+        header.append('Region')
+
     align_left = ['Description', 'Tag_Name']
     sortby = kwargs['sortby'] if kwargs['sortby'] else "InstanceId"
-    print_table(header, rows, sortby=sortby, alignl=align_left)
+    print_table(header, rows, sortby=sortby, alignl=align_left,
+                fmt=kwargs['args'].format, timer=phase)
 
 
 ###############################################################################
 # Show instances' volumes details
 ###############################################################################
 def show_instances_volume(*args, **kwargs):
-    log.info("args: %s", pprint.pformat(args))
-    log.info("args: %s", pprint.pformat(kwargs))
+    log.info("args: %s", LazyPformat(args))
+    log.info("args: %s", LazyPformat(kwargs))
 
     header = ['InstanceId', 'Tag_Name', 'VolumeId', 'Size',
               'VolumeType', 'Device', 'State', 'DeleteOnTermination']
 
+    # resolve all instances' volumes at once and join them by volume id
+    volumes = query_aws_by_ids_regions(kwargs['args'],
+                                       Aws_ec2_volume,
+                                       resource_type='volumes',
+                                       filter_name='volume-id',
+                                       resources=kwargs["instances"],
+                                       get_ids=lambda i: i.getvolumesids(),
+                                       scan_threshold=VOLUME_SCAN_THRESHOLD)
+
     rows = list()
     for instance in kwargs["instances"]:
         # get all instance's volumes
@@ -65,11 +130,21 @@ def show_instances_volume(*args, **kwargs):
             for metadata_key in header[:2]:
                 row.append((getattr(instance, metadata_key.lower())()))
             # handle volumes methods
-            vol = Aws_ec2_volume(kwargs["ec2"], 'Volume', vol_id)
-            for vol_attr in header[2:]:
-                row.append((getattr(vol, vol_attr.lower())()))
+            vol = volumes.get(vol_id)
+            if not vol:
+                # volume deleted after the instance was described
+                row.append(vol_id)
+                row.extend([""] * len(header[3:]))
+            else:
+                for vol_attr in header[2:]:
+                    row.append((getattr(vol, vol_attr.lower())()))
+            if kwargs['args'].regions:
+                row.append(instance.region())
             rows.append(row)
 
+    if kwargs['args'].regions:
+        header.append('Region')
+
     align_right = ['Size']
     align_left = ['Tag_Name']
     sortby = kwargs['sortby'] if kwargs['sortby'] else "InstanceId"
@@ -78,17 +153,21 @@ def show_instances_volume(*args, **kwargs):
         rows,
         sortby=sortby,
         alignl=align_left,
-        alignr=align_right)
+        alignr=align_right,
+        fmt=kwargs['args'].format,
+        timer=phase)
 
 
 ##########################################################################
 # Show instances' security group
 ##########################################################################
 def show_instances_secgroup(*args, **kwargs):
-    log.info("args: %s", pprint.pformat(args))
-    log.info("args: %s", pprint.pformat(kwargs))
+    log.info("args: %s", LazyPformat(args))
+    log.info("args: %s", LazyPformat(kwargs))
 
     header = ['InstanceId', 'Tag_Name', 'SecurityGroups']
+    if kwargs['args'].regions:
+        header.append('Region')
     rows = list()
     for instance in kwargs["instances"]:
         row = list()
@@ -111,25 +190,27 @@ def show_instances_secgroup(*args, **kwargs):
 
     align_left = ['Tag_Name', 'SecurityGroups']
     sortby = kwargs['sortby'] if kwargs['sortby'] else "InstanceId"
-    print_table(header, rows, sortby=sortby, alignl=align_left, hrules="ALL")
+    print_table(header, rows, sortby=sortby, alignl=align_left, hrules="ALL",
+                fmt=kwargs['args'].format, timer=phase)
 
 
 ###############################################################################
 # Show instances resource names
 ###############################################################################
 def show_instances_names(*args, **kwargs):
-    # get vpc id for all instances
-    vpcs_id = set([i.vpcid() for i in kwargs['instances'] if i.vpcid()])
-    log.debug("vpcs_id: %s", pprint.pformat(vpcs_id))
-    # get subnet id for all instances
-    subnets_id = set([i.subnetid()
-                      for i in kwargs['instances'] if i.subnetid()])
-    log.debug("subnets_id: %s", pprint.pformat(subnets_id))
-
-    # instantiate all ec2 vpcs returned in the query
-    vpcs = [Aws_ec2(kwargs['ec2'], 'Vpc', i_id) for i_id in vpcs_id]
-    # instantiate all ec2 subnets returned in the query
-    subnets = [Aws_ec2(kwargs['ec2'], 'Subnet', i_id) for i_id in subnets_id]
+    # index all vpcs and subnets by id, resolved with chunked queries
+    vpcs = query_aws_by_ids_regions(kwargs['args'],
+                                    Aws_ec2_vpc,
+                                    resource_type='vpcs',
+                                    filter_name='vpc-id',
+                                    resources=kwargs['instances'],
+                                    get_ids=lambda i: [i.vpcid()])
+    subnets = query_aws_by_ids_regions(kwargs['args'],
+                                       Aws_ec2_subnet,
+                                       resource_type='subnets',
+                                       filter_name='subnet-id',
+                                       resources=kwargs['instances'],
+                                       get_ids=lambda i: [i.subnetid()])
 
     header = ['InstanceId', 'InstanceName', 'VpcName', 'SubnetName',
               'AvailabilityZone']
@@ -139,26 +220,30 @@ def show_instances_names(*args, **kwargs):
         row = list()
         row.append(instance.instanceid())
         row.append(instance.tag_name())
-        vpc_name = [i.tag_name() for i in vpcs
-                    if i.resource_id == instance.vpcid()]
-        row.append(vpc_name[0] if vpc_name else "")
-        subnet_name = [i.tag_name() for i in subnets
-                       if i.resource_id == instance.subnetid()]
-        row.append(subnet_name[0] if subnet_name else "")
+        vpc = vpcs.get(instance.vpcid())
+        row.append(vpc.tag_name() if vpc else "")
+        subnet = subnets.get(instance.subnetid())
+        row.append(subnet.tag_name() if subnet else "")
         row.append(instance.availabilityzone())
+        if kwargs['args'].regions:
+            row.append(instance.region())
         rows.append(row)
 
+    if kwargs['args'].regions:
+        header.append('Region')
+
     align_left = ['InstanceName']
     sortby = kwargs['sortby'] if kwargs['sortby'] else "InstanceId"
-    print_table(header, rows, sortby=sortby, alignl=align_left)
+    print_table(header, rows, sortby=sortby, alignl=align_left,
+                fmt=kwargs['args'].format, timer=phase)
 
 
 ###############################################################################
 # Show all instances metadata
 ###############################################################################
 def show_instances_details(*args, **kwargs):
-    log.info("args: %s", pprint.pformat(args))
-    log.info("args: %s", pprint.pformat(kwargs))
+    log.info("args: %s", LazyPformat(args))
+    log.info("args: %s", LazyPformat(kwargs))
 
     for instance in kwargs["instances"]:
         instance.show_metadata()
@@ -168,12 +253,12 @@ def show_instances_details(*args, **kwargs):
 # Show instances information as table
 ###############################################################################
 def show_instances_table(*args, **kwargs):
-    log.info("args: %s", pprint.pformat(args))
-    log.info("args: %s", pprint.pformat(kwargs))
+    log.info("args: %s", LazyPformat(args))
+    log.info("args: %s", LazyPformat(kwargs))
 
-    header = ['InstanceId', 'Tag_Name', 'VpcId', 'AvailabilityZone',
-              'InstanceType', 'InstanceState', 'KeyName', 'PrivateIpAddress',
-              'LaunchTime']
+    header = list(TABLE_HEADER)
+    if kwargs['args'].regions:
+        header.append('Region')
     rows = list()
     for instance in kwargs["instances"]:
         row = list()
@@ -182,85 +267,156 @@ def show_instances_table(*args, **kwargs):
 
         rows.append(row)
 
-    align_left = ['PrivateIpAddress', 'Tag_Name']
     sortby = kwargs['sortby'] if kwargs['sortby'] else "InstanceId"
-    print_table(header, rows, sortby=sortby, alignl=align_left)
+    print_table(header, rows, sortby=sortby, alignl=TABLE_ALIGN_LEFT,
+                fmt=kwargs['args'].format, timer=phase)
 
 
 ###############################################################################
 # Show all instance tags
 ###############################################################################
 def show_instances_tags(*args, **kwargs):
-    log.info("args: %s", pprint.pformat(args))
-    log.info("args: %s", pprint.pformat(kwargs))
-
-    # find all tags key
-    all_keys = set()
-    for instance in kwargs["instances"]:
-        all_keys.update(instance.all_tags_key())
-    log.debug("all_keys: %s", pprint.pformat(all_keys))
+    log.info("args: %s", LazyPformat(args))
+    log.info("args: %s", LazyPformat(kwargs))
 
     # create a nested list with all table rows
-    # instance_id, tag_key, tag_value
+    # instance_id, tag_key -> tag_value
     rows = list()
     for instance in kwargs["instances"]:
         row = list()
         row.append(instance.resource_id)
-        all_tags = ""
-        for tag_key in all_keys:
-            value = instance.tag_value(tag_key)
-            # since it is looping through all tag keys, ensure
-            # the tag is defined for this specific instance
-            if value:
-                if all_tags:
-                    all_tags += "\n"
-                all_tags += tag_key + " -> " + value
-        row.append(all_tags)
+        row.append("\n".join(key + " -> " + value
+                              for key, value in sorted(instance.tags.items())
+                              if value))
+        if kwargs['args'].regions:
+            row.append(instance.region())
         rows.append(row)
     header = ['InstanceId', 'Tags']
+    if kwargs['args'].regions:
+        header.append('Region')
     sortby = "InstanceId"
     align_left = ['Tags']
-    print_table(header, rows, sortby=sortby, alignl=align_left, hrules="ALL")
+    print_table(header, rows, sortby=sortby, alignl=align_left, hrules="ALL",
+                fmt=kwargs['args'].format, timer=phase)
+
+
+###############################################################################
+# Return tags and missing tag keys selected by -tag and -tag-missing
+#
+# -tag key=value selects a value, -tag key selects any value
+# Return tuple: list with (key, value) tuples, list with keys
+###############################################################################
+def selected_tags(args):
+    tags = list()
+    for tag in args.tag or ():
+        key, sep, value = tag.partition('=')
+        tags.append((key, value if sep else None))
+    log.debug("tags: %s, missing: %s", tags, args.tag_missing)
+
+    return tags, args.tag_missing or []
+
+
+###############################################################################
+# Return the function that returns the group value of an instance
+# Params:
+#   - pertype  (str): one of PERTYPES or Tag:<key>
+#   - profile  (str): profile where the instance was found
+###############################################################################
+def pertype_func(pertype, profile):
+    if pertype.lower().startswith('tag:'):
+        tag_key = pertype[4:]
+        return lambda instance: instance.tag_value(tag_key)
+    if pertype == 'Profile':
+        profile_name = profile or 'default'
+        return lambda instance: profile_name
+    if pertype not in PERTYPES:
+        msg("red", "Error: invalid type: " + pertype, 1)
+    return getattr(Aws_ec2_instance, pertype.lower())
+
+
+###############################################################################
+# Count instances per group in a single pass over the streamed pages
+# Params:
+#   - args      (args): command line arguments, args.profile is used
+#   - pertypes  (list): group keys, see pertype_func
+#   - filter_name  (str): Optional. Describe filter name
+#   - filter_value (str): Optional. Describe filter value
+#
+# Return a Counter: tuple with the group values -> number of instances
+###############################################################################
+def count_instances(args, pertypes, filter_name='', filter_value=''):
+    funcs = [pertype_func(pertype, args.profile) for pertype in pertypes]
+    fields = set()
+    for pertype in pertypes:
+        if pertype.lower().startswith('tag:'):
+            fields.add('Tags')
+        elif pertype in PERTYPE_FIELDS:
+            fields.update(PERTYPE_FIELDS[pertype])
+        else:
+            fields.add(pertype)
+
+    counter = collections.Counter()
+    for page in query_aws_regions_pages(args,
+                                        Aws_ec2_instance,
+                                        resource_type='instances',
+                                        filter_name=filter_name,
+                                        filter_value=filter_value,
+                                        fields=sorted(fields)):
+        counter.update(tuple(func(instance) for func in funcs)
+                       for instance in page)
+    log.debug("counter: %s", LazyPformat(counter))
+
+    return counter
 
 
 ###############################################################################
 # Show number of instance per "type"
+#
+# Several types, comma separated, group by all of them. Profiles from
+# -profiles are queried in parallel and their counts are added up
 ###############################################################################
 def cmd_num_inst(args):
     log.info("params: %s", args)
 
-    ec2 = initialize_boto3_session(args, 'ec2')
-
     # check if filter was specified
     filter_name = args.filter[0] if args.filter else ""
     filter_value = args.filter[1] if args.filter else ""
 
-    resource = 'instances'
-    # get resources id
-    instances_id = query_aws(ec2,
-                             resource_type=resource,
-                             filter_name=filter_name,
-                             filter_value=filter_value)
-    if not instances_id:
+    # types are case insensitive, tag keys are not
+    types = {i.lower(): i for i in PERTYPES}
+    pertypes = list()
+    for pertype in (i.strip() for i in args.pertype.split(',')):
+        if not pertype:
+            continue
+        if pertype.lower().startswith('tag:') and pertype[4:]:
+            pertype = 'Tag:' + pertype[4:]
+        elif pertype.lower() in types:
+            pertype = types[pertype.lower()]
+        else:
+            msg("red", "Error: invalid type: %s. Types: %s or Tag:<key>"
+                % (pertype, ', '.join(PERTYPES)), 1)
+        if pertype in pertypes:
+            msg("red", "Error: duplicated type: " + pertype, 1)
+        pertypes.append(pertype)
+    if not pertypes:
+        msg("red", "Error: No type informed", 1)
+
+    def count_profile(profile_args):
+        return count_instances(profile_args, pertypes,
+                               filter_name=filter_name,
+                               filter_value=filter_value)
+
+    counter = collections.Counter()
+    for profile_counter in run_profiles(args, count_profile).values():
+        counter.update(profile_counter)
+    if not counter:
         msg("red", "Error: No instance found", 1)
 
-    # instantiate all ec2 instances returned in the query
-    instances = [Aws_ec2_instance(ec2, 'Instance', i_id)
-                 for i_id in instances_id]
+    rows = [list(group) + [number] for group, number in counter.items()]
 
-    all_types = [getattr(i, args.pertype.lower())() for i in instances]
-    log.debug("all_types: %s", pprint.pformat(all_types))
-
-    rows = list()
-    for each_type in set(all_types):
-        row = list()
-        row.append(each_type)
-        row.append(all_types.count(each_type))
-        rows.append(row)
-
-    header = [args.pertype, 'Number']
-    sortby = args.sortby if args.sortby else args.pertype
-    print_table(header, rows, sortby=sortby)
+    header = pertypes + ['Number']
+    sortby = args.sortby if args.sortby else pertypes[0]
+    print_table(header, rows, sortby=sortby, fmt=args.format, timer=phase)
 
 
 ###############################################################################
@@ -269,25 +425,46 @@ def cmd_num_inst(args):
 def cmd_list_instances(args):
     log.info("params: %s", args)
 
-    ec2 = initialize_boto3_session(args, 'ec2')
-
     # check if filter was specified
     filter_name = args.filter[0] if args.filter else ""
     filter_value = args.filter[1] if args.filter else ""
 
     resource = 'instances'
-    # get resources id
-    instances_id = query_aws(ec2,
-                             resource_type=resource,
-                             filter_name=filter_name,
-                             filter_value=filter_value)
-    if not instances_id:
+    tags, missing = selected_tags(args)
+
+    if args.output == 'table' and stream_output(args):
+        header = list(TABLE_HEADER)
+        if args.regions:
+            header.append('Region')
+        select = None
+        if tags or missing:
+            select = lambda i: i.match_tags(tags, missing)
+        # print rows as soon as each page arrives
+        if not stream_aws_regions(args,
+                                  Aws_ec2_instance,
+                                  header,
+                                  resource_type=resource,
+                                  filter_name=filter_name,
+                                  filter_value=filter_value,
+                                  fields=OUTPUT_FIELDS['table'],
+                                  select=select,
+                                  alignl=TABLE_ALIGN_LEFT):
+            msg("red", "Error: No instance found", 1)
+        return
+
+    # get resources from all regions, built straight from the pages
+    instances = query_aws_regions(args,
+                                  Aws_ec2_instance,
+                                  resource_type=resource,
+                                  filter_name=filter_name,
+                                  filter_value=filter_value,
+                                  fields=OUTPUT_FIELDS[args.output])
+    if tags or missing:
+        selected = Aws_tag_index(instances).select(tags, missing)
+        instances = [i for i in instances if i.resource_id in selected]
+    if not instances:
         msg("red", "Error: No instance found", 1)
 
-    # instantiate all ec2 instances returned in the query
-    instances = [Aws_ec2_instance(ec2, 'Instance', i_id)
-                 for i_id in instances_id]
-
     # For each option, store the function to call
     funcs = {
         "table": show_instances_table,
@@ -299,6 +476,6 @@ def cmd_list_instances(args):
         "names": show_instances_names}
 
     # call function to handle the output type
-    funcs[args.output](ec2=ec2, instances=instances, sortby=args.sortby)
+    funcs[args.output](args=args, instances=instances, sortby=args.sortby)
 
 # vim: ts=4
@@ -10,13 +10,14 @@ Developed for Python 3
 # Site: http://thobias.org
 
 import logging
-import subprocess
 import datetime
 import sys
 import re
-import smtplib
+import csv
+import json
+import itertools
+import contextlib
 import collections
-import prettytable
 
 
 ##############################################################################
@@ -85,7 +86,8 @@ def msg(color,
         sys.exit(exitcode)
 
 
-def print_table(header, rows, *, sortby='', alignl='', alignr='', hrules=''):
+def print_table(header, rows, *, sortby='', alignl='', alignr='', hrules='',
+                fmt='table', timer=None):
     """
     Print table
     Arguments:
@@ -99,28 +101,161 @@ def print_table(header, rows, *, sortby='', alignl='', alignr='', hrules=''):
         alignr     (list): headers name to align to right
         hrules      (str): Controls printing of horizontal rules after rows.
                            Allowed values: FRAME, HEADER, ALL, NONE
+        fmt         (str): Output format: table, csv, tsv or jsonl
+                           Default is table
+        timer      (func): timer(name) context manager, called to time the
+                           'sort' and 'render' steps
     """
-    output = prettytable.PrettyTable(header)
-    output.format = True
-    if hrules:
-        output.hrules = getattr(prettytable, hrules)
+    # imported only when needed, to keep startup fast
+    import prettytable
 
-    for row in rows:
-        row_entry = list()
-        for pos in row:
-            row_entry.append(pos)
-        output.add_row(row_entry)
+    if timer is None:
+        def timer(name):
+            return contextlib.nullcontext()
 
     if sortby:
         # if sortby is invalid, ie, does not exist on header,
         # sort by first column by default
-        output.sortby = sortby if sortby in header else header[0]
-    for left in alignl:
-        output.align[left] = 'l'
-    for right in alignr:
-        output.align[right] = 'r'
+        column = header.index(sortby) if sortby in header else 0
+        with timer('sort'):
+            if fmt != 'table':
+                rows = sorted(rows, key=lambda row: row[column])
+            else:
+                # same order as prettytable sortby: ties are sorted by
+                # the whole row
+                rows = sorted(rows, key=lambda row: [row[column]] + list(row))
+
+    with timer('render'):
+        if fmt != 'table':
+            output = StreamTable(header, fmt=fmt)
+            output.add_rows(rows)
+            output.close()
+            return
+
+        output = prettytable.PrettyTable(header)
+        output.format = True
+        if hrules:
+            output.hrules = getattr(prettytable, hrules)
+
+        for row in rows:
+            row_entry = list()
+            for pos in row:
+                row_entry.append(pos)
+            output.add_row(row_entry)
+
+        for left in alignl:
+            output.align[left] = 'l'
+        for right in alignr:
+            output.align[right] = 'r'
+
+        print(output)
+
+
+class StreamTable:
+    """
+    Print table rows as soon as they are added, so rows are never kept
+    in memory. As rows are not known in advance, the table format uses
+    fixed column widths and rows can not be sorted.
+
+    Arguments:
+        header     (list): List with table header
+
+    Keyword arguments (optional):
+        fmt         (str): Output format: table, csv, tsv or jsonl
+                           Default is table
+        widths     (dict): header name -> column width, used by table
+                           format. Larger values are truncated. Default
+                           width is the header length
+        alignl     (list): headers name to align to left
+        alignr     (list): headers name to align to right
+        out         (obj): file object to write, default is stdout
+
+    Example:
+        >>> output = StreamTable(['Name', 'Size'], widths={'Name': 10})
+        >>> output.add_rows([['file1', 10], ['file2', 20]])
+        >>> output.close()
+    """
+    formats = ['table', 'csv', 'tsv', 'jsonl']
+
+    def __init__(self, header, *, fmt='table', widths=None, alignl='',
+                 alignr='', out=None):
+        if fmt not in self.formats:
+            raise ValueError("Invalid format")
+
+        self.header = list(header)
+        self.fmt = fmt
+        self.out = out if out else sys.stdout
+        self.num_rows = 0
+
+        widths = widths if widths else dict()
+        self.widths = [max(len(name), widths.get(name, 0))
+                       for name in self.header]
+        self.align = ['l' if name in alignl else 'r' if name in alignr
+                      else 'c' for name in self.header]
+
+        self.writer = None
+        if fmt in ['csv', 'tsv']:
+            self.writer = csv.writer(self.out,
+                                     delimiter=',' if fmt == 'csv' else '\t',
+                                     lineterminator='\n')
+
+    def _border(self):
+        return '+' + '+'.join('-' * (width + 2) for width in self.widths) + '+'
+
+    def _line(self, values, align=None):
+        cells = list()
+        for pos, value in enumerate(values):
+            width = self.widths[pos]
+            value = value[:width]
+            col_align = align if align else self.align[pos]
+            if col_align == 'l':
+                cells.append(value.ljust(width))
+            elif col_align == 'r':
+                cells.append(value.rjust(width))
+            else:
+                cells.append(value.center(width))
+        return '| ' + ' | '.join(cells) + ' |'
+
+    def _write_header(self):
+        if self.fmt == 'table':
+            self.out.write(self._border() + '\n')
+            self.out.write(self._line(self.header, align='c') + '\n')
+            self.out.write(self._border() + '\n')
+        elif self.writer:
+            self.writer.writerow(self.header)
+
+    def add_rows(self, rows):
+        """
+        Print rows and flush the output
+
+        Arguments:
+            rows   (list): Nested list with table rows
+        """
+        for row in rows:
+            if not self.num_rows:
+                self._write_header()
+            self.num_rows += 1
+
+            if self.fmt == 'table':
+                # multi line values are printed in many table lines
+                cells = [str(value).split('\n') for value in row]
+                for values in itertools.zip_longest(*cells, fillvalue=''):
+                    self.out.write(self._line(values) + '\n')
+            elif self.fmt == 'jsonl':
+                self.out.write(json.dumps(dict(zip(self.header, row)),
+                                          default=str) + '\n')
+            else:
+                self.writer.writerow(row)
 
-    print(output)
+        self.out.flush()
+
+    def close(self):
+        """
+        Finish the table
+        """
+        if self.fmt == 'table' and self.num_rows:
+            self.out.write(self._border() + '\n')
+        self.out.flush()
 
 
 ##############################################################################
@@ -139,6 +274,8 @@ def send_email(mail_from, mail_to, subject, body, mailserver='localhost'):
         subject     (str): mail subject
         mail_server (str, opt): mail server address. Default is localhost
     """
+    import smtplib
+
     mail_msg = """\
 From: %s
 To: %s
@@ -205,6 +342,29 @@ def setup_logging(logfile=None, *,
     return logging.getLogger(__name__)
 
 
+class LazyPformat:
+    """
+    Pretty-print an object only if the log record is really emitted
+
+    logging only converts arguments to str when a record is emitted, so
+    nothing is formatted when the log level is disabled
+
+    Arguments:
+        obj       (obj): object to be pretty-printed
+
+    Example:
+        log.debug("metadata: %s", LazyPformat(metadata))
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        import pprint
+        return pprint.pformat(self.obj)
+
+
 ##############################################################################
 ##############################################################################
 ## Dictionary
@@ -284,6 +444,8 @@ def run_cmd(cmd):
         - If command completes with return code different from zero
         return: command_return_code, stderr
     """
+    import subprocess
+
     process = subprocess.Popen(
         cmd,
         shell=True,
@@ -0,0 +1,171 @@
+"""
+Module to reuse boto3 sessions and clients in the whole process
+"""
+import logging
+import threading
+import collections
+from cache import cache_client
+from ratelimit import client_config
+from ratelimit import limit_client
+from stats import stats_client
+
+
+log = logging.getLogger(__name__)
+
+# Default max number of http connections of each client
+MAX_POOL_CONNECTIONS = 10
+
+# Settings from the command line, see configure_pool
+_settings = {'max_pool_connections': MAX_POOL_CONNECTIONS}
+
+# profile -> boto3 session
+_sessions = dict()
+# (profile, region, service) -> boto3 client
+_clients = dict()
+# (profile, service) -> boto3 service resource class
+_resource_classes = dict()
+# boto3 sessions are not thread safe, so clients are created with it
+_lock = threading.RLock()
+
+# Number of hits and misses: (kind, 'hits' | 'misses') -> number
+_stats = collections.Counter()
+
+
+##############################################################################
+# Configure the pool from command line arguments
+#
+# Each client has one http connection per worker thread. Pooled clients
+# are discarded if the settings changed, including the API cache and
+# rate limit ones, which are applied when clients are created. The
+# daemon configures the pool for each command and keeps warm clients
+##############################################################################
+def configure_pool(args):
+    settings = {'max_pool_connections': max(MAX_POOL_CONNECTIONS,
+                                            args.workers),
+                'client_settings': (args.cache, args.cache_ttl,
+                                    args.refresh, args.api_rate,
+                                    args.retry_mode, args.retries)}
+    with _lock:
+        if settings == _settings:
+            return
+        _settings.update(settings)
+        _sessions.clear()
+        _clients.clear()
+        _resource_classes.clear()
+        _stats.clear()
+    log.debug("settings: %s", _settings)
+
+
+##############################################################################
+# Return the boto3 session of a profile
+# Params:
+#   - profile   (str): Optional. Profile name, default uses the default
+#                      credentials chain
+##############################################################################
+def get_session(profile=None):
+    with _lock:
+        if profile in _sessions:
+            _stats['session', 'hits'] += 1
+            return _sessions[profile]
+        _stats['session', 'misses'] += 1
+
+        # boto3 takes a while to be imported, so only import it when an
+        # AWS API is really used
+        import boto3
+
+        log.debug("new session: %s", profile)
+        _sessions[profile] = boto3.Session(profile_name=profile)
+        return _sessions[profile]
+
+
+##############################################################################
+# Use a boto3 session for a profile, instead of a new one
+# Params:
+#   - profile   (str): Profile name, None for the default credentials chain
+#   - session   (obj): boto3 session. Ex: with event handlers registered
+#
+# Pooled clients and resource classes of the profile are discarded, so
+# the next ones are created with this session
+##############################################################################
+def set_session(profile, session):
+    with _lock:
+        _sessions[profile] = session
+        for key in [i for i in _clients if i[0] == profile]:
+            del _clients[key]
+        for key in [i for i in _resource_classes if i[0] == profile]:
+            del _resource_classes[key]
+    log.debug("session set: %s", profile)
+
+
+##############################################################################
+# Return the boto3 client of a profile, region and service
+# Params:
+#   - service     (str): boto3 service name. Ex: ec2, s3
+#   - profile     (str): Optional. Profile name
+#   - region_name (str): Optional. Default is the configured region
+#
+# Clients are thread safe, so the same client is used by all threads.
+# Stats, API cache and rate limit handlers are registered only once per
+# client
+##############################################################################
+def get_client(service, profile=None, region_name=None):
+    key = (profile, region_name, service)
+    with _lock:
+        if key in _clients:
+            _stats['client', 'hits'] += 1
+            return _clients[key]
+        _stats['client', 'misses'] += 1
+
+        log.debug("new client: %s", key)
+        client = get_session(profile).client(
+            service,
+            region_name=region_name,
+            config=client_config(
+                max_pool_connections=_settings['max_pool_connections']))
+        # count API calls, serve them from the cache and limit their rate.
+        # Calls are counted first, as the cache stops the other handlers
+        stats_client(client)
+        cache_client(client, profile)
+        limit_client(client, profile)
+        _clients[key] = client
+        return client
+
+
+##############################################################################
+# Return a boto3 service resource of a profile, region and service
+# Params:
+#   - service     (str): boto3 service name. Ex: ec2, s3
+#   - profile     (str): Optional. Profile name
+#   - region_name (str): Optional. Default is the configured region
+#
+# Resources are not thread safe, so a new one is returned on each call,
+# but all of them use the pooled client, which is the expensive part
+##############################################################################
+def get_resource(service, profile=None, region_name=None):
+    key = (profile, service)
+    with _lock:
+        if key in _resource_classes:
+            _stats['resource', 'hits'] += 1
+        else:
+            _stats['resource', 'misses'] += 1
+            # the resource class is built from the service definition
+            # only once, its own client is discarded
+            _resource_classes[key] = type(
+                get_session(profile).resource(service,
+                                              region_name=region_name))
+        resource_class = _resource_classes[key]
+
+    return resource_class(client=get_client(service, profile, region_name))
+
+
+##############################################################################
+# Return dictionary with the number of hits and misses of each kind
+# Ex: {'client': {'hits': 10, 'misses': 2}, ...}
+##############################################################################
+def pool_stats():
+    stats = collections.defaultdict(dict)
+    for (kind, result), number in sorted(_stats.items()):
+        stats[kind][result] = number
+    return dict(stats)
+
+# vim: ts=4
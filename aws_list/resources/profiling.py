@@ -0,0 +1,124 @@
+"""
+Module to profile CPU and memory hotspots of a run
+"""
+import sys
+import logging
+import contextlib
+
+
+log = logging.getLogger(__name__)
+
+# Number of functions or lines shown in the reports
+REPORT_LINES = 30
+
+# Frames kept by tracemalloc for each memory block
+MEM_FRAMES = 10
+
+
+##############################################################################
+# Profile the code run inside it, as selected by --profile-run
+# Params: args (args): --profile-run is cpu or mem. --profile-output is
+#                      the pstats file (cpu) or report file (mem), the
+#                      report is written to stderr if it is not informed
+#
+# cpu uses cProfile, which only profiles the main thread. Use a single
+# region (or --workers 1) to profile the per region queries too.
+# mem uses tracemalloc, which traces the memory allocated by all threads.
+# The report is written even if the code exits (ex: no instance found)
+##############################################################################
+@contextlib.contextmanager
+def profile_run(args):
+    if args.profile_run == 'cpu':
+        # imported only when needed, to keep startup fast
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            write_cpu_report(profiler, args.profile_output)
+    elif args.profile_run == 'mem':
+        import tracemalloc
+        tracemalloc.start(MEM_FRAMES)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            write_mem_report(snapshot, peak, args.profile_output)
+    else:
+        yield
+
+
+##############################################################################
+# Write cProfile results
+# Params:
+#   - profiler   (obj): cProfile.Profile
+#   - filename   (str): pstats file, to be loaded by pstats or snakeviz.
+#                       If None, a report sorted by cumulative time is
+#                       written to stderr
+##############################################################################
+def write_cpu_report(profiler, filename=None):
+    import pstats
+
+    if filename:
+        try:
+            profiler.dump_stats(filename)
+        except OSError as error:
+            log.warning("Could not write profile %s: %s", filename, error)
+        return
+
+    sys.stderr.write("\nCPU profile, main thread, by cumulative time:\n")
+    stats = pstats.Stats(profiler, stream=sys.stderr)
+    stats.sort_stats('cumulative', 'tottime').print_stats(REPORT_LINES)
+
+
+##############################################################################
+# Write tracemalloc results
+# Params:
+#   - snapshot   (obj): tracemalloc.Snapshot taken at the end of the run
+#   - peak       (int): peak traced memory in bytes
+#   - filename   (str): report file. If None, it is written to stderr
+#
+# The report shows the lines that allocated most of the memory still in
+# use, and the call stack of the biggest one
+##############################################################################
+def write_mem_report(snapshot, peak, filename=None):
+    import tracemalloc
+
+    # memory used by the imports is not interesting
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, tracemalloc.__file__)])
+    top_lines = snapshot.statistics('lineno')
+    total = sum(stat.size for stat in top_lines)
+
+    lines = ["", "Memory profile, all threads:",
+             "in use: {:.1f} KiB, peak: {:.1f} KiB".format(total / 1024,
+                                                            peak / 1024),
+             ""]
+    for stat in top_lines[:REPORT_LINES]:
+        frame = stat.traceback[0]
+        lines.append("{:>10.1f} KiB {:>8} blocks  {}:{}".format(
+            stat.size / 1024, stat.count, frame.filename, frame.lineno))
+
+    top_tracebacks = snapshot.statistics('traceback')
+    if top_tracebacks:
+        lines.extend(["", "Biggest allocation call stack:"])
+        lines.extend(top_tracebacks[0].traceback.format())
+    report = "\n".join(lines) + "\n"
+
+    if filename:
+        try:
+            with open(filename, 'w') as fd:
+                fd.write(report)
+        except OSError as error:
+            log.warning("Could not write profile %s: %s", filename, error)
+        return
+
+    sys.stderr.write(report)
+
+# vim: ts=4
@@ -0,0 +1,272 @@
+"""
+Module to limit the rate of AWS API calls and to configure retries
+"""
+import time
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Requests per second and burst of each (service, API family). API family
+# is the first word of the operation name, ex: Describe, List, Get
+RATE_LIMITS = {('ec2', 'Describe'): (20, 100),
+               ('s3', 'List'): (50, 100),
+               ('s3', 'Get'): (50, 100),
+               ('cloudwatch', 'Get'): (20, 50)}
+RATE_LIMIT_DEFAULT = (10, 20)
+
+# Rate never goes below it, in requests per second, after throttling
+RATE_MIN = 0.5
+
+# Fraction of the max rate recovered after each successful request
+RATE_RECOVERY = 0.02
+
+# Error codes returned when requests are throttled
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'ThrottledException',
+                     'RequestLimitExceeded', 'RequestThrottled',
+                     'RequestThrottledException', 'TooManyRequestsException',
+                     'SlowDown', 'BandwidthLimitExceeded')
+
+# Default botocore retries
+RETRY_MODE = 'standard'
+RETRY_MAX_ATTEMPTS = 10
+
+# First botocore version with retry modes, older ones only have legacy
+RETRY_MODES_BOTOCORE = (1, 15)
+
+# Settings from the command line, see configure_rate_limit
+_settings = {'rate': None,
+             'retry_mode': RETRY_MODE,
+             'max_attempts': RETRY_MAX_ATTEMPTS}
+
+# Token buckets shared by all threads:
+# (profile, region, service, API family) -> TokenBucket
+_buckets = dict()
+_buckets_lock = threading.Lock()
+
+
+##############################################################################
+# Token Bucket Class
+##############################################################################
+class TokenBucket:
+    """
+    Thread safe token bucket with adaptive rate
+
+    The rate is halved each time a request is throttled and slowly grows
+    back to max_rate after successful requests (AIMD).
+
+    Params:
+        rate    (float): max requests per second
+        burst     (int): max requests sent at once
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Reserve a token, without waiting for it
+
+        Return the time in seconds to wait before the request is sent
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # the token is reserved even if it is not available yet, so
+            # waiting requests are served in order
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self):
+        """
+        Wait until a request can be sent
+
+        Return the time waited in seconds
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        """
+        Slow down after a throttled request
+        """
+        with self.lock:
+            self.throttles += 1
+            self.rate = max(RATE_MIN, self.rate / 2)
+            # throttled requests are retried, do not send them in a burst
+            self.tokens = min(self.tokens, 0)
+        log.debug("throttled, rate: %.2f", self.rate)
+
+    def succeeded(self):
+        """
+        Speed up after a successful request
+        """
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate * RATE_RECOVERY)
+
+
+##############################################################################
+# Return the token bucket shared by all requests of an API family
+##############################################################################
+def get_bucket(profile, region, service, operation):
+    family = operation
+    for pos, char in enumerate(operation[1:], 1):
+        if char.isupper():
+            family = operation[:pos]
+            break
+
+    key = (profile, region, service, family)
+    with _buckets_lock:
+        if key not in _buckets:
+            rate, burst = RATE_LIMITS.get((service, family),
+                                          RATE_LIMIT_DEFAULT)
+            if _settings['rate']:
+                rate = _settings['rate']
+            log.debug("bucket: %s, rate: %s, burst: %s", key, rate, burst)
+            _buckets[key] = TokenBucket(rate, burst)
+        return _buckets[key]
+
+
+##############################################################################
+# Configure rate limits and retries from command line arguments
+#
+# --api-rate sets the requests per second of all API families, 0 disables
+# the rate limit. --retries and --retry-mode configure botocore retries.
+# Buckets are kept if the settings did not change, as the daemon
+# configures them for each command
+##############################################################################
+def configure_rate_limit(args):
+    settings = {'rate': args.api_rate,
+                'retry_mode': args.retry_mode,
+                'max_attempts': args.retries}
+    if settings == _settings:
+        return
+    _settings.update(settings)
+    with _buckets_lock:
+        _buckets.clear()
+    log.debug("settings: %s", _settings)
+
+
+##############################################################################
+# Return True if botocore supports retry modes (--retry-mode)
+##############################################################################
+def retry_modes_supported():
+    import botocore
+
+    version = tuple(map(int, botocore.__version__.split('.')[:2]))
+    return version >= RETRY_MODES_BOTOCORE
+
+
+##############################################################################
+# Return botocore client configuration with the configured retries
+# Params:
+#   - kwargs: Optional. Other botocore Config parameters
+#
+# Retry mode is only set if botocore supports it, older versions use the
+# legacy retries
+##############################################################################
+def client_config(**kwargs):
+    # botocore is imported by boto3, only when a client is created
+    import botocore.config
+
+    retries = {'max_attempts': _settings['max_attempts']}
+    if retry_modes_supported():
+        retries['mode'] = _settings['retry_mode']
+    elif _settings['retry_mode'] != 'legacy':
+        log.debug("botocore does not support retry mode %s, using legacy",
+                  _settings['retry_mode'])
+
+    return botocore.config.Config(retries=retries, **kwargs)
+
+
+##############################################################################
+# Return a "needs-retry" handler that slows down the bucket of throttled
+# requests and speeds it up after successful ones
+##############################################################################
+def throttling_handler(profile, region):
+    def check_throttled(event_name, response=None, **kwargs):
+        # event_name: needs-retry.<service>.<operation>
+        if response is None:
+            return None
+        _, service, operation = event_name.split('.', 2)
+        bucket = get_bucket(profile, region, service, operation)
+        if response[1].get('Error', {}).get('Code') in THROTTLING_ERRORS:
+            bucket.throttled()
+        elif response[0].status_code < 300:
+            bucket.succeeded()
+        # the retry decision is left to botocore
+        return None
+
+    return check_throttled
+
+
+##############################################################################
+# Limit the rate of API calls of a boto3 client
+# Params:
+#   - client    (obj): boto3 client
+#   - profile   (str): profile used to create the client
+#
+# Every attempt, including retries, waits for a token of its bucket, and
+# throttling errors slow down all clients that share the bucket
+##############################################################################
+def limit_client(client, profile=None):
+    if _settings['rate'] == 0:
+        return client
+
+    region = client.meta.region_name
+
+    def acquire(event_name, **kwargs):
+        # event_name: before-send.<service>.<operation>
+        _, service, operation = event_name.split('.', 2)
+        get_bucket(profile, region, service, operation).acquire()
+
+    client.meta.events.register('before-send', acquire)
+    client.meta.events.register('needs-retry',
+                                throttling_handler(profile, region))
+
+    return client
+
+
+##############################################################################
+# Limit the rate of API calls of an aiobotocore client
+# Params:
+#   - client    (obj): aiobotocore client
+#   - profile   (str): profile used to create the client
+#
+# Same as limit_client, but the token is waited with asyncio.sleep, so
+# the event loop keeps running the other requests. aiobotocore awaits
+# the coroutines returned by event handlers
+##############################################################################
+def limit_async_client(client, profile=None):
+    if _settings['rate'] == 0:
+        return client
+    import asyncio
+
+    region = client.meta.region_name
+
+    async def acquire(event_name, **kwargs):
+        _, service, operation = event_name.split('.', 2)
+        wait = get_bucket(profile, region, service, operation).reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    client.meta.events.register('before-send', acquire)
+    client.meta.events.register('needs-retry',
+                                throttling_handler(profile, region))
+
+    return client
+
+# vim: ts=4
@@ -2,24 +2,32 @@
 Module to handle regions
 """
 import logging
-import pprint
-import boto3
 import prettytable
+from pcof import LazyPformat
+from cache import cache_ttl
+from cache import load_cache
+from cache import save_cache
+from pool import get_client
+from stats import phase
+from Aws import run_regions
 
 
 log = logging.getLogger(__name__)
 
+# Regions and availability zones almost never change, cache them for a week
+REGIONS_CACHE_TTL = 7 * 24 * 3600
+
 
 ##############################################################################
 # Query all AWS Regions
 #
 # Return a list with regions name
 ##############################################################################
-def query_regions():
-    ec2 = boto3.client('ec2')
+def query_regions(profile=None):
+    ec2 = get_client('ec2', profile)
 
     regions = ec2.describe_regions()
-    log.debug("regions: %s", pprint.pformat(regions))
+    log.debug("regions: %s", LazyPformat(regions))
 
     region_name = [i['RegionName'] for i in regions['Regions']]
     log.debug("region_name: %s", region_name)
@@ -32,39 +40,62 @@ def query_regions():
 #
 # Return a list with zone names
 ##############################################################################
-def query_availability_zones(region_name):
+def query_availability_zones(region_name, profile=None):
     log.debug("Params region_name: %s", region_name)
-    ec2 = boto3.client('ec2', region_name=region_name)
+    ec2 = get_client('ec2', profile, region_name)
 
     avail_zones = ec2.describe_availability_zones()
-    log.debug("avail_zones: %s", pprint.pformat(avail_zones))
+    log.debug("avail_zones: %s", LazyPformat(avail_zones))
 
     zones_name = [i['ZoneName'] for i in avail_zones['AvailabilityZones']]
     return zones_name
 
 
+##############################################################################
+# Query all regions and their availability zones
+#
+# Availability zones of all regions are queried in parallel
+# Return a dictionary: region name -> list with zone names
+##############################################################################
+def query_regions_topology(args):
+    regions_name = query_regions(args.profile)
+
+    return run_regions(
+        args,
+        lambda region: query_availability_zones(region, args.profile),
+        regions_name)
+
+
 ##############################################################################
 # List Regions
 ##############################################################################
 def cmd_list_regions(args):
     log.debug("params: %s", args)
 
-    regions_name = query_regions()
+    # cached as the API responses, with --cache or --cache-ttl
+    ttl = cache_ttl(args, REGIONS_CACHE_TTL)
+    cache_name = 'regions_' + (args.profile or 'default')
+    topology = load_cache(cache_name, ttl)
+    if topology is None:
+        with phase('fetch'):
+            topology = query_regions_topology(args)
+        if ttl is not None:
+            save_cache(cache_name, topology)
 
     header = ['Region', 'NumberAvailabilityZones', 'AvailabilityZones']
     output = prettytable.PrettyTable(header)
     output.format = True
 
-    for region_name in regions_name:
+    for region_name, zones in topology.items():
         row = list()
         row.append(region_name)
-        zones = query_availability_zones(region_name)
         row.append(len(zones))
         row.append(", ".join(zones))
         output.add_row(row)
 
     output.align['AvailabilityZones'] = 'l'
     output.align['Region'] = 'l'
-    print(output)
+    with phase('render'):
+        print(output)
 
 # vim: ts=4
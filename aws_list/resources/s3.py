@@ -2,33 +2,139 @@
 Module to handle S3
 """
 import logging
-import pprint
+import collections
+import concurrent.futures
 import prettytable
 from pcof import bytes2human
+from pcof import LazyPformat
 from Cloudwatch import Cloudwatch
 from Aws import initialize_boto3_session
+from Aws import run_regions
+from cache import cache_ttl
+from cache import load_cache
+from cache import save_cache
+from stats import phase
 
 
 log = logging.getLogger(__name__)
 
+# Seconds to keep buckets location cached on disk
+S3_LOCATION_CACHE_TTL = 24 * 3600
+
+
+##############################################################################
+# Query S3 Buckets location (region)
+# Params:
+#   - args           (args): command line arguments: --profile, --workers
+#                            and the cache options are used
+#   - s3              (obj): boto3 s3 resource
+#   - bucket_names   (list): list with bucket names
+#
+# Locations are queried in parallel and cached on disk, with --cache or
+# --cache-ttl, as the API responses. The location of
+# buckets that can not be queried (ex: access denied, connection error) is
+# unknown, ie, None, and it is not cached
+# Return a dictionary: bucket name -> region name or None
+##############################################################################
+def s3_buckets_location(args, s3, bucket_names):
+    log.debug("num buckets: %s", len(bucket_names))
+    import botocore.exceptions
+
+    cache_name = 's3_locations_' + (args.profile or 'default')
+    ttl = cache_ttl(args, S3_LOCATION_CACHE_TTL)
+    locations = load_cache(cache_name, ttl) or dict()
+
+    def query_location(bucket_name):
+        try:
+            resp = s3.meta.client.get_bucket_location(Bucket=bucket_name)
+        except (botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError) as error:
+            log.warning("Could not get location of bucket %s: %s",
+                        bucket_name, error)
+            return None
+        # buckets in us-east-1 have a null location, and very old
+        # buckets in eu-west-1 return the legacy 'EU' value
+        location = resp['LocationConstraint'] or 'us-east-1'
+        return 'eu-west-1' if location == 'EU' else location
+
+    missing = [i for i in bucket_names if i not in locations]
+    if missing:
+        # boto3 clients are thread safe, so the s3 client is shared
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=args.workers) as pool:
+            for bucket_name, location in zip(missing,
+                                             pool.map(query_location,
+                                                      missing)):
+                locations[bucket_name] = location
+    if missing and ttl is not None:
+        save_cache(cache_name, {bucket_name: location
+                                for bucket_name, location in locations.items()
+                                if location})
+
+    return {i: locations[i] for i in bucket_names}
+
+
+##############################################################################
+# Query S3 Buckets metrics on Cloud Watch of each bucket's region
+# Params:
+#   - bucket_names   (list): list with bucket names
+#   - metrics        (list): Cloudwatch S3_METRICS names
+#   - numdays         (int): number days to show
+#
+# Buckets are grouped by region and the regions are queried in parallel,
+# with one Cloud Watch client per region
+# Return the same dictionary as Cloudwatch.get_s3_buckets_metrics. Buckets
+# with unknown location have no metrics
+##############################################################################
+def s3_buckets_metrics(args, s3, bucket_names, metrics, numdays):
+    buckets_per_region = collections.defaultdict(list)
+    results = dict()
+    with phase('fetch'):
+        locations = s3_buckets_location(args, s3, bucket_names)
+    for bucket_name, region in locations.items():
+        if region:
+            buckets_per_region[region].append(bucket_name)
+        else:
+            results[bucket_name] = {metric: list() for metric in metrics}
+    log.debug("buckets_per_region: %s", LazyPformat(buckets_per_region))
+
+    def query_region(region):
+        cloudwatch = Cloudwatch(args.profile, region)
+        return cloudwatch.get_s3_buckets_metrics(buckets_per_region[region],
+                                                 metrics=metrics,
+                                                 numdays=numdays)
+
+    with phase('fetch'):
+        for region_results in run_regions(args,
+                                          query_region,
+                                          list(buckets_per_region)).values():
+            results.update(region_results)
+
+    return results
+
 
 ##############################################################################
 # Query S3 Bucket Size
 # Params:
+#   - s3              (obj): boto3 s3 resource
 #   - bucket_names   (list): list with bucket names
 #   - numdays         (int): number days to show
 ##############################################################################
-def s3_buckets_size(bucket_names, numdays=7):
+def s3_buckets_size(args, s3, bucket_names, numdays=7):
     log.debug("bucket_names: %s", bucket_names)
 
     header = ['BucketName', 'Timestamp', 'BucketSizeBytes']
     output = prettytable.PrettyTable(header)
     output.format = True
 
-    cloudwatch = Cloudwatch()
+    metrics = s3_buckets_metrics(args,
+                                 s3,
+                                 bucket_names,
+                                 metrics=['size'],
+                                 numdays=numdays)
     for bucket_name in bucket_names:
-        resp = cloudwatch.get_s3_bucket_size(bucket_name, numdays)
-        log.debug("resp: %s", pprint.pformat(resp))
+        resp = metrics[bucket_name]['size']
+        log.debug("resp: %s", LazyPformat(resp))
         if resp:
             for resp_day in resp:
                 row = list()
@@ -46,26 +152,32 @@ def s3_buckets_size(bucket_names, numdays=7):
 
     output.align['BucketName'] = 'l'
     output.sortby = 'BucketName'
-    print(output)
+    with phase('render'):
+        print(output)
 
 
 ##############################################################################
 # Query S3 Bucket Number of Object
 # Params:
+#   - s3              (obj): boto3 s3 resource
 #   - bucket_names   (list): list with bucket names
 #   - numdays         (int): number days to show
 ##############################################################################
-def s3_buckets_numobj(bucket_names, numdays=7):
+def s3_buckets_numobj(args, s3, bucket_names, numdays=7):
     log.debug("bucket_names: %s", bucket_names)
 
     header = ['BucketName', 'Timestamp', 'NumberOfObjects']
     output = prettytable.PrettyTable(header)
     output.format = True
 
-    cloudwatch = Cloudwatch()
+    metrics = s3_buckets_metrics(args,
+                                 s3,
+                                 bucket_names,
+                                 metrics=['numobj'],
+                                 numdays=numdays)
     for bucket_name in bucket_names:
-        resp = cloudwatch.get_s3_bucket_numobj(bucket_name, numdays)
-        log.debug("resp: %s", pprint.pformat(resp))
+        resp = metrics[bucket_name]['numobj']
+        log.debug("resp: %s", LazyPformat(resp))
         if resp:
             for resp_day in resp:
                 row = list()
@@ -83,7 +195,50 @@ def s3_buckets_numobj(bucket_names, numdays=7):
 
     output.align['BucketName'] = 'l'
     output.sortby = 'BucketName'
-    print(output)
+    with phase('render'):
+        print(output)
+
+
+##############################################################################
+# Query S3 Bucket Size and Number of Objects in the same requests
+# Params:
+#   - s3              (obj): boto3 s3 resource
+#   - bucket_names   (list): list with bucket names
+#   - numdays         (int): number days to show
+##############################################################################
+def s3_buckets_size_numobj(args, s3, bucket_names, numdays=7):
+    log.debug("bucket_names: %s", bucket_names)
+
+    header = ['BucketName', 'Timestamp', 'BucketSizeBytes', 'NumberOfObjects']
+    output = prettytable.PrettyTable(header)
+    output.format = True
+
+    metrics = s3_buckets_metrics(args,
+                                 s3,
+                                 bucket_names,
+                                 metrics=['size', 'numobj'],
+                                 numdays=numdays)
+    for bucket_name in bucket_names:
+        # join both metrics by timestamp
+        days = dict()
+        for resp_day in metrics[bucket_name]['size']:
+            size = "{0} {1}".format(*bytes2human(resp_day['Average']))
+            days.setdefault(resp_day['Timestamp'], ["", ""])[0] = size
+        for resp_day in metrics[bucket_name]['numobj']:
+            num = "{:.0f}".format(resp_day['Average'])
+            days.setdefault(resp_day['Timestamp'], ["", ""])[1] = num
+        log.debug("days: %s", LazyPformat(days))
+
+        if days:
+            for timestamp, values in days.items():
+                output.add_row([bucket_name, timestamp] + values)
+        else:
+            output.add_row([bucket_name, "", "", ""])
+
+    output.align['BucketName'] = 'l'
+    output.sortby = 'BucketName'
+    with phase('render'):
+        print(output)
 
 
 ##############################################################################
@@ -95,13 +250,16 @@ def cmd_list_s3(args):
     s3 = initialize_boto3_session(args, 's3')
 
     buckets_name = list()
-    for bucket in s3.buckets.all():
-        buckets_name.append(bucket.name)
+    with phase('fetch'):
+        for bucket in s3.buckets.all():
+            buckets_name.append(bucket.name)
 
-    if args.size:
-        s3_buckets_size(buckets_name, 1)
+    if args.size and args.numobj:
+        s3_buckets_size_numobj(args, s3, buckets_name, 4)
+    elif args.size:
+        s3_buckets_size(args, s3, buckets_name, 1)
     elif args.numobj:
-        s3_buckets_numobj(buckets_name, 4)
+        s3_buckets_numobj(args, s3, buckets_name, 4)
     else:
         print("\n".join(buckets_name))
 
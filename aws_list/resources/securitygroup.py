@@ -3,15 +3,156 @@ Module to handle AWS Security Groups
 """
 import logging
 import pprint
+import ipaddress
+import collections
 from pcof import msg
 from pcof import print_table
 from Aws import Aws_ec2_secgroup
-from Aws import query_aws
-from Aws import initialize_boto3_session
+from Aws import query_aws_regions
+from Aws import stream_aws_regions
+from Aws import stream_output
+from stats import phase
 
 
 log = logging.getLogger(__name__)
 
+# IpProtocol numbers returned instead of names
+PROTOCOLS = {'1': 'icmp', '6': 'tcp', '17': 'udp', '58': 'icmpv6'}
+
+# Inbound rule: group where it is defined, protocol ('-1' is any), port
+# range (-1 is any) and source (cidr or group id)
+Rule = collections.namedtuple('Rule', ['secgroup', 'protocol', 'from_port',
+                                       'to_port', 'source'])
+
+
+##############################################################################
+# Security Groups Rules Index Class
+##############################################################################
+class RulesIndex():
+    """
+    Index of the inbound rules of many security groups
+
+    Cidr rules are indexed by ip version, prefix length and network
+    address, so the rules that contain a source are found with one
+    lookup per prefix length. Rules that reference a group are indexed
+    by the group id.
+
+    Params:
+        secgroups (list): Optional. Aws_ec2_secgroup objects to index
+    """
+
+    def __init__(self, secgroups=()):
+        # (ip version, prefix length) -> network address -> rules
+        self.cidrs = collections.defaultdict(dict)
+        # referenced group id -> rules
+        self.groups = collections.defaultdict(list)
+        self.num_rules = 0
+
+        for secgroup in secgroups:
+            self.add(secgroup)
+
+    def add(self, secgroup):
+        """
+        Add all inbound rules of a security group to the index
+        """
+        for perm in secgroup.metadata['IpPermissions']:
+            protocol = PROTOCOLS.get(perm['IpProtocol'], perm['IpProtocol'])
+            from_port = perm.get('FromPort', -1)
+            to_port = perm.get('ToPort', -1)
+
+            cidrs = [i['CidrIp'] for i in perm.get('IpRanges', [])]
+            cidrs += [i['CidrIpv6'] for i in perm.get('Ipv6Ranges', [])]
+            for cidr in cidrs:
+                network = ipaddress.ip_network(cidr, strict=False)
+                key = (network.version, network.prefixlen)
+                self.cidrs[key].setdefault(
+                    int(network.network_address), []).append(
+                        Rule(secgroup, protocol, from_port, to_port, cidr))
+                self.num_rules += 1
+
+            for pair in perm.get('UserIdGroupPairs', []):
+                self.groups[pair['GroupId']].append(
+                    Rule(secgroup, protocol, from_port, to_port,
+                         pair['GroupId']))
+                self.num_rules += 1
+
+    def reach(self, source, port, protocol='tcp'):
+        """
+        Return list with the rules that allow source to reach port
+
+        Params:
+            source    (str): ip address, cidr or security group id. A cidr
+                             matches rules that allow all its addresses
+            port      (int): destination port
+            protocol  (str): Optional. ip protocol name, default tcp
+        """
+        if source.startswith('sg-'):
+            candidates = self.groups.get(source, [])
+        else:
+            network = ipaddress.ip_network(source, strict=False)
+            address = int(network.network_address)
+            max_prefixlen = network.max_prefixlen
+            candidates = list()
+            # rules whose network contains the source
+            for prefixlen in range(network.prefixlen + 1):
+                rules = self.cidrs.get((network.version, prefixlen))
+                if not rules:
+                    continue
+                mask = ((1 << prefixlen) - 1) << (max_prefixlen - prefixlen)
+                candidates.extend(rules.get(address & mask, []))
+
+        return [rule for rule in candidates
+                if rule.protocol == '-1' or (
+                    rule.protocol == protocol
+                    and (rule.from_port == -1
+                         or rule.from_port <= port <= rule.to_port))]
+
+
+##############################################################################
+# Show inbound rules that allow a source to reach a port
+##############################################################################
+def show_reach(args, secgroups):
+    source = args.reach[0]
+    port, _, protocol = args.reach[1].partition('/')
+    try:
+        port = int(port)
+        if not source.startswith('sg-'):
+            ipaddress.ip_network(source, strict=False)
+    except ValueError as error:
+        msg("red", "Error: -reach: " + str(error), 1)
+
+    index = RulesIndex(secgroups)
+    log.debug("indexed rules: %s", index.num_rules)
+    rules = index.reach(source, port, protocol.lower() or 'tcp')
+    if not rules:
+        msg("red", "Error: No rule found", 1)
+
+    header = ['GroupId', 'VpcId', 'GroupName', 'Source', 'Protocol', 'Ports']
+    if args.regions:
+        header.append('Region')
+
+    rows = list()
+    for rule in rules:
+        if rule.protocol == '-1':
+            ports = 'any'
+        elif rule.from_port == -1 or rule.from_port == rule.to_port:
+            ports = str(rule.from_port)
+        else:
+            ports = str(rule.from_port) + '-' + str(rule.to_port)
+        row = [rule.secgroup.groupid(),
+               rule.secgroup.vpcid(),
+               rule.secgroup.groupname(),
+               rule.source,
+               'any' if rule.protocol == '-1' else rule.protocol,
+               ports]
+        if args.regions:
+            row.append(rule.secgroup.region())
+        rows.append(row)
+
+    sortby = args.sortby if args.sortby else "GroupId"
+    print_table(header, rows, sortby=sortby, alignl=['GroupName'],
+                fmt=args.format, timer=phase)
+
 
 ##############################################################################
 # List security groups
@@ -19,33 +160,48 @@ log = logging.getLogger(__name__)
 def cmd_list_securitygroup(args):
     log.debug("params: %s", args)
 
-    ec2 = initialize_boto3_session(args, 'ec2')
-
     # check if filter was specified
     filter_name = args.filter[0] if args.filter else ""
     filter_value = args.filter[1] if args.filter else ""
 
     resource = 'security_groups'
-    # get resources id
-    secgroups_id = query_aws(ec2,
-                             resource_type=resource,
-                             filter_name=filter_name,
-                             filter_value=filter_value)
-    if not secgroups_id:
+    if args.rules:
+        header = ['GroupId', 'VpcId', 'GroupName', 'InBound', 'OutBound']
+    else:
+        header = ['GroupId', 'VpcId', 'GroupName', 'Description']
+    if args.regions:
+        header.append('Region')
+    align_left = ['GroupName', 'Description', 'InBound', 'OutBound']
+
+    if not args.detail and not args.reach and stream_output(args):
+        # print rows as soon as each page arrives
+        if not stream_aws_regions(args,
+                                  Aws_ec2_secgroup,
+                                  header,
+                                  resource_type=resource,
+                                  filter_name=filter_name,
+                                  filter_value=filter_value,
+                                  alignl=align_left):
+            msg("red", "Error: No security group found", 1)
+        return
+
+    # get resources from all regions, built straight from the pages
+    secgroups = query_aws_regions(args,
+                                  Aws_ec2_secgroup,
+                                  resource_type=resource,
+                                  filter_name=filter_name,
+                                  filter_value=filter_value)
+    if not secgroups:
         msg("red", "Error: No security group found", 1)
 
-    # instantiate all ec2 security group returned in the query
-    secgroups = [Aws_ec2_secgroup(ec2, 'SecurityGroup', i_id)
-                 for i_id in secgroups_id]
+    if args.reach:
+        show_reach(args, secgroups)
+        return
 
     if args.detail:
         for secgroup in secgroups:
             secgroup.show_metadata()
         return
-    elif args.rules:
-        header = ['GroupId', 'VpcId', 'GroupName', 'InBound', 'OutBound']
-    else:
-        header = ['GroupId', 'VpcId', 'GroupName', 'Description']
 
     rows = list()
     for secgroup in secgroups:
@@ -54,8 +210,8 @@ def cmd_list_securitygroup(args):
             row.append((getattr(secgroup, attr.lower())()))
         rows.append(row)
 
-    align_left = ['GroupName', 'Description', 'InBound', 'OutBound']
     sortby = args.sortby if args.sortby else "GroupId"
-    print_table(header, rows, sortby=sortby, alignl=align_left, hrules="ALL")
+    print_table(header, rows, sortby=sortby, alignl=align_left, hrules="ALL",
+                fmt=args.format, timer=phase)
 
 # vim: ts=4
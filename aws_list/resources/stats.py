@@ -0,0 +1,247 @@
+"""
+Module to count AWS API calls and to time the phases of a run
+"""
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+import collections
+from ratelimit import THROTTLING_ERRORS
+
+
+log = logging.getLogger(__name__)
+
+# Latency percentiles shown in the summary
+PERCENTILES = (50, 90, 99)
+
+# Stats of the run, None if --stats is not used, see configure_stats
+_stats = None
+
+
+##############################################################################
+# Run Stats Class
+##############################################################################
+class RunStats:
+    """
+    API calls per (service, operation, region) and wall time per phase
+
+    API calls are counted by all threads. Phases are only timed in the
+    main thread, so the time spent by parallel queries is not added up.
+    A phase does not include the time of the phases started inside it.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        # (service, operation, region) -> counter name -> number
+        self.calls = collections.defaultdict(collections.Counter)
+        # (service, operation, region) -> list with latency of each call
+        self.latencies = collections.defaultdict(list)
+        # phase name -> seconds
+        self.phases = collections.Counter()
+        # phases being timed: [name, start time]
+        self.running = list()
+
+    def add_call(self, key, latency, cached):
+        with self.lock:
+            self.calls[key]['calls'] += 1
+            if cached:
+                self.calls[key]['cached'] += 1
+            self.latencies[key].append(latency)
+
+    def add_attempt(self, key, attempts, throttled, size):
+        with self.lock:
+            self.calls[key]['attempts'] += 1
+            if attempts > 1:
+                self.calls[key]['retries'] += 1
+            if throttled:
+                self.calls[key]['throttles'] += 1
+            self.calls[key]['bytes'] += size
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        now = time.perf_counter()
+        # pause the outer phase
+        if self.running:
+            outer = self.running[-1]
+            self.phases[outer[0]] += now - outer[1]
+        self.running.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.phases[name] += now - self.running.pop()[1]
+            # resume the outer phase
+            if self.running:
+                self.running[-1][1] = now
+
+    def summary(self):
+        """
+        Return dictionary with the stats of the run
+        """
+        def percentile(values, pct):
+            # nearest rank
+            return values[max(0, -(-len(values) * pct // 100) - 1)]
+
+        api = list()
+        with self.lock:
+            for key in sorted(self.calls, key=lambda i: tuple(map(str, i))):
+                latencies = sorted(self.latencies[key])
+                entry = {'service': key[0],
+                         'operation': key[1],
+                         'region': key[2]}
+                for name in ('calls', 'cached', 'attempts', 'retries',
+                             'throttles', 'bytes'):
+                    entry[name] = self.calls[key][name]
+                # calls answered before "before-call" have no latency
+                latencies = latencies or [0.0]
+                entry['latency'] = {'p%d' % pct: percentile(latencies, pct)
+                                    for pct in PERCENTILES}
+                entry['latency']['max'] = latencies[-1]
+                api.append(entry)
+
+        return {'wall_time': time.perf_counter() - self.start,
+                'phases': dict(self.phases),
+                'api': api}
+
+
+##############################################################################
+# Configure the stats from command line arguments
+#
+# Stats are enabled with --stats or --stats-file
+##############################################################################
+def configure_stats(args):
+    global _stats
+
+    if args.stats or args.stats_file:
+        _stats = RunStats()
+    else:
+        _stats = None
+
+    return _stats
+
+
+##############################################################################
+# Time a phase of the run (ex: fetch, join, sort, render)
+#
+# It does nothing if the stats are not enabled
+##############################################################################
+@contextlib.contextmanager
+def phase(name):
+    if _stats is None:
+        yield
+        return
+    with _stats.phase(name):
+        yield
+
+
+##############################################################################
+# Count the API calls of a boto3 client
+# Params:
+#   - client         (obj): boto3 or aiobotocore client
+#   - asynchronous  (bool): Optional. True for aiobotocore clients, whose
+#                           response body is read by a coroutine, so
+#                           bytes come from the content-length header
+#
+# Handlers must be registered before the ones of the API cache, as the
+# cache answers the call in "before-call" and the handlers registered
+# after it are not called. It does nothing if the stats are not enabled
+##############################################################################
+def stats_client(client, asynchronous=False):
+    run_stats = _stats
+    if not run_stats:
+        return client
+
+    region = client.meta.region_name
+
+    def start(model, context, **kwargs):
+        context['stats_start'] = time.perf_counter()
+
+    def finish(model, context, **kwargs):
+        if 'stats_start' not in context:
+            return
+        run_stats.add_call((model.service_model.service_name,
+                            model.name,
+                            region),
+                           time.perf_counter() - context['stats_start'],
+                           context.get('api_cache_hit', False))
+
+    def attempt(operation, attempts, response=None, **kwargs):
+        throttled = False
+        size = 0
+        if response is not None:
+            throttled = (response[1].get('Error', {}).get('Code')
+                         in THROTTLING_ERRORS)
+            if asynchronous:
+                size = int(response[0].headers.get('content-length') or 0)
+            elif not operation.has_streaming_output:
+                size = len(response[0].content or b'')
+        run_stats.add_attempt((operation.service_model.service_name,
+                               operation.name,
+                               region),
+                              attempts, throttled, size)
+        # the retry decision is left to botocore
+        return None
+
+    client.meta.events.register('before-call', start)
+    client.meta.events.register('after-call', finish)
+    client.meta.events.register('after-call-error', finish)
+    client.meta.events.register('needs-retry', attempt)
+
+    return client
+
+
+##############################################################################
+# Write the stats summary
+# Params: args (args): --stats-file is the json file, or the summary is
+#                      written to stderr as text
+#
+# It does nothing if the stats are not enabled
+##############################################################################
+def write_stats(args):
+    if not _stats:
+        return
+
+    summary = _stats.summary()
+    log.debug("stats: %s", summary)
+
+    if args.stats_file:
+        try:
+            with open(args.stats_file, 'w') as fd:
+                json.dump(summary, fd, indent=2)
+        except OSError as error:
+            log.warning("Could not write stats %s: %s", args.stats_file,
+                        error)
+        return
+
+    out = sys.stderr
+    out.write("\n{:<11} {:<26} {:<15} {:>6} {:>6} {:>8} {:>7} {:>9} "
+              "{:>10} {:>7} {:>7} {:>7} {:>7}\n".format(
+                  'service', 'operation', 'region', 'calls', 'cached',
+                  'attempts', 'retries', 'throttles', 'bytes', 'p50',
+                  'p90', 'p99', 'max'))
+    for entry in summary['api']:
+        out.write("{:<11} {:<26} {:<15} {:>6} {:>6} {:>8} {:>7} {:>9} "
+                  "{:>10} {:>7.3f} {:>7.3f} {:>7.3f} {:>7.3f}\n".format(
+                      entry['service'], entry['operation'],
+                      entry['region'] or '-', entry['calls'],
+                      entry['cached'], entry['attempts'], entry['retries'],
+                      entry['throttles'], entry['bytes'],
+                      entry['latency']['p50'], entry['latency']['p90'],
+                      entry['latency']['p99'], entry['latency']['max']))
+
+    phases = summary['phases']
+    out.write("\nphases: {}\n".format(", ".join(
+        "{} {:.3f}s".format(name, seconds)
+        for name, seconds in sorted(phases.items()))))
+    out.write("total: {:.3f}s (other {:.3f}s)\n".format(
+        summary['wall_time'],
+        summary['wall_time'] - sum(phases.values())))
+
+# vim: ts=4
@@ -5,44 +5,114 @@ import logging
 from pcof import msg
 from pcof import print_table
 from Aws import Aws_ec2_subnet
-from Aws import query_aws
-from Aws import initialize_boto3_session
+from Aws import query_aws_regions
+from Aws import stream_aws_regions
+from Aws import stream_output
+from Aws import run_profiles
+from Aws import cidr_overlaps
+from stats import phase
 
 
 log = logging.getLogger(__name__)
 
 
+##############################################################################
+# Show subnets of different VPCs with overlapping cidrs
+#
+# Cidrs of all regions and profiles are compared
+##############################################################################
+def show_subnets_overlaps(args, filter_name, filter_value):
+    def query_subnets(profile_args):
+        return query_aws_regions(profile_args,
+                                 Aws_ec2_subnet,
+                                 resource_type='subnets',
+                                 filter_name=filter_name,
+                                 filter_value=filter_value)
+
+    blocks = list()
+    profile_subnets = run_profiles(args, query_subnets, asynchronous=True)
+    for profile, subnets in profile_subnets.items():
+        for subnet in subnets:
+            for cidr in subnet.cidrblocks():
+                blocks.append((cidr, (profile or 'default', subnet)))
+
+    header = ['SubnetId', 'VpcId', 'CidrBlock', 'Relation',
+              'OtherSubnetId', 'OtherVpcId', 'OtherCidrBlock']
+    if args.regions:
+        header += ['Region', 'OtherRegion']
+    if args.profiles:
+        header += ['Profile', 'OtherProfile']
+
+    rows = list()
+    for (profile, subnet), cidr, (other_profile, other_subnet), other_cidr, \
+            relation in cidr_overlaps(blocks):
+        # subnets of the same vpc never overlap
+        if (profile == other_profile
+                and subnet.vpcid() == other_subnet.vpcid()):
+            continue
+        row = [subnet.subnetid(), subnet.vpcid(), cidr, relation,
+               other_subnet.subnetid(), other_subnet.vpcid(), other_cidr]
+        if args.regions:
+            row += [subnet.region(), other_subnet.region()]
+        if args.profiles:
+            row += [profile, other_profile]
+        rows.append(row)
+
+    if not rows:
+        msg("green", "No overlapping subnets found")
+        return
+
+    sortby = args.sortby if args.sortby else "CidrBlock"
+    print_table(header, rows, sortby=sortby, fmt=args.format, timer=phase)
+
+
 ##############################################################################
 # List Subnets
 ##############################################################################
 def cmd_list_subnets(args):
     log.info("params: %s", args)
 
-    ec2 = initialize_boto3_session(args, 'ec2')
-
     # check if filter was specified
     filter_name = args.filter[0] if args.filter else ""
     filter_value = args.filter[1] if args.filter else ""
 
+    if args.overlaps:
+        show_subnets_overlaps(args, filter_name, filter_value)
+        return
+
     resource = 'subnets'
-    # get resources id
-    subnets_id = query_aws(ec2,
-                           resource_type=resource,
-                           filter_name=filter_name,
-                           filter_value=filter_value)
-    if not subnets_id:
-        msg("red", "Error: No subnet found", 1)
+    header = ['SubnetId', 'Tag_Name', 'VpcId', 'CidrBlock',
+              'AvailableIpAddressCount', 'AvailabilityZone',
+              'DefaultForAz', 'State']
+    if args.regions:
+        header.append('Region')
+    align_left = ['CidrBlock', 'Tag_Name']
+
+    if not args.detail and stream_output(args):
+        # print rows as soon as each page arrives
+        if not stream_aws_regions(args,
+                                  Aws_ec2_subnet,
+                                  header,
+                                  resource_type=resource,
+                                  filter_name=filter_name,
+                                  filter_value=filter_value,
+                                  alignl=align_left):
+            msg("red", "Error: No subnet found", 1)
+        return
 
-    # instantiate all ec2 subnets returned in the query
-    subnets = [Aws_ec2_subnet(ec2, 'Subnet', i_id) for i_id in subnets_id]
+    # get resources from all regions, built straight from the pages
+    subnets = query_aws_regions(args,
+                                Aws_ec2_subnet,
+                                resource_type=resource,
+                                filter_name=filter_name,
+                                filter_value=filter_value)
+    if not subnets:
+        msg("red", "Error: No subnet found", 1)
 
     if args.detail:
         for subnet in subnets:
             subnet.show_metadata()
     else:
-        header = ['SubnetId', 'Tag_Name', 'VpcId', 'CidrBlock',
-                  'AvailableIpAddressCount', 'AvailabilityZone',
-                  'DefaultForAz', 'State']
         rows = list()
         for subnet in subnets:
             row = list()
@@ -50,7 +120,7 @@ def cmd_list_subnets(args):
                 row.append((getattr(subnet, attr.lower())()))
             rows.append(row)
         sortby = args.sortby if args.sortby else "SubnetId"
-        align_left = ['CidrBlock', 'Tag_Name']
-        print_table(header, rows, sortby=sortby, alignl=align_left)
+        print_table(header, rows, sortby=sortby, alignl=align_left,
+                    fmt=args.format, timer=phase)
 
 # vim: ts=4
@@ -5,43 +5,114 @@ import logging
 from pcof import msg
 from pcof import print_table
 from Aws import Aws_ec2_vpc
-from Aws import query_aws
-from Aws import initialize_boto3_session
+from Aws import query_aws_regions
+from Aws import stream_aws_regions
+from Aws import stream_output
+from Aws import run_profiles
+from Aws import cidr_overlaps
+from stats import phase
 
 
 log = logging.getLogger(__name__)
 
 
+##############################################################################
+# Show VPCs with overlapping cidrs
+#
+# Primary and secondary cidrs of all regions and profiles are compared
+##############################################################################
+def show_vpcs_overlaps(args, filter_name, filter_value):
+    def query_vpcs(profile_args):
+        return query_aws_regions(profile_args,
+                                 Aws_ec2_vpc,
+                                 resource_type='vpcs',
+                                 filter_name=filter_name,
+                                 filter_value=filter_value)
+
+    blocks = list()
+    profile_vpcs = run_profiles(args, query_vpcs, asynchronous=True)
+    for profile, vpcs in profile_vpcs.items():
+        for vpc in vpcs:
+            for cidr in vpc.cidrblocks():
+                blocks.append((cidr, (profile or 'default', vpc)))
+
+    header = ['VpcId', 'Tag_Name', 'CidrBlock', 'Relation',
+              'OtherVpcId', 'OtherTag_Name', 'OtherCidrBlock']
+    if args.regions:
+        header += ['Region', 'OtherRegion']
+    if args.profiles:
+        header += ['Profile', 'OtherProfile']
+
+    rows = list()
+    for (profile, vpc), cidr, (other_profile, other_vpc), other_cidr, \
+            relation in cidr_overlaps(blocks):
+        # secondary cidrs of the same vpc never overlap
+        if vpc is other_vpc:
+            continue
+        row = [vpc.vpcid(), vpc.tag_name(), cidr, relation,
+               other_vpc.vpcid(), other_vpc.tag_name(), other_cidr]
+        if args.regions:
+            row += [vpc.region(), other_vpc.region()]
+        if args.profiles:
+            row += [profile, other_profile]
+        rows.append(row)
+
+    if not rows:
+        msg("green", "No overlapping vpcs found")
+        return
+
+    sortby = args.sortby if args.sortby else "CidrBlock"
+    print_table(header, rows, sortby=sortby,
+                alignl=['Tag_Name', 'OtherTag_Name'], fmt=args.format,
+                timer=phase)
+
+
 ##############################################################################
 # List VPC
 ##############################################################################
 def cmd_list_vpcs(args):
     log.info("params: %s", args)
 
-    ec2 = initialize_boto3_session(args, 'ec2')
-
     # check if filter was specified
     filter_name = args.filter[0] if args.filter else ""
     filter_value = args.filter[1] if args.filter else ""
 
+    if args.overlaps:
+        show_vpcs_overlaps(args, filter_name, filter_value)
+        return
+
     resource = 'vpcs'
-    # get resources id
-    vpcs_id = query_aws(ec2,
-                        resource_type=resource,
-                        filter_name=filter_name,
-                        filter_value=filter_value)
-    if not vpcs_id:
-        msg("red", "Error: No vpcs found", 1)
+    header = ['VpcId', 'Tag_Name', 'CidrBlock', 'DhcpOptionsId',
+              'IsDefault', 'InstanceTenancy', 'State']
+    if args.regions:
+        header.append('Region')
+    align_left = ['CidrBlock']
+
+    if not args.detail and stream_output(args):
+        # print rows as soon as each page arrives
+        if not stream_aws_regions(args,
+                                  Aws_ec2_vpc,
+                                  header,
+                                  resource_type=resource,
+                                  filter_name=filter_name,
+                                  filter_value=filter_value,
+                                  alignl=align_left):
+            msg("red", "Error: No vpcs found", 1)
+        return
 
-    # instantiate all ec2 vpcs returned in the query
-    vpcs = [Aws_ec2_vpc(ec2, 'Vpc', i_id) for i_id in vpcs_id]
+    # get resources from all regions, built straight from the pages
+    vpcs = query_aws_regions(args,
+                             Aws_ec2_vpc,
+                             resource_type=resource,
+                             filter_name=filter_name,
+                             filter_value=filter_value)
+    if not vpcs:
+        msg("red", "Error: No vpcs found", 1)
 
     if args.detail:
         for vpc in vpcs:
             vpc.show_metadata()
     else:
-        header = ['VpcId', 'Tag_Name', 'CidrBlock', 'DhcpOptionsId',
-                  'IsDefault', 'InstanceTenancy', 'State']
         rows = list()
         for vpc in vpcs:
             row = list()
@@ -50,7 +121,7 @@ def cmd_list_vpcs(args):
             rows.append(row)
 
         sortby = args.sortby if args.sortby else "VpcId"
-        align_left = ['CidrBlock']
-        print_table(header, rows, sortby=sortby, alignl=align_left)
+        print_table(header, rows, sortby=sortby, alignl=align_left,
+                    fmt=args.format, timer=phase)
 
 # vim: ts=4
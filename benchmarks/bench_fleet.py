@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark subcommands against synthetic AWS accounts
+
+Run every subcommand and output mode against Fleet accounts of several
+sizes, without network. Each run is done in a new interpreter and
+records:
+    - wall time of the subcommand
+    - peak RSS of the process
+    - number of API calls per service and operation
+
+Results are saved as JSON, and can be compared with a previous run
+with --compare.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+
+# Get script path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+AWS_LIST_DIR = os.path.join(DIR_PATH, '..', 'aws_list')
+
+# Default number of instances of the synthetic accounts
+SIZES = [100, 1000, 10000]
+
+# Commands to measure, global options go before the subcommand
+COMMANDS = [['instances'],
+            ['instances', '-detail'],
+            ['instances', '-tags'],
+            ['instances', '-ami'],
+            ['instances', '-volumes'],
+            ['instances', '-secgroup'],
+            ['instances', '-names'],
+            ['instances', '-tag', 'Team=search'],
+            ['--stream', 'instances'],
+            ['--format', 'csv', 'instances'],
+            ['--format', 'jsonl', 'instances'],
+            ['--regions', 'all', 'instances'],
+            ['numinstances', 'InstanceType'],
+            ['numinstances', 'InstanceType,VpcId,Tag:Team'],
+            ['volumes'],
+            ['volumes', '-detail'],
+            ['subnets'],
+            ['subnets', '-overlaps'],
+            ['vpcs'],
+            ['vpcs', '-overlaps'],
+            ['secgroups'],
+            ['secgroups', '-rules'],
+            ['secgroups', '-reach', '10.1.2.3', '22'],
+            ['regions'],
+            ['s3'],
+            ['s3', '-size'],
+            ['s3', '-numobj'],
+            ['s3', '-size', '-numobj']]
+
+# Options of every run: the fleet answers the calls, so there is nothing
+# to rate limit, and a running daemon must not answer them
+RUN_OPTIONS = ['--no-daemon', '--api-rate', '0']
+
+
+###########################################################################
+# Parses the command line arguments
+###########################################################################
+def parse_parameters():
+    parser = argparse.ArgumentParser(
+        description='Benchmark subcommands against synthetic AWS accounts')
+    parser.add_argument('--sizes',
+                        default=','.join(str(i) for i in SIZES),
+                        help='Number of instances of each account, comma '
+                             'separated (default: %s). Ex: 100,1000,100000'
+                             % ','.join(str(i) for i in SIZES))
+    parser.add_argument('--commands',
+                        metavar='TEXT',
+                        help='Only run commands that contain TEXT. '
+                             'Ex: "instances -ami"')
+    parser.add_argument('--page-size',
+                        type=int,
+                        default=1000,
+                        help='Resources per page, when the request does '
+                             'not set MaxResults (default: 1000)')
+    parser.add_argument('--output', '-o',
+                        default='bench_fleet.json',
+                        help='JSON results file (default: bench_fleet.json)')
+    parser.add_argument('--compare',
+                        metavar='FILE',
+                        help='Show the results ratio to a previous JSON '
+                             'results file')
+    # internal: run one command in this process, see run_child
+    parser.add_argument('--run-child',
+                        nargs=2,
+                        metavar=('SIZE', 'CMD'),
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+###########################################################################
+# Return the peak RSS, in bytes, of this process
+###########################################################################
+def peak_rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+###########################################################################
+# Run a command against a fleet and print its result as JSON
+# Params:
+#   - size          (int): number of instances
+#   - cmd_args     (list): aws_list.py arguments
+#   - page_size     (int): fleet default page size
+###########################################################################
+def run_child(size, cmd_args, page_size):
+    # no user credentials, config or cache is used
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'AKIAFLEET',
+                       'AWS_SECRET_ACCESS_KEY': 'fleet',
+                       'AWS_DEFAULT_REGION': 'us-east-1',
+                       'AWS_CONFIG_FILE': os.devnull,
+                       'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+                       'XDG_CACHE_HOME': tempfile.mkdtemp(
+                           prefix='bench_fleet')})
+
+    sys.path.append(AWS_LIST_DIR)
+    import aws_list
+    from fleet import Fleet
+    import boto3
+    import pool
+
+    args = aws_list.parse_parameters(RUN_OPTIONS + cmd_args)
+    aws_list.configure_api_cache(args)
+    aws_list.configure_rate_limit(args)
+    aws_list.configure_pool(args)
+
+    # all clients of the default profile are created by this session
+    fleet = Fleet(size, page_size=page_size)
+    session = boto3.Session()
+    fleet.install(session)
+    pool.set_session(None, session)
+
+    rss_start = peak_rss()
+    exit_code = 0
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        try:
+            args.func(args)
+        except SystemExit as error:
+            exit_code = error.code if isinstance(error.code, int) else 1
+    wall_time = time.perf_counter() - start
+
+    print(json.dumps({'wall_time': wall_time,
+                      'peak_rss_start': rss_start,
+                      'peak_rss': peak_rss(),
+                      'exit_code': exit_code,
+                      'api_calls': dict(sorted(fleet.calls.items()))}))
+
+
+###########################################################################
+# Run a command in a new interpreter
+#
+# Return dictionary with the run result
+###########################################################################
+def run(size, cmd_args, page_size):
+    proc = subprocess.run([sys.executable, os.path.realpath(__file__),
+                           '--page-size', str(page_size),
+                           '--run-child', str(size), json.dumps(cmd_args)],
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True,
+                          check=False)
+    result = {'command': ' '.join(cmd_args), 'size': size}
+    try:
+        result.update(json.loads(proc.stdout.splitlines()[-1]))
+    except (IndexError, ValueError):
+        result.update({'exit_code': proc.returncode or 1,
+                       'error': proc.stderr.strip().splitlines()[-1:]})
+    return result
+
+
+###########################################################################
+# Return dictionary: (command, size) -> result of a JSON results file
+###########################################################################
+def load_results(filename):
+    with open(filename) as fd:
+        return {(i['command'], i['size']): i
+                for i in json.load(fd)['results']}
+
+
+###########################################################################
+# Print a result line, with the ratio to a previous result if informed
+###########################################################################
+def print_result(result, previous=None):
+    if 'wall_time' not in result:
+        print("{:>7} {:<42} FAIL {}".format(result['size'],
+                                            result['command'],
+                                            ' '.join(result['error'])))
+        return
+
+    line = "{:>7} {:<42} {:8.3f} s {:8.1f} MB {:7d} calls".format(
+        result['size'],
+        result['command'],
+        result['wall_time'],
+        result['peak_rss'] / 1024 / 1024,
+        sum(result['api_calls'].values()))
+    if previous and 'wall_time' in previous:
+        line += "  time x{:.2f} rss x{:.2f} calls {:+d}".format(
+            result['wall_time'] / previous['wall_time'],
+            result['peak_rss'] / previous['peak_rss'],
+            sum(result['api_calls'].values())
+            - sum(previous['api_calls'].values()))
+    if result['exit_code']:
+        line += "  exit code {}".format(result['exit_code'])
+    print(line)
+
+
+##############################################################################
+# Main
+##############################################################################
+def main():
+    args = parse_parameters()
+
+    if args.run_child:
+        run_child(int(args.run_child[0]), json.loads(args.run_child[1]),
+                  args.page_size)
+        return
+
+    previous = load_results(args.compare) if args.compare else dict()
+    commands = [i for i in COMMANDS
+                if not args.commands or args.commands in ' '.join(i)]
+
+    results = list()
+    for size in [int(i) for i in args.sizes.split(',')]:
+        for cmd_args in commands:
+            result = run(size, cmd_args, args.page_size)
+            print_result(result, previous.get((result['command'], size)))
+            results.append(result)
+
+    with open(args.output, 'w') as fd:
+        json.dump({'date': datetime.datetime.now().isoformat(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'page_size': args.page_size,
+                   'results': results}, fd, indent=2)
+    print("results saved in {}".format(args.output))
+
+    sys.exit(1 if any(i['exit_code'] for i in results) else 0)
+
+
+##############################################################################
+# Run from command line
+##############################################################################
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4
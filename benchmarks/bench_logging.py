@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark logging overhead per resource with --debug off
+
+Build many Aws_ec2_instance objects from synthetic page metadata and
+compare the time per resource of:
+    - no logging at all
+    - the current code (deferred formatting)
+    - eager pprint.pformat, as the code used to do
+"""
+import os
+import sys
+import time
+import pprint
+import logging
+import argparse
+import datetime
+
+
+# Get script path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# Add path where modules reside
+sys.path.append(os.path.join(DIR_PATH, '..', 'aws_list', 'resources'))
+
+import Aws
+from Aws import Aws_ec2_instance
+
+
+###########################################################################
+# Minimal boto3 ec2 service resource, only what Aws_ec2 uses when the
+# metadata comes from a page (no API call is done)
+###########################################################################
+class FakeEc2():
+    class meta():
+        class client():
+            class meta():
+                region_name = 'us-east-1'
+
+    def Instance(self, resource_id):
+        return resource_id
+
+
+###########################################################################
+# Return metadata similar to a DescribeInstances instance
+###########################################################################
+def instance_metadata(num):
+    return {
+        'InstanceId': 'i-%017x' % num,
+        'InstanceType': 't3.micro',
+        'ImageId': 'ami-0e2e2a5f6c0977c50',
+        'KeyName': 'mykey',
+        'LaunchTime': datetime.datetime(2018, 10, 18, 17, 28, 35),
+        'Placement': {'AvailabilityZone': 'us-east-1a', 'Tenancy': 'default'},
+        'PrivateIpAddress': '172.16.%d.%d' % (num // 256 % 256, num % 256),
+        'State': {'Code': 16, 'Name': 'running'},
+        'SubnetId': 'subnet-213adb7c',
+        'VpcId': 'vpc-49a93d92',
+        'SecurityGroups': [{'GroupId': 'sg-93837a73',
+                            'GroupName': 'BastionSSH'}],
+        'BlockDeviceMappings': [{'DeviceName': '/dev/xvda',
+                                 'Ebs': {'VolumeId': 'vol-%017x' % num,
+                                         'Status': 'attached'}}],
+        'Tags': [{'Key': 'Name', 'Value': 'server %d' % num},
+                 {'Key': 'Team', 'Value': 'payments'}]}
+
+
+###########################################################################
+# Parses the command line arguments
+###########################################################################
+def parse_parameters():
+    parser = argparse.ArgumentParser(
+        description='Benchmark logging overhead per resource')
+    parser.add_argument('--resources',
+                        type=int,
+                        default=20000,
+                        help='Number of resources (default: 20000)')
+    return parser.parse_args()
+
+
+###########################################################################
+# Return time per resource, in microseconds, to build all resources
+###########################################################################
+def time_per_resource(pages):
+    ec2 = FakeEc2()
+    start = time.perf_counter()
+    for metadata in pages:
+        instance = Aws_ec2_instance(ec2, 'Instance', metadata['InstanceId'],
+                                    metadata=metadata)
+        instance.tag_name()
+    return (time.perf_counter() - start) * 1e6 / len(pages)
+
+
+##############################################################################
+# Main
+##############################################################################
+def main():
+    args = parse_parameters()
+    pages = [instance_metadata(i) for i in range(args.resources)]
+
+    # same level as aws_list.py without --debug
+    logging.basicConfig(level=logging.WARNING)
+
+    # warm up
+    time_per_resource(pages)
+
+    logging.disable(logging.CRITICAL)
+    no_log = time_per_resource(pages)
+    logging.disable(logging.NOTSET)
+
+    deferred = time_per_resource(pages)
+
+    # what every resource used to pay: format before calling log.debug
+    start = time.perf_counter()
+    for metadata in pages:
+        Aws.log.debug("metadata: %s", pprint.pformat(metadata))
+    eager = no_log + (time.perf_counter() - start) * 1e6 / len(pages)
+
+    print("resources:                 {}".format(args.resources))
+    print("logging disabled:          {:8.2f} us/resource".format(no_log))
+    print("deferred formatting:       {:8.2f} us/resource".format(deferred))
+    print("eager pprint.pformat:      {:8.2f} us/resource".format(eager))
+
+
+##############################################################################
+# Run from command line
+##############################################################################
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4
@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark memory used by instance objects
+
+Build many Aws_ec2_instance objects from synthetic page metadata and
+compare the memory kept by:
+    - full records: all metadata keys (as -detail does)
+    - compact records: only the keys used by the default table
+"""
+import os
+import sys
+import argparse
+import datetime
+import tracemalloc
+
+
+# Get script path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# Add path where modules reside
+sys.path.append(os.path.join(DIR_PATH, '..', 'aws_list', 'resources'))
+
+from Aws import Aws_ec2_instance
+from instances import OUTPUT_FIELDS
+
+
+###########################################################################
+# Minimal boto3 ec2 service resource, only what Aws_ec2 uses when the
+# metadata comes from a page (no API call is done)
+###########################################################################
+class FakeEc2():
+    class meta():
+        class client():
+            class meta():
+                region_name = 'us-east-1'
+
+
+###########################################################################
+# Return metadata similar to a DescribeInstances instance
+#
+# Every value is a new object, as the ones parsed from an API response
+###########################################################################
+def instance_metadata(num):
+    return {
+        'InstanceId': 'i-%017x' % num,
+        'InstanceType': ''.join(['t3.', 'micro']),
+        'ImageId': ''.join(['ami-', '0e2e2a5f6c0977c50']),
+        'KeyName': ''.join(['my', 'key']),
+        'LaunchTime': datetime.datetime(2018, 10, 18, 17, 28, 35),
+        'Placement': {'AvailabilityZone': ''.join(['us-east-', '1a']),
+                      'GroupName': '',
+                      'Tenancy': ''.join(['def', 'ault'])},
+        'PrivateIpAddress': '172.16.%d.%d' % (num // 256 % 256, num % 256),
+        'PrivateDnsName': 'ip-172-16-%d-%d.ec2.internal' % (num // 256 % 256,
+                                                           num % 256),
+        'State': {'Code': 16, 'Name': ''.join(['run', 'ning'])},
+        'SubnetId': ''.join(['subnet-', '213adb7c']),
+        'VpcId': ''.join(['vpc-', '49a93d92']),
+        'Architecture': ''.join(['x86', '_64']),
+        'Hypervisor': ''.join(['x', 'en']),
+        'RootDeviceName': ''.join(['/dev/', 'xvda']),
+        'RootDeviceType': ''.join(['e', 'bs']),
+        'SecurityGroups': [{'GroupId': ''.join(['sg-', '93837a73']),
+                            'GroupName': ''.join(['Bastion', 'SSH'])}],
+        'BlockDeviceMappings': [{'DeviceName': ''.join(['/dev/', 'xvda']),
+                                 'Ebs': {'VolumeId': 'vol-%017x' % num,
+                                         'Status': 'attached',
+                                         'DeleteOnTermination': True}}],
+        'NetworkInterfaces': [{'NetworkInterfaceId': 'eni-%017x' % num,
+                               'MacAddress': '0e:%02x:%02x:00:00:01' % (
+                                   num // 256 % 256, num % 256),
+                               'Status': 'in-use'}],
+        'Monitoring': {'State': ''.join(['dis', 'abled'])},
+        'Tags': [{'Key': ''.join(['Na', 'me']),
+                  'Value': 'server %d' % num},
+                 {'Key': ''.join(['Te', 'am']),
+                  'Value': ''.join(['pay', 'ments'])}]}
+
+
+###########################################################################
+# Parses the command line arguments
+###########################################################################
+def parse_parameters():
+    parser = argparse.ArgumentParser(
+        description='Benchmark memory used by instance objects')
+    parser.add_argument('--resources',
+                        type=int,
+                        default=20000,
+                        help='Number of resources (default: 20000)')
+    return parser.parse_args()
+
+
+###########################################################################
+# Return memory, in bytes, kept by the objects built with fields
+###########################################################################
+def memory_used(num_resources, fields):
+    ec2 = FakeEc2()
+    tracemalloc.start()
+    instances = list()
+    for num in range(num_resources):
+        # metadata is only referenced by the object, as in a page
+        metadata = instance_metadata(num)
+        instances.append(Aws_ec2_instance(ec2, 'Instance',
+                                          metadata['InstanceId'],
+                                          metadata=metadata,
+                                          fields=fields))
+    del metadata
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used
+
+
+##############################################################################
+# Main
+##############################################################################
+def main():
+    args = parse_parameters()
+
+    full = memory_used(args.resources, None)
+    compact = memory_used(args.resources, OUTPUT_FIELDS['table'])
+
+    print("resources:        {}".format(args.resources))
+    print("full records:     {:8.1f} MB {:6d} bytes/resource".format(
+        full / 1024 / 1024, full // args.resources))
+    print("compact records:  {:8.1f} MB {:6d} bytes/resource".format(
+        compact / 1024 / 1024, compact // args.resources))
+    print("saved:            {:8.1f} %".format(100 - compact * 100 / full))
+
+
+##############################################################################
+# Run from command line
+##############################################################################
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4
@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark aws_list.py cold start time
+
+Run "aws_list.py --help" and "aws_list.py <subcommand> -h" many times in
+new interpreters and fail (exit code 1) if the startup time is over the
+budget, or if any heavy module is imported before a subcommand runs.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+
+# Get aws_list.py path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+AWS_LIST = os.path.join(DIR_PATH, '..', 'aws_list', 'aws_list.py')
+
+# Modules that must not be imported only to parse the command line
+HEAVY_MODULES = ['boto3', 'botocore', 'prettytable', 'smtplib', 'subprocess']
+
+# Commands to measure
+COMMANDS = [['--help'], ['instances', '-h'], ['regions', '-h']]
+
+
+###########################################################################
+# Parses the command line arguments
+###########################################################################
+def parse_parameters():
+    parser = argparse.ArgumentParser(
+        description='Benchmark aws_list.py cold start time')
+    parser.add_argument('--budget',
+                        type=float,
+                        default=0.15,
+                        help='Max median startup time in seconds '
+                             '(default: 0.15)')
+    parser.add_argument('--runs',
+                        type=int,
+                        default=20,
+                        help='Number of runs of each command (default: 20)')
+    return parser.parse_args()
+
+
+###########################################################################
+# Return the wall time, in seconds, to start an empty python interpreter
+###########################################################################
+def run_time_python():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=False)
+    return time.perf_counter() - start
+
+
+###########################################################################
+# Return the wall time, in seconds, to run aws_list.py with cmd_args
+###########################################################################
+def run_time(cmd_args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, AWS_LIST] + cmd_args,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL,
+                   check=False)
+    return time.perf_counter() - start
+
+
+###########################################################################
+# Return the heavy modules imported when aws_list.py runs with cmd_args
+###########################################################################
+def heavy_imports(cmd_args):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', AWS_LIST]
+                          + cmd_args,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True,
+                          check=False)
+    # lines format: "import time: self [us] | cumulative | imported package"
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            imported.add(line.split('|')[-1].strip().split('.')[0])
+    return sorted(imported.intersection(HEAVY_MODULES))
+
+
+##############################################################################
+# Main
+##############################################################################
+def main():
+    args = parse_parameters()
+
+    # baseline: interpreter startup alone
+    baseline = statistics.median(
+        run_time_python() for _ in range(args.runs))
+    print("python startup: {:.1f} ms".format(baseline * 1000))
+
+    failed = False
+    for cmd_args in COMMANDS:
+        median = statistics.median(run_time(cmd_args)
+                                   for _ in range(args.runs))
+        heavy = heavy_imports(cmd_args)
+        status = 'ok'
+        if median > args.budget or heavy:
+            status = 'FAIL'
+            failed = True
+        print("{:<20} {:7.1f} ms (+{:.1f} ms) heavy imports: {}  {}".format(
+            ' '.join(cmd_args),
+            median * 1000,
+            (median - baseline) * 1000,
+            ', '.join(heavy) if heavy else '-',
+            status))
+
+    sys.exit(1 if failed else 0)
+
+
+##############################################################################
+# Run from command line
+##############################################################################
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4
@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare query strategies over a simulated network
+
+Run the same queries with serial, threaded and batched strategies
+against a Fleet account behind a Network with latency and throttling,
+so concurrency settings can be tuned without network. Paths:
+    - query_aws: instances of all regions
+    - regions: availability zones of all regions
+    - s3: size of all buckets, per bucket GetMetricStatistics or
+      batched GetMetricData
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import collections
+import concurrent.futures
+
+
+# Get script path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+AWS_LIST_DIR = os.path.join(DIR_PATH, '..', 'aws_list')
+
+# no user credentials, config or cache is used
+os.environ.update({'AWS_ACCESS_KEY_ID': 'AKIANETWORK',
+                   'AWS_SECRET_ACCESS_KEY': 'network',
+                   'AWS_DEFAULT_REGION': 'us-east-1',
+                   'AWS_CONFIG_FILE': os.devnull,
+                   'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+                   'XDG_CACHE_HOME': tempfile.mkdtemp(
+                       prefix='bench_strategies')})
+sys.path.append(AWS_LIST_DIR)
+
+import aws_list
+from fleet import Fleet
+from network import Network
+
+
+###########################################################################
+# Parses the command line arguments
+###########################################################################
+def parse_parameters():
+    parser = argparse.ArgumentParser(
+        description='Compare query strategies over a simulated network')
+    parser.add_argument('--size',
+                        type=int,
+                        default=5000,
+                        help='Number of instances of the account '
+                             '(default: 5000)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=aws_list.MAX_WORKERS,
+                        help='Threads of the threaded strategies '
+                             '(default: %s)' % aws_list.MAX_WORKERS)
+    parser.add_argument('--paths',
+                        default='query_aws,regions,s3',
+                        help='Paths to compare (default: '
+                             'query_aws,regions,s3)')
+    parser.add_argument('--settings',
+                        metavar='FILE',
+                        help='JSON file with Network settings per '
+                             'operation. Ex: {"*": {"latency": 0.1}, '
+                             '"DescribeInstances": {"max_rate": 5}}')
+    parser.add_argument('--latency',
+                        type=float,
+                        help='Median latency in seconds of all operations')
+    parser.add_argument('--throttle-rate',
+                        type=float,
+                        help='Fraction of attempts throttled at random')
+    parser.add_argument('--page-size',
+                        type=int,
+                        help='Resources per Describe* page')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=1,
+                        help='Random seed (default: 1)')
+    parser.add_argument('--output', '-o',
+                        help='Save results in a JSON file')
+    return parser.parse_args()
+
+
+###########################################################################
+# Return Network settings from the command line arguments
+###########################################################################
+def network_settings(args):
+    settings = dict()
+    if args.settings:
+        with open(args.settings) as fd:
+            settings = json.load(fd)
+    for key in ('latency', 'throttle_rate', 'page_size'):
+        if getattr(args, key) is not None:
+            settings.setdefault('*', dict())[key] = getattr(args, key)
+    return settings
+
+
+###########################################################################
+# Return aws_list arguments with a new pool whose clients use the network
+#
+# --refresh makes every strategy query the bucket locations again
+###########################################################################
+def aws_list_args(network, workers, argv):
+    import boto3
+    import pool
+
+    args = aws_list.parse_parameters(['--no-daemon', '--refresh',
+                                      '--workers', str(workers)] + argv)
+    aws_list.configure_api_cache(args)
+    aws_list.configure_rate_limit(args)
+    aws_list.configure_pool(args)
+
+    session = boto3.Session()
+    network.install(session)
+    pool.set_session(None, session)
+    return args
+
+
+###########################################################################
+# Strategies: function(network, workers) -> number of results
+###########################################################################
+def query_aws_regions(network, workers):
+    from Aws import Aws_ec2_instance
+    from Aws import query_aws_regions
+
+    args = aws_list_args(network, workers, ['--regions', 'all', 'instances'])
+    return len(query_aws_regions(args,
+                                 Aws_ec2_instance,
+                                 resource_type='instances'))
+
+
+def query_aws_regions_pages(network, workers):
+    from Aws import Aws_ec2_instance
+    from Aws import query_aws_regions_pages
+
+    args = aws_list_args(network, workers, ['--regions', 'all', 'instances'])
+    return sum(len(page)
+               for page in query_aws_regions_pages(
+                   args, Aws_ec2_instance, resource_type='instances'))
+
+
+def regions_topology(network, workers):
+    from regions import query_regions_topology
+
+    args = aws_list_args(network, workers, ['regions'])
+    return sum(len(i) for i in query_regions_topology(args).values())
+
+
+def s3_buckets(args):
+    from Aws import initialize_boto3_session
+    from s3 import s3_buckets_location
+
+    s3 = initialize_boto3_session(args, 's3')
+    bucket_names = [bucket.name for bucket in s3.buckets.all()]
+    return s3, s3_buckets_location(args, s3, bucket_names)
+
+
+def s3_size_per_bucket(network, workers):
+    from Cloudwatch import Cloudwatch
+
+    args = aws_list_args(network, workers, ['s3', '-size'])
+    _, locations = s3_buckets(args)
+
+    def query_bucket(bucket_name):
+        cloudwatch = Cloudwatch(args.profile, locations[bucket_name])
+        return cloudwatch.get_s3_bucket_size(bucket_name, 1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return len(list(pool.map(query_bucket, locations)))
+
+
+def s3_size_batched(network, workers):
+    from s3 import s3_buckets_metrics
+
+    args = aws_list_args(network, workers, ['s3', '-size'])
+    s3, locations = s3_buckets(args)
+    return len(s3_buckets_metrics(args, s3, list(locations), ['size'], 1))
+
+
+# path -> list of (strategy name, function, workers or None for --workers)
+STRATEGIES = collections.OrderedDict([
+    ('query_aws', [('serial', query_aws_regions, 1),
+                   ('threaded', query_aws_regions, None),
+                   ('threaded pages', query_aws_regions_pages, None)]),
+    ('regions', [('serial', regions_topology, 1),
+                 ('threaded', regions_topology, None)]),
+    ('s3', [('serial', s3_size_per_bucket, 1),
+            ('threaded', s3_size_per_bucket, None),
+            ('batched', s3_size_batched, 1),
+            ('threaded batched', s3_size_batched, None)])])
+
+
+##############################################################################
+# Main
+##############################################################################
+def main():
+    args = parse_parameters()
+
+    fleet = Fleet(args.size)
+    network = Network(fleet, network_settings(args), seed=args.seed)
+
+    print("{:<10} {:<17} {:>7} {:>9} {:>7} {:>8} {:>9} {:>8}".format(
+        'path', 'strategy', 'workers', 'time', 'calls', 'attempts',
+        'throttles', 'results'))
+    results = list()
+    for path in args.paths.split(','):
+        for name, func, workers in STRATEGIES[path]:
+            workers = workers or args.workers
+            network.reset()
+            start = time.perf_counter()
+            num_results = func(network, workers)
+            wall_time = time.perf_counter() - start
+            result = {'path': path,
+                      'strategy': name,
+                      'workers': workers,
+                      'wall_time': wall_time,
+                      'results': num_results,
+                      'api_calls': dict(sorted(fleet.calls.items())),
+                      'attempts': dict(sorted(network.attempts.items())),
+                      'throttles': dict(sorted(network.throttles.items())),
+                      'latency': network.latency}
+            results.append(result)
+            print("{:<10} {:<17} {:>7} {:>7.2f} s {:>7} {:>8} {:>9} "
+                  "{:>8}".format(path, name, workers, wall_time,
+                                 sum(result['api_calls'].values()),
+                                 sum(result['attempts'].values()),
+                                 sum(result['throttles'].values()),
+                                 num_results))
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump({'size': args.size,
+                       'seed': args.seed,
+                       'settings': network.settings,
+                       'results': results}, fd, indent=2)
+        print("results saved in {}".format(args.output))
+
+
+##############################################################################
+# Run from command line
+##############################################################################
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic AWS account served to boto3 without network
+
+Fleet answers the EC2, S3 and CloudWatch operations used by aws_list with
+generated resources. It is installed on a boto3 session with botocore
+event handlers: "before-parameter-build" keeps the request parameters
+and "before-call" returns the synthetic response, so no request is
+signed or sent. Every answered call is counted per operation.
+"""
+import os
+import sys
+import datetime
+import threading
+import collections
+
+
+# Get script path
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# Add path where modules reside
+sys.path.append(os.path.join(DIR_PATH, '..', 'aws_list', 'resources'))
+
+from cache import cached_http_response
+
+
+# Default number of resources per page, when MaxResults is not informed
+PAGE_SIZE = 1000
+
+# Regions returned by DescribeRegions
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1',
+           'eu-central-1', 'sa-east-1', 'ap-southeast-1', 'ap-northeast-1']
+
+INSTANCE_TYPES = ['t3.micro', 't3.small', 'm5.large', 'c5.xlarge', 'r5.large']
+TEAMS = ['payments', 'search', 'infra', 'data']
+PORTS = [22, 80, 443, 3306, 5432, 8080]
+
+LAUNCH_TIME = datetime.datetime(2018, 10, 18, 17, 28, 35,
+                                tzinfo=datetime.timezone.utc)
+
+
+##############################################################################
+# Fleet Class
+##############################################################################
+class Fleet:
+    """
+    Synthetic account with size instances and proportional numbers of the
+    other resources. Resources are generated from their index when they
+    are requested, so big fleets do not use memory.
+
+    Params:
+        size        (int): number of instances
+        page_size   (int): Optional. Default number of resources per page
+        page_sizes (dict): Optional. Operation -> number of resources per
+                           page, instead of page_size
+    """
+
+    def __init__(self, size, page_size=PAGE_SIZE, page_sizes=None):
+        self.page_size = page_size
+        self.page_sizes = page_sizes or dict()
+        self.counts = {'instance': size,
+                       'volume': size,
+                       'image': max(1, size // 50),
+                       'vpc': max(1, size // 500),
+                       'subnet': max(1, size // 500) * 4,
+                       'sg': max(1, size // 20),
+                       'bucket': max(1, min(size // 100, 1000))}
+        # operation -> number of calls
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+        # operation -> (resource kind, response key, item builder)
+        self.describe = {
+            'DescribeInstances': ('instance', 'Reservations', self.instance),
+            'DescribeVolumes': ('volume', 'Volumes', self.volume),
+            'DescribeImages': ('image', 'Images', self.image),
+            'DescribeVpcs': ('vpc', 'Vpcs', self.vpc),
+            'DescribeSubnets': ('subnet', 'Subnets', self.subnet),
+            'DescribeSecurityGroups': ('sg', 'SecurityGroups',
+                                       self.secgroup)}
+
+    ##########################################################################
+    # Resources
+    ##########################################################################
+    @staticmethod
+    def resource_id(kind, index):
+        return '%s-%017x' % (kind, index)
+
+    def instance(self, index):
+        subnet = index % self.counts['subnet']
+        return {
+            'InstanceId': self.resource_id('i', index),
+            'InstanceType': INSTANCE_TYPES[index % len(INSTANCE_TYPES)],
+            'ImageId': self.resource_id('ami', index % self.counts['image']),
+            'KeyName': 'key-%d' % (index % 7),
+            'LaunchTime': LAUNCH_TIME,
+            'Placement': {'AvailabilityZone': 'us-east-1' + 'abcd'[subnet % 4],
+                          'GroupName': '', 'Tenancy': 'default'},
+            'PrivateIpAddress': '10.%d.%d.%d' % (subnet // 4 % 256,
+                                                 index // 256 % 256,
+                                                 index % 256),
+            'State': {'Code': 16, 'Name': 'running'},
+            'SubnetId': self.resource_id('subnet', subnet),
+            'VpcId': self.resource_id('vpc', subnet // 4),
+            'Architecture': 'x86_64',
+            'RootDeviceName': '/dev/xvda',
+            'RootDeviceType': 'ebs',
+            'SecurityGroups': [{
+                'GroupId': self.resource_id('sg', index % self.counts['sg']),
+                'GroupName': 'group %d' % (index % self.counts['sg'])}],
+            'BlockDeviceMappings': [{
+                'DeviceName': '/dev/xvda',
+                'Ebs': {'VolumeId': self.resource_id('vol', index),
+                        'Status': 'attached',
+                        'AttachTime': LAUNCH_TIME,
+                        'DeleteOnTermination': True}}],
+            'Tags': [{'Key': 'Name', 'Value': 'server %d' % index},
+                     {'Key': 'Team', 'Value': TEAMS[index % len(TEAMS)]}]}
+
+    def volume(self, index):
+        return {
+            'VolumeId': self.resource_id('vol', index),
+            'Size': 8 + index % 100,
+            'VolumeType': 'gp2',
+            'State': 'in-use',
+            'Iops': 100,
+            'CreateTime': LAUNCH_TIME,
+            'AvailabilityZone': 'us-east-1a',
+            'Attachments': [{'InstanceId': self.resource_id('i', index),
+                             'Device': '/dev/xvda',
+                             'State': 'attached',
+                             'DeleteOnTermination': True}]}
+
+    def image(self, index):
+        return {
+            'ImageId': self.resource_id('ami', index),
+            'Name': 'image %d' % index,
+            'Description': 'synthetic image %d' % index,
+            'OwnerId': '123456789012',
+            'ImageOwnerAlias': 'self',
+            'RootDeviceType': 'ebs',
+            'CreationDate': '2018-10-18T17:28:35.000Z',
+            'State': 'available',
+            'Tags': [{'Key': 'Name', 'Value': 'image %d' % index}]}
+
+    def vpc(self, index):
+        # some vpcs reuse the cidr of another one, to be found by -overlaps
+        cidr = '10.%d.0.0/16' % (index % 200)
+        return {
+            'VpcId': self.resource_id('vpc', index),
+            'CidrBlock': cidr,
+            'CidrBlockAssociationSet': [{
+                'CidrBlock': cidr,
+                'CidrBlockState': {'State': 'associated'}}],
+            'DhcpOptionsId': 'dopt-0001',
+            'IsDefault': index == 0,
+            'InstanceTenancy': 'default',
+            'State': 'available',
+            'Tags': [{'Key': 'Name', 'Value': 'vpc %d' % index}]}
+
+    def subnet(self, index):
+        return {
+            'SubnetId': self.resource_id('subnet', index),
+            'VpcId': self.resource_id('vpc', index // 4),
+            'CidrBlock': '10.%d.%d.0/24' % (index // 4 % 200, index % 4),
+            'AvailableIpAddressCount': 200,
+            'AvailabilityZone': 'us-east-1' + 'abcd'[index % 4],
+            'DefaultForAz': False,
+            'State': 'available',
+            'Tags': [{'Key': 'Name', 'Value': 'subnet %d' % index}]}
+
+    def secgroup(self, index):
+        rules = [{'IpProtocol': 'tcp',
+                  'FromPort': port,
+                  'ToPort': port,
+                  'IpRanges': [{'CidrIp': '10.%d.0.0/16' % (index % 200)}],
+                  'Ipv6Ranges': [],
+                  'UserIdGroupPairs': [{
+                      'GroupId': self.resource_id(
+                          'sg', (index + 1) % self.counts['sg'])}]}
+                 for port in PORTS[index % 3:index % 3 + 3]]
+        if index % 50 == 0:
+            rules.append({'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22,
+                          'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                          'Ipv6Ranges': [], 'UserIdGroupPairs': []})
+        return {
+            'GroupId': self.resource_id('sg', index),
+            'GroupName': 'group %d' % index,
+            'Description': 'synthetic group %d' % index,
+            'VpcId': self.resource_id('vpc', index % self.counts['vpc']),
+            'IpPermissions': rules,
+            'IpPermissionsEgress': [{'IpProtocol': '-1',
+                                     'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                                     'Ipv6Ranges': [],
+                                     'UserIdGroupPairs': []}],
+            'Tags': [{'Key': 'Name', 'Value': 'group %d' % index}]}
+
+    ##########################################################################
+    # Responses
+    ##########################################################################
+    def selected_indexes(self, kind, params):
+        """
+        Return the indexes selected by the id filters or id lists of a
+        Describe* request. Other filters (ex: tag wildcards) select all
+        """
+        ids = list()
+        for key in ('InstanceIds', 'VolumeIds', 'ImageIds', 'VpcIds',
+                    'SubnetIds', 'GroupIds'):
+            ids.extend(params.get(key, []))
+        for filter_ in params.get('Filters', []):
+            if filter_['Name'].endswith('-id') and not any(
+                    '*' in value for value in filter_['Values']):
+                ids.extend(filter_['Values'])
+
+        if not ids:
+            return range(self.counts[kind])
+
+        indexes = set()
+        for resource_id in ids:
+            try:
+                index = int(resource_id.rsplit('-', 1)[1], 16)
+            except (IndexError, ValueError):
+                continue
+            if index < self.counts[kind]:
+                indexes.add(index)
+        return sorted(indexes)
+
+    def describe_page(self, operation, params):
+        """
+        Return a page of a Describe* response, following NextToken
+        """
+        kind, key, build = self.describe[operation]
+        indexes = self.selected_indexes(kind, params)
+        start = int(params.get('NextToken') or 0)
+        end = start + (params.get('MaxResults')
+                       or self.page_sizes.get(operation, self.page_size))
+
+        items = [build(index) for index in indexes[start:end]]
+        if operation == 'DescribeInstances':
+            items = [{'ReservationId': 'r-%017x' % start,
+                      'OwnerId': '123456789012',
+                      'Groups': [],
+                      'Instances': items}] if items else []
+        response = {key: items}
+        if end < len(indexes):
+            response['NextToken'] = str(end)
+        return response
+
+    def metric_data(self, params):
+        end_time = params['EndTime']
+        results = list()
+        for query in params['MetricDataQueries']:
+            dimensions = query['MetricStat']['Metric']['Dimensions']
+            bucket = dimensions[0]['Value']
+            index = int(bucket.rsplit('-', 1)[1])
+            results.append({
+                'Id': query['Id'],
+                'Label': query['MetricStat']['Metric']['MetricName'],
+                'Timestamps': [end_time - datetime.timedelta(days=1)],
+                'Values': [float((index + 1) * 1024 ** 2)],
+                'StatusCode': 'Complete'})
+        return {'MetricDataResults': results, 'Messages': []}
+
+    @staticmethod
+    def metric_statistics(params):
+        bucket = params['Dimensions'][0]['Value']
+        index = int(bucket.rsplit('-', 1)[1])
+        end_time = params['EndTime']
+        return {'Label': params['MetricName'],
+                'Datapoints': [{
+                    'Timestamp': end_time - datetime.timedelta(days=1),
+                    'Average': float((index + 1) * 1024 ** 2),
+                    'Unit': params['Unit']}]}
+
+    def response(self, operation, params):
+        """
+        Return the parsed response of an operation, or None if the
+        operation is not handled
+        """
+        if operation in self.describe:
+            return self.describe_page(operation, params)
+        if operation == 'DescribeRegions':
+            return {'Regions': [{'RegionName': region,
+                                 'Endpoint': 'ec2.%s.amazonaws.com' % region}
+                                for region in REGIONS]}
+        if operation == 'DescribeAvailabilityZones':
+            return {'AvailabilityZones': [
+                {'ZoneName': 'us-east-1' + zone, 'State': 'available'}
+                for zone in 'abcd']}
+        if operation == 'ListBuckets':
+            return {'Buckets': [{'Name': 'bucket-%d' % index,
+                                 'CreationDate': LAUNCH_TIME}
+                                for index in range(self.counts['bucket'])],
+                    'Owner': {'ID': '1234'}}
+        if operation == 'GetBucketLocation':
+            index = int(params['Bucket'].rsplit('-', 1)[1])
+            return {'LocationConstraint': [None, 'eu-west-1',
+                                           'sa-east-1'][index % 3]}
+        if operation == 'GetMetricData':
+            return self.metric_data(params)
+        if operation == 'GetMetricStatistics':
+            return self.metric_statistics(params)
+        return None
+
+    ##########################################################################
+    # botocore handlers
+    ##########################################################################
+    def install(self, session):
+        """
+        Answer the calls of all clients created afterwards by a boto3
+        session
+        """
+        session.events.register('before-parameter-build', self.keep_params)
+        session.events.register('before-call', self.answer)
+
+    @staticmethod
+    def keep_params(params, context, **kwargs):
+        context['fleet_params'] = params
+
+    def answer(self, model, context, **kwargs):
+        with self.lock:
+            self.calls[model.service_model.service_name + '.'
+                       + model.name] += 1
+        response = self.response(model.name, context.get('fleet_params', {}))
+        if response is None:
+            # never send a real request, the caller gets an empty response
+            response = dict()
+        response.setdefault('ResponseMetadata', {'HTTPStatusCode': 200})
+        return cached_http_response(), response
+
+# vim: ts=4
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated network between boto3 and a synthetic AWS account
+
+Network answers the calls of a Fleet as if they went through the
+internet: each attempt waits a sampled latency and may be throttled, by
+a random error rate or by a server side max rate. It is installed on a
+boto3 session with botocore event handlers:
+    - "before-call" keeps the protocol of each service (ec2, query,
+      rest-xml, json, rest-json or smithy-rpc-v2-cbor)
+    - "before-send" waits the latency and returns a throttling error or
+      an empty successful http response, so no request is sent. Bodies
+      are encoded in the service protocol, so botocore parses them as a
+      real answer. It runs inside botocore retry loop, so throttled
+      attempts are retried with botocore backoff and are seen by the
+      ratelimit module
+    - "after-call" fills the parsed response with the Fleet response
+"""
+import json
+import math
+import time
+import random
+import urllib.parse
+import threading
+import collections
+
+
+# Default settings of all operations. Settings of an operation are the
+# '*' settings updated with the operation ones. Keys:
+#   - latency       (float): median seconds of each attempt
+#   - sigma         (float): lognormal spread of the latency, 0 is constant
+#   - jitter        (float): max seconds added at random to the latency
+#   - throttle_rate (float): fraction of attempts throttled at random
+#   - max_rate      (float): max attempts per second per region and
+#                            operation before the server throttles, 0 is
+#                            unlimited
+#   - page_size       (int): resources per Describe* page
+SETTINGS = {'*': {'latency': 0.05,
+                  'sigma': 0.3,
+                  'jitter': 0.01,
+                  'throttle_rate': 0.0,
+                  'max_rate': 0,
+                  'page_size': 1000},
+            'DescribeInstances': {'latency': 0.3, 'max_rate': 20},
+            'DescribeVolumes': {'latency': 0.2, 'max_rate': 20},
+            'DescribeImages': {'latency': 0.4, 'max_rate': 20},
+            'DescribeSecurityGroups': {'latency': 0.15, 'max_rate': 20},
+            'DescribeRegions': {'latency': 0.1},
+            'DescribeAvailabilityZones': {'latency': 0.1},
+            'ListBuckets': {'latency': 0.2},
+            'GetBucketLocation': {'latency': 0.1, 'max_rate': 50},
+            'GetMetricStatistics': {'latency': 0.08, 'max_rate': 50},
+            'GetMetricData': {'latency': 0.4, 'max_rate': 20}}
+
+# Throttling error of each service: service -> (http status, error code)
+THROTTLING_ERRORS = {'ec2': (400, 'RequestLimitExceeded'),
+                     's3': (503, 'SlowDown'),
+                     'cloudwatch': (400, 'Throttling')}
+THROTTLING_ERROR_DEFAULT = (400, 'Throttling')
+
+# Message of the simulated throttling errors
+THROTTLING_MESSAGE = 'Simulated throttling'
+
+
+##############################################################################
+# Encode a dictionary of strings as a CBOR map, as smithy-rpc-v2-cbor
+# services answer
+##############################################################################
+def cbor_map(data):
+    def head(major_type, length):
+        if length < 24:
+            return bytes([major_type << 5 | length])
+        if length < 256:
+            return bytes([major_type << 5 | 24, length])
+        return bytes([major_type << 5 | 25]) + length.to_bytes(2, 'big')
+
+    def text(value):
+        value = value.encode()
+        return head(3, len(value)) + value
+
+    return head(5, len(data)) + b''.join(text(key) + text(value)
+                                         for key, value in data.items())
+
+
+##############################################################################
+# Http response body, as botocore reads it from urllib3
+##############################################################################
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+##############################################################################
+# Network Class
+##############################################################################
+class Network:
+    """
+    Latency and throttling between boto3 and a Fleet
+
+    Params:
+        fleet     (Fleet): synthetic account that answers the calls
+        settings   (dict): Optional. Operation -> settings, merged with
+                           SETTINGS. Its '*' settings override the ones
+                           of all operations
+        seed        (int): Optional. Random seed, runs with the same seed
+                           sample the same latencies and errors
+    """
+
+    def __init__(self, fleet, settings=None, seed=None):
+        self.fleet = fleet
+        self.settings = dict()
+        for operation in set(SETTINGS).union(settings or ()):
+            self.settings[operation] = dict()
+            for source in (SETTINGS, settings or dict()):
+                self.settings[operation].update(source.get('*', {}))
+                self.settings[operation].update(source.get(operation, {}))
+        self.fleet.page_sizes = {
+            operation: operation_settings['page_size']
+            for operation, operation_settings in self.settings.items()}
+        self.fleet.page_size = self.settings['*']['page_size']
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # service, as in botocore event names -> protocol
+        self.protocols = dict()
+        # (endpoint, operation) -> (tokens, last attempt time)
+        self.buckets = dict()
+        # operation -> number of attempts, throttled attempts
+        self.attempts = collections.Counter()
+        self.throttles = collections.Counter()
+        # seconds waited in latency by all attempts
+        self.latency = 0.0
+
+    def operation_settings(self, operation):
+        return self.settings.get(operation, self.settings['*'])
+
+    def sample_latency(self, operation):
+        settings = self.operation_settings(operation)
+        with self.lock:
+            latency = settings['latency']
+            if settings['sigma'] and latency:
+                latency = self.random.lognormvariate(math.log(latency),
+                                                     settings['sigma'])
+            latency += self.random.uniform(0, settings['jitter'])
+            self.latency += latency
+        return latency
+
+    def throttled(self, endpoint, operation):
+        """
+        Return True if an attempt is throttled. A server side token
+        bucket, with one second of burst, is used per endpoint (ie,
+        region) and operation
+        """
+        settings = self.operation_settings(operation)
+        with self.lock:
+            self.attempts[operation] += 1
+            if self.random.random() < settings['throttle_rate']:
+                self.throttles[operation] += 1
+                return True
+            max_rate = settings['max_rate']
+            if not max_rate:
+                return False
+            now = time.monotonic()
+            tokens, last = self.buckets.get((endpoint, operation),
+                                            (max_rate, now))
+            tokens = min(max_rate, tokens + (now - last) * max_rate)
+            if tokens < 1:
+                self.buckets[endpoint, operation] = (tokens, now)
+                self.throttles[operation] += 1
+                return True
+            self.buckets[endpoint, operation] = (tokens - 1, now)
+            return False
+
+    def reset(self):
+        """
+        Clear the counters of the network and of the fleet
+        """
+        with self.lock:
+            self.buckets.clear()
+            self.attempts.clear()
+            self.throttles.clear()
+            self.latency = 0.0
+        self.fleet.calls.clear()
+
+    ##########################################################################
+    # botocore handlers
+    ##########################################################################
+    def install(self, session):
+        """
+        Answer the calls of all clients created afterwards by a boto3
+        session. Handlers run after the ones of the clients, so the
+        ratelimit module waits before the simulated latency
+        """
+        session.events.register('before-parameter-build',
+                                self.fleet.keep_params)
+        session.events.register('before-call', self.keep_protocol)
+        session.events.register_last('before-send', self.send)
+        session.events.register_last('after-call', self.fill)
+
+    def keep_protocol(self, model, event_name, **kwargs):
+        # event_name: before-call.<service>.<operation>, the same service
+        # of the before-send event name. Services with several protocols
+        # (ex: cloudwatch) use the one resolved by botocore, older
+        # versions only have one
+        service_model = model.service_model
+        self.protocols[event_name.split('.')[1]] = getattr(
+            service_model, 'resolved_protocol', service_model.protocol)
+
+    def send(self, request, event_name, **kwargs):
+        # botocore is loaded by boto3, when the session is created
+        from botocore.awsrequest import AWSResponse
+
+        # event_name: before-send.<service>.<operation>
+        _, service, operation = event_name.split('.', 2)
+        protocol = self.protocols.get(service, 'query')
+        endpoint = urllib.parse.urlsplit(request.url).netloc
+        time.sleep(self.sample_latency(operation))
+
+        if self.throttled(endpoint, operation):
+            status, code = THROTTLING_ERRORS.get(service,
+                                                 THROTTLING_ERROR_DEFAULT)
+            headers, body = self.error_body(protocol, code)
+        else:
+            status = 200
+            headers, body = self.success_body(protocol, operation)
+        return AWSResponse(request.url, status, headers, RawBody(body))
+
+    @staticmethod
+    def error_body(protocol, code):
+        """
+        Return tuple: http headers, body of a throttling error
+        """
+        if protocol == 'ec2':
+            return {}, ('<Response><Errors><Error><Code>%s</Code>'
+                        '<Message>%s</Message></Error></Errors>'
+                        '<RequestID>network</RequestID></Response>'
+                        % (code, THROTTLING_MESSAGE)).encode()
+        if protocol == 'rest-xml':
+            return {}, ('<Error><Code>%s</Code><Message>%s</Message>'
+                        '</Error>' % (code, THROTTLING_MESSAGE)).encode()
+        if protocol in ('json', 'rest-json'):
+            return ({'content-type': 'application/x-amz-json-1.0',
+                     'x-amzn-errortype': code},
+                    json.dumps({'__type': code,
+                                'message': THROTTLING_MESSAGE}).encode())
+        if protocol == 'smithy-rpc-v2-cbor':
+            return ({'content-type': 'application/cbor',
+                     'smithy-protocol': 'rpc-v2-cbor'},
+                    cbor_map({'__type': code,
+                              'message': THROTTLING_MESSAGE}))
+        return {}, ('<ErrorResponse><Error><Type>Sender</Type>'
+                    '<Code>%s</Code><Message>%s</Message></Error>'
+                    '<RequestId>network</RequestId></ErrorResponse>'
+                    % (code, THROTTLING_MESSAGE)).encode()
+
+    @staticmethod
+    def success_body(protocol, operation):
+        """
+        Return tuple: http headers, body of an empty result. The parsed
+        response is filled by fill()
+        """
+        if protocol in ('json', 'rest-json'):
+            return {'content-type': 'application/x-amz-json-1.0'}, b'{}'
+        if protocol == 'smithy-rpc-v2-cbor':
+            return ({'content-type': 'application/cbor',
+                     'smithy-protocol': 'rpc-v2-cbor'},
+                    cbor_map({}))
+        return {}, ('<{0}Response><{0}Result/></{0}Response>'
+                    .format(operation)).encode()
+
+    def fill(self, http_response, parsed, model, context, **kwargs):
+        if http_response.status_code >= 300:
+            return
+        with self.fleet.lock:
+            self.fleet.calls[model.service_model.service_name + '.'
+                             + model.name] += 1
+        response = self.fleet.response(model.name,
+                                       context.get('fleet_params', {}))
+        metadata = parsed.get('ResponseMetadata', {})
+        parsed.clear()
+        parsed.update(response or {})
+        parsed['ResponseMetadata'] = metadata
+
+# vim: ts=4